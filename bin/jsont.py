@@ -55,8 +55,7 @@ def main(argv):
                               more_predicates=None)
 
   dictionary = json.load(sys.stdin)
-  s = t.expand(dictionary)
-  sys.stdout.write(s.encode('utf-8'))
+  sys.stdout.write(t.expand_bytes(dictionary))
   return 0
 
 
@@ -1582,6 +1582,9 @@ def main(argv):
   options = cmdapp.ParseArgv(argv, run_params)
 
   int_py_verifier = python_verifier.InternalTemplateVerifier()
+  # The same tests against the code-generating backend
+  codegen_verifier = python_verifier.InternalTemplateVerifier(
+      backend='codegen')
 
   python_impl = os.path.join(this_dir, 'python', 'expand.py')
   py_verifier = python_verifier.ExternalVerifier(python_impl)
@@ -1611,6 +1614,7 @@ def main(argv):
   multi_tests = taste.GetTestClasses(__import__(__name__), filt)
 
   internal_tests = [m(int_py_verifier) for m in multi_tests]
+  internal_tests.extend(m(codegen_verifier) for m in multi_tests)
 
   # External versions
   if options.all_tests:
@@ -0,0 +1,267 @@
+#!/usr/bin/python -S
+"""
+benchmarks.py
+
+Micro-benchmarks for the Python implementation of JSON Template.  Each one
+compares an optimized code path against the code it replaced (or against the
+reference implementation), on the same input.
+
+Usage:
+  benchmarks.py               # run all benchmarks
+  benchmarks.py tokenize ...  # run the named benchmarks
+"""
+
+__author__ = 'Andy Chu'
+
+
+import cgi
+import os
+import pprint
+import sys
+import timeit
+
+if __name__ == '__main__':
+  # for the jsontemplate package
+  sys.path.insert(0, os.path.dirname(__file__))
+
+from jsontemplate import _jsontemplate as jsontemplate
+
+
+def _Time(func, number):
+  """Returns the best time per call of func, in seconds."""
+  return min(timeit.Timer(func).repeat(3, number)) / number
+
+
+def _Report(name, before, after):
+  print '%-40s %12.1f us %12.1f us %8.2fx' % (
+      name, before * 1e6, after * 1e6, before / after)
+
+
+def _Header(title):
+  print
+  print title
+  print '%-40s %15s %15s %9s' % ('', 'before', 'after', 'speedup')
+
+
+# A chunk of a typical generated page: mostly static HTML, with some
+# directives alone on a line, some inline, and comments.
+_PAGE_CHUNK = """\
+<div class="item">
+  {# A comment which is removed}
+  <h2>{title|html}</h2>
+  {.section author}
+    <p class="author">By {name|html} ({email|html-attr-value})</p>
+  {.or}
+    <p class="author">Anonymous</p>
+  {.end}
+  <ul>
+    {.repeated section tags}
+      <li><a href="/tags/{@|url-param-value}">{@|html}</a></li>
+    {.end}
+  </ul>
+  <p>Posted on {date}{.space}in {category|html}.</p>
+</div>
+"""
+
+
+def _GeneratedTemplate(num_lines):
+  """Returns a template string with about num_lines lines."""
+  n = _PAGE_CHUNK.count('\n')
+  return _PAGE_CHUNK * (num_lines // n)
+
+
+def BenchmarkTokenize():
+  """Compile-time cost of _Tokenize vs. the old line-by-line tokenizer."""
+  _Header('Tokenizing a 5000 line template')
+  template_str = _GeneratedTemplate(5000)
+  for whitespace in ('smart', 'strip-line'):
+    before = _Time(
+        lambda: list(jsontemplate._TokenizeLines(
+            template_str, '{', '}', whitespace)),
+        10)
+    after = _Time(
+        lambda: list(jsontemplate._Tokenize(
+            template_str, '{', '}', whitespace)),
+        10)
+    _Report('tokenize (whitespace=%s)' % whitespace, before, after)
+
+  _Header('Compiling a 5000 line template')
+  tokenize = jsontemplate._Tokenize
+  for whitespace in ('smart', 'strip-line'):
+    compile_template = lambda: jsontemplate.Template(
+        template_str, whitespace=whitespace)
+    jsontemplate._Tokenize = jsontemplate._TokenizeLines
+    try:
+      before = _Time(compile_template, 10)
+    finally:
+      jsontemplate._Tokenize = tokenize
+    after = _Time(compile_template, 10)
+    _Report('Template() (whitespace=%s)' % whitespace, before, after)
+
+
+def _DoRepeatedSectionWithNext(args, context, callback, trace):
+  """The old _DoRepeatedSection, which calls context.Next() for every item."""
+  block = args
+
+  items = context.PushResolvedSection(block.lookup, block.pre_format)
+  if items:
+    if not isinstance(items, list):
+      raise jsontemplate.EvaluationError(
+          'Expected a list; got %s' % type(items))
+
+    last_index = len(items) - 1
+    statements = block.LoopStatements()
+    alt_statements = block.LoopStatements('alternates with')
+    try:
+      i = 0
+      while True:
+        context.Next()
+        jsontemplate._Execute(statements, context, callback, trace)
+        if i != last_index:
+          jsontemplate._Execute(alt_statements, context, callback, trace)
+        i += 1
+    except StopIteration:
+      pass
+
+  else:
+    jsontemplate._Execute(block.Statements('or'), context, callback, trace)
+
+  context.Pop()
+
+
+def BenchmarkRepeated():
+  """Per-item overhead of repeated sections in the interpreter."""
+  num_rows = 10000
+  _Header('Expanding %d rows (time per row)' % num_rows)
+  rows = [{'name': 'row %d' % i, 'value': i} for i in xrange(num_rows)]
+  row_templates = [
+      ('empty row', ''),
+      ('literal row', '<tr></tr>'),
+      ('{@index} row', '<tr><td>{@index}</td></tr>'),
+      ('two field row', '<tr><td>{name}</td><td>{value}</td></tr>'),
+      ]
+  for name, row_template in row_templates:
+    template_str = (
+        '{.repeated section rows}%s{.alternates with}\n{.end}' % row_template)
+    do_repeated_section = jsontemplate._DoRepeatedSection
+    jsontemplate._DoRepeatedSection = _DoRepeatedSectionWithNext
+    try:
+      old = jsontemplate.Template(template_str)
+    finally:
+      jsontemplate._DoRepeatedSection = do_repeated_section
+    new = jsontemplate.Template(template_str)
+    assert old.expand(rows=rows) == new.expand(rows=rows)
+
+    before = _Time(lambda: old.expand(rows=rows), 10) / num_rows
+    after = _Time(lambda: new.expand(rows=rows), 10) / num_rows
+    _Report(name, before, after)
+
+
+def _HtmlWithCgi(x):
+  """The old _Html."""
+  if not isinstance(x, basestring):
+    x = str(x)
+  return cgi.escape(x)
+
+
+def _HtmlAttrValueWithCgi(x):
+  """The old _HtmlAttrValue."""
+  if not isinstance(x, basestring):
+    x = str(x)
+  return cgi.escape(x, quote=True)
+
+
+def BenchmarkHtml():
+  """The html and html-attr-value formatters vs. cgi.escape."""
+  values = [
+      ('short string', 'Bob Smith'),
+      ('short unicode', u'Andr\xe9 Smith'),
+      ('short string to escape', 'Bob & Alice <bob@example.com>'),
+      ('long string', 'lorem ipsum ' * 100),
+      ('long string to escape', '<p>lorem ipsum</p> ' * 100),
+      ('int', 12345),
+      ('float', 3.25),
+      ]
+  formatters = [
+      ('html', _HtmlWithCgi, jsontemplate._Html),
+      ('html-attr-value', _HtmlAttrValueWithCgi, jsontemplate._HtmlAttrValue),
+      ]
+  for formatter_name, old, new in formatters:
+    _Header('Formatting with %s' % formatter_name)
+    for name, value in values:
+      assert old(value) == new(value), value
+      before = _Time(lambda: old(value), 100000)
+      after = _Time(lambda: new(value), 100000)
+      _Report(name, before, after)
+
+
+def _ToStringWithPprint(x):
+  """The old _ToString."""
+  if x is None:
+    return 'null'
+  if isinstance(x, basestring):
+    return x
+  return pprint.pformat(x)
+
+
+def BenchmarkToString():
+  """The default 'str' formatter vs. calling pprint for every non-string."""
+  _Header('Formatting with str')
+  values = [
+      ('string', 'Bob Smith'),
+      ('int', 12345),
+      ('long', 12345L),
+      ('float', 3.25),
+      ('bool', True),
+      ('None', None),
+      ('list', [1, 2, 3]),
+      ]
+  for name, value in values:
+    assert _ToStringWithPprint(value) == jsontemplate._ToString(value), value
+    before = _Time(lambda: _ToStringWithPprint(value), 100000)
+    after = _Time(lambda: jsontemplate._ToString(value), 100000)
+    _Report(name, before, after)
+
+  num_rows = 10000
+  _Header('Expanding %d numeric rows (time per row)' % num_rows)
+  rows = [
+      {'id': i, 'price': i * 0.25, 'in_stock': i % 2 == 0, 'rating': None}
+      for i in xrange(num_rows)]
+  template_str = (
+      '{.repeated section rows}'
+      '<tr><td>{id}</td><td>{price}</td><td>{in_stock}</td><td>{rating}</td>'
+      '</tr>\n'
+      '{.end}')
+  old = jsontemplate.Template(
+      template_str, more_formatters={'str': _ToStringWithPprint})
+  new = jsontemplate.Template(template_str)
+  assert old.expand(rows=rows) == new.expand(rows=rows)
+
+  before = _Time(lambda: old.expand(rows=rows), 10) / num_rows
+  after = _Time(lambda: new.expand(rows=rows), 10) / num_rows
+  _Report('four numeric fields', before, after)
+
+
+BENCHMARKS = {
+    'html': BenchmarkHtml,
+    'repeated': BenchmarkRepeated,
+    'str': BenchmarkToString,
+    'tokenize': BenchmarkTokenize,
+    }
+
+
+def main(argv):
+  names = argv[1:] or sorted(BENCHMARKS)
+  for name in names:
+    try:
+      benchmark = BENCHMARKS[name]
+    except KeyError:
+      print >>sys.stderr, 'Unknown benchmark %r; choose from %s' % (
+          name, sorted(BENCHMARKS))
+      return 1
+    benchmark()
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
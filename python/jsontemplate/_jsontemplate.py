@@ -61,17 +61,31 @@ __all__ = [
     'TemplateSyntaxError', 'UndefinedVariable',
     # API
     'FromString', 'FromFile', 'Template', 'expand', 'Trace', 'FunctionRegistry',
-    'MakeTemplateGroup',
+    'MakeTemplateGroup', 'CompiledTemplateCache', 'BufferedSink', 'Lazy',
+    'LruCache',
     # Function API
     'SIMPLE_FUNC', 'ENHANCED_FUNC']
 
 import StringIO
+import copy  # for _PartialEvaluator, _PrefetchFutures and _HtmlContext
+import marshal  # for CompiledTemplateCache
+import os
 import pprint
 import re
 import sys
+import UserDict  # for _TemplateGroup
+
+try:
+  from hashlib import sha1
+except ImportError:  # Python 2.4
+  from sha import new as sha1
+
+try:
+  import threading  # for LruCache
+except ImportError:  # Python built without threads
+  import dummy_threading as threading
 
 # For formatters
-import cgi  # cgi.escape
 import time  # for strftime
 import urllib  # for urllib.encode
 import urlparse  # for urljoin
@@ -149,6 +163,11 @@ SIMPLE_FUNC, ENHANCED_FUNC = 0, 1
 # Templates are a third kind of function, but only for formatters currently
 TEMPLATE_FORMATTER = 2  
 
+# Kinds of variable lookups.  Names are resolved into (kind, key) pairs when the
+# template is compiled, so that they aren't parsed every time they're expanded.
+# See _ResolveName.
+CURSOR_LOOKUP, INDEX_LOOKUP, NAME_LOOKUP, PATH_LOOKUP, ROOT_LOOKUP = range(5)
+
 
 class FunctionRegistry(object):
   """Abstract class for looking up formatters or predicates at compile time.
@@ -243,6 +262,15 @@ class PrefixRegistry(FunctionRegistry):
     return None, ()
 
 
+def _NoFunctions(unused_user_str):
+  """The default for more_formatters and more_predicates.
+
+  It's a named function rather than a lambda so that Template instances can be
+  pickled.
+  """
+  return None
+
+
 class _TemplateRef(object):
   """A reference from one template to another.
   
@@ -319,12 +347,15 @@ class _ProgramBuilder(object):
   instances.
   """
 
-  def __init__(self, formatters, predicates, template_registry):
+  def __init__(self, formatters, predicates, template_registry,
+               memoize_formatters=False):
     """
     Args:
       formatters: See docstring for _CompileTemplate
       predicates: See docstring for _CompileTemplate
+      memoize_formatters: See Template()
     """
+    self.memoize_formatters = memoize_formatters
     self.current_section = _Section(None)
     self.stack = [self.current_section]
 
@@ -382,10 +413,17 @@ class _ProgramBuilder(object):
     """
     formatter, args, func_type = self.formatters.LookupWithType(format_str)
     if formatter:
-      return formatter, args, func_type
+      return self._Memoize(formatter, args, func_type)
     else:
       raise BadFormatter('%r is not a valid formatter' % format_str)
 
+  def _Memoize(self, formatter, args, func_type):
+    """Wraps a pure formatter for memoize_formatters=True."""
+    if (self.memoize_formatters and func_type == SIMPLE_FUNC and
+        _IsPure(formatter)):
+      return _MemoizedFormatter(formatter), None, ENHANCED_FUNC
+    return formatter, args, func_type
+
   def _GetPredicate(self, pred_str, test_attr=False):
     """
     The user's predicates are consulted first, then the default predicates.
@@ -405,16 +443,33 @@ class _ProgramBuilder(object):
         raise BadPredicate('%r is not a valid predicate' % pred_str)
     return pred
 
-  def AppendSubstitution(self, name, formatters):
+  def AppendSubstitution(self, name, formatters, escaper=None):
+    """
+    Args:
+      escaper: For autoescape, the name of a function in _AUTOESCAPERS to apply
+          after the formatters.
+    """
+    if escaper is not None:
+      # The escapers convert values like 'str' does, so it's not needed
+      if (len(formatters) == 1 and
+          self.formatters.LookupWithType(formatters[0])[0] is _ToString):
+        formatters = []
     formatters = [self._GetFormatter(f) for f in formatters]
-    self.current_section.Append((_DoSubstitute, (name, formatters)))
+    if escaper is not None:
+      formatters.append(
+          self._Memoize(_AUTOESCAPERS[escaper], None, SIMPLE_FUNC))
+    self.current_section.Append(
+        (_DoSubstitute, (name, _ResolveName(name), formatters,
+                         _FuseFormatters(name, formatters))))
 
   def AppendTemplateSubstitution(self, name):
     # {.template BODY} is semantically something like {$|template BODY}, where $
     # is the root
     formatters = [self._GetFormatter('template ' + name)]
     # None as the name indicates we use the context.Root()
-    self.current_section.Append((_DoSubstitute, (None, formatters)))
+    self.current_section.Append(
+        (_DoSubstitute, (None, (ROOT_LOOKUP, None), formatters,
+                         _FuseFormatters(None, formatters))))
 
   def _NewSection(self, func, new_block):
     self.current_section.Append((func, new_block))
@@ -502,7 +557,9 @@ class _Section(_AbstractSection):
     """
     _AbstractSection.__init__(self)
     self.section_name = section_name
+    self.lookup = _ResolveSectionName(section_name)
     self.pre_formatters = pre_formatters
+    self.pre_format = _ComposePreFormatters(pre_formatters)
 
     # Clauses is just a string and a list of statements.
     self.statements = {'default': self.current_clause}
@@ -513,6 +570,10 @@ class _Section(_AbstractSection):
   def Statements(self, clause='default'):
     return self.statements.get(clause, [])
 
+  def StatementLists(self):
+    """Returns all the lists of statements in this block, for tree walkers."""
+    return self.statements.values()
+
   def NewOrClause(self, pred):
     if pred:
       raise TemplateSyntaxError(
@@ -524,10 +585,80 @@ class _Section(_AbstractSection):
 class _RepeatedSection(_Section):
   """Repeated section is like section, but it supports {.alternates with}"""
 
+  def __init__(self, section_name, pre_formatters=[]):
+    _Section.__init__(self, section_name, pre_formatters)
+    self.loop_statements = {}  # cache for LoopStatements
+
   def AlternatesWith(self):
     self.current_clause = []
     self.statements['alternates with'] = self.current_clause
 
+  def LoopStatements(self, clause='default'):
+    """The statements to execute for each item, with loop invariants hoisted.
+
+    Substitutions like {site-name|html} usually resolve to a frame below the
+    loop, so they're replaced with _DoInvariantSubstitute, which formats them
+    once per loop.  Only substitutions with pure formatters are hoisted (see
+    _IsContextFree), since they're functions of the value alone.
+
+    This is computed on first use, after all the passes over the program, and
+    is only used to execute it; Statements() is unchanged.
+    """
+    try:
+      return self.loop_statements[clause]
+    except KeyError:
+      pass
+    result = []
+    for statement in self.Statements(clause):
+      if not isinstance(statement, basestring):
+        func, args = statement
+        if func is _DoSubstitute and _IsLoopInvariant(args):
+          statement = (_DoInvariantSubstitute, _InvariantArgs(args))
+      result.append(statement)
+    self.loop_statements[clause] = result
+    return result
+
+
+class _InvariantArgs(object):
+  """The args of _DoInvariantSubstitute.
+
+  The object is the key of the formatted value in the cache of the loop's
+  frame.  It hashes by identity, and unlike an id(), the key can't be reused
+  by another object while the cache refers to it.
+  """
+
+  def __init__(self, args):
+    self.args = args
+
+
+def _IsLoopInvariant(args):
+  """Can a substitution in a repeated section be hoisted out of the loop?"""
+  _, (kind, key), formatters, _ = args
+  if kind == PATH_LOOKUP:
+    if key[0] == '@index':
+      return False
+  elif kind != NAME_LOOKUP:  # the cursor, @index, etc. change every item
+    return False
+  for f, _, func_type in formatters:
+    if not _IsContextFree(f, func_type):
+      return False
+  return True
+
+
+def _IsContextFree(f, func_type):
+  """Does the formatter's result only depend on the value it's passed?
+
+  Only pure formatters are (see _IsPure); others may e.g. count their calls, so
+  they can't be called fewer times, or at compile time.
+  """
+  if func_type == SIMPLE_FUNC:
+    return _IsPure(f)
+  return isinstance(f, _MemoizedFormatter)  # which only wraps pure ones
+
+
+def _AlwaysTrue(unused_value):
+  return True
+
 
 class _PredicateSection(_AbstractSection):
   """Represents a sequence of predicate clauses."""
@@ -539,18 +670,72 @@ class _PredicateSection(_AbstractSection):
 
   def NewOrClause(self, pred):
     # {.or} always executes if reached
-    pred = pred or (lambda x: True, None, SIMPLE_FUNC)  # 3-tuple
+    pred = pred or (_AlwaysTrue, None, SIMPLE_FUNC)  # 3-tuple
     self.current_clause = []
     self.clauses.append((pred, self.current_clause))
 
+  def StatementLists(self):
+    return [statements for _, statements in self.clauses]
+
+
+def _ResolveName(name):
+  """Resolve a variable name into a lookup, at compile time.
+
+  Returns:
+    A pair (kind, key), where kind is one of the *_LOOKUP constants.  The key
+    is the name for NAME_LOOKUP, a tuple of the parts of a dotted name for
+    PATH_LOOKUP, and None otherwise.
+  """
+  if name == '@':
+    return CURSOR_LOOKUP, None
+  if name == '@index':
+    return INDEX_LOOKUP, None
+  if '.' in name:
+    return PATH_LOOKUP, tuple(name.split('.'))
+  return NAME_LOOKUP, name
+
+
+def _ResolveSectionName(name):
+  """Like _ResolveName, but for section names.
+
+  Sections only look up names in the current context; they don't search the
+  stack or split dotted names.
+  """
+  if name == '@':
+    return CURSOR_LOOKUP, None
+  return NAME_LOOKUP, name
+
+
+class Lazy(object):
+  """A value in the data dictionary which is computed only if it's used.
+
+    data_dict = {'comments': Lazy(lambda: LoadComments(post_id))}
+
+  The function is called with no arguments when the expansion reaches the
+  value, e.g. in a substitution, or a section or predicate which is evaluated.
+  It's called at most once per expansion.
+  """
+
+  def __init__(self, func):
+    self.func = func
+
 
 class _Frame(object):
-  """A stack frame."""
+  """A stack frame.
+
+  The cache maps names to the values they resolve to when looked up from this
+  frame down the stack.  It stays valid as long as the frame's context is the
+  same, since the frames below it don't change until it's popped.  Inside a
+  repeated section, names from outer scopes are then found in the cache of the
+  frame below the item, instead of walking the rest of the stack on every
+  iteration.
+  """
 
   def __init__(self, context, index=-1):
     # Public attributes
     self.context = context
     self.index = index   # An iteration index.  -1 means we're NOT iterating.
+    self.cache = {}  # filled by _ScopedContext.LookupName
 
   def __str__(self):
     return 'Frame %s (%s)' % (self.context, self.index)
@@ -575,6 +760,8 @@ class _ScopedContext(object):
     self.undefined_str = undefined_str
     self.group = group  # used by _DoSubstitute?
     self.root = context
+    self.lazy_values = {}  # Lazy instance -> value
+    self.formatter_cache = {}  # for _MemoizedFormatter
 
   def Root(self):
     """For {.template FOO} substitution."""
@@ -591,34 +778,47 @@ class _ScopedContext(object):
     Returns:
       The new section, or None if there is no such section.
     """
-    if name == '@':
-      value = self.stack[-1].context
-    else:
-      top = self.stack[-1].context
-      try:
-        value = top.get(name)
-      except AttributeError:  # no .get()
-        raise EvaluationError(
-            "Can't get name %r from top value %s" % (name, top))
+    return self.PushResolvedSection(
+        _ResolveSectionName(name), _ComposePreFormatters(pre_formatters))
 
-    # Apply pre-formatters
-    for i, (f, args, formatter_type) in enumerate(pre_formatters):
-      if formatter_type == ENHANCED_FUNC:
-        value = f(value, self, args)
-      elif formatter_type == SIMPLE_FUNC:
-        value = f(value)
-      else:
-        assert False, 'Invalid formatter type %r' % formatter_type
+  def PushResolvedSection(self, lookup, pre_format):
+    """Like PushSection, but resolved at compile time.
+
+    Args:
+      lookup: The result of _ResolveSectionName
+      pre_format: The result of _ComposePreFormatters
+    """
+    value = self._SectionValue(lookup)
+    if pre_format is not None:
+      value = pre_format(value, self)
 
     self.stack.append(_Frame(value))
     return value
 
+  def _SectionValue(self, lookup):
+    """Returns the value a section is over, before any pre-formatters."""
+    kind, name = lookup
+    if kind == CURSOR_LOOKUP:
+      return self.stack[-1].context
+    top = self.stack[-1].context
+    try:
+      value = top.get(name)
+    except AttributeError:  # no .get()
+      raise EvaluationError(
+          "Can't get name %r from top value %s" % (name, top))
+    if value.__class__ is Lazy:
+      value = self._Force(value)
+    return value
+
   def Pop(self):
     self.stack.pop()
 
   def Next(self):
     """Advance to the next item in a repeated section.
 
+    _DoRepeatedSection iterates over the items directly; this is for code that
+    walks a context by hand.
+
     Raises:
       StopIteration if there are no more elements
     """
@@ -635,11 +835,24 @@ class _ScopedContext(object):
       self.stack.pop()
       raise StopIteration
 
-    stacktop.context = context_array[stacktop.index]
+    item = context_array[stacktop.index]
+    if item.__class__ is Lazy:
+      item = self._Force(item)
+    stacktop.context = item
     stacktop.index += 1
+    if stacktop.cache:
+      stacktop.cache = {}
 
     return True  # OK, we mutated the stack
 
+  def _Force(self, lazy):
+    """Returns the value of a Lazy, computing it the first time."""
+    try:
+      return self.lazy_values[lazy]
+    except KeyError:
+      value = self.lazy_values[lazy] = lazy.func()
+      return value
+
   def _Undefined(self, name):
     if self.undefined_str is None:
       raise UndefinedVariable('%r is not defined' % name)
@@ -648,23 +861,9 @@ class _ScopedContext(object):
 
   def _LookUpStack(self, name):
     """Look up the stack for the given name."""
-    i = len(self.stack) - 1
-    while 1:
-      frame = self.stack[i]
-      if name == '@index':
-        if frame.index != -1:  # -1 is undefined
-          return frame.index  # @index is 1-based
-      else:
-        context = frame.context
-        if hasattr(context, 'get'):  # Can't look up names in a list or atom
-          try:
-            return context[name]
-          except KeyError:
-            pass
-
-      i -= 1  # Next frame
-      if i <= -1:  # Couldn't find it anywhere
-        return self._Undefined(name)
+    if name == '@index':
+      return self.LookupIndex()
+    return self.LookupName(name)
 
   def Lookup(self, name):
     """Get the value associated with a name in the current context.
@@ -681,10 +880,73 @@ class _ScopedContext(object):
     Raises:
       UndefinedVariable if self.undefined_str is not set
     """
-    if name == '@':
+    return self.LookupResolved(_ResolveName(name))
+
+  def LookupResolved(self, lookup):
+    """Like Lookup, but with a name resolved by _ResolveName."""
+    kind, key = lookup
+    if kind == NAME_LOOKUP:
+      return self.LookupName(key)
+    elif kind == CURSOR_LOOKUP:
       return self.stack[-1].context
+    elif kind == PATH_LOOKUP:
+      return self.LookupPath(key)
+    elif kind == INDEX_LOOKUP:
+      return self.LookupIndex()
+    elif kind == ROOT_LOOKUP:
+      return self.root
+    else:
+      raise AssertionError('Invalid lookup kind %r' % kind)
+
+  def LookupName(self, name):
+    """Look up a name without dots, like 'foo'.
 
-    parts = name.split('.')
+    A name found below the top frame is cached in the frames that were walked
+    past; see _Frame.
+    """
+    stack = self.stack
+    top = len(stack) - 1
+    i = top
+    while i >= 0:
+      frame = stack[i]
+      if i != top:
+        cache = frame.cache
+        if name in cache:
+          value = cache[name]
+          break
+      context = frame.context
+      if hasattr(context, 'get'):  # Can't look up names in a list or atom
+        try:
+          value = context[name]
+          break
+        except KeyError:
+          pass
+      i -= 1  # Next frame
+    else:
+      return self._Undefined(name)
+
+    if value.__class__ is Lazy:
+      value = self._Force(value)
+
+    # The top frame isn't cached in, since it changes on every iteration of a
+    # repeated section.
+    while i < top:
+      stack[i].cache[name] = value
+      i += 1
+    return value
+
+  def LookupIndex(self):
+    """Look up @index, the 1-based index of the innermost repeated section."""
+    i = len(self.stack) - 1
+    while i >= 0:
+      index = self.stack[i].index
+      if index != -1:  # -1 is undefined
+        return index
+      i -= 1  # Next frame
+    return self._Undefined('@index')
+
+  def LookupPath(self, parts):
+    """Look up a dotted name, given as a tuple of parts like ('foo', 'bar')."""
     value = self._LookUpStack(parts[0])
 
     # Now do simple lookups of the rest of the parts
@@ -693,8 +955,136 @@ class _ScopedContext(object):
         value = value[part]
       except (KeyError, TypeError):  # TypeError for non-dictionaries
         return self._Undefined(part)
+      if value.__class__ is Lazy:
+        value = self._Force(value)
+
+    return value
+
+
+def _IsFuture(value):
+  """Is the value a future, like a concurrent.futures.Future?"""
+  return hasattr(value, 'result') and hasattr(value, 'done')
+
+
+class _FutureContext(_ScopedContext):
+  """A _ScopedContext which waits for futures in the data dictionary.
+
+  A future is waited for when the expansion reaches it: when a name is looked
+  up, or when a section is entered.  The items of a list are waited for when a
+  section over the list is entered.  Until then, the futures for the rest of
+  the data can still be running, e.g. in a thread pool.
+  """
+
+  def __init__(self, context, undefined_str, group=None, flush=None):
+    """
+    Args:
+      flush: If set, this is called before waiting for a future which isn't
+          done yet, so the output so far can be written out.
+    """
+    self.flush = flush
+    _ScopedContext.__init__(self, self._Wait(context), undefined_str,
+                            group=group)
+
+  def _Wait(self, value):
+    if not _IsFuture(value):
+      return value
+    if self.flush and not value.done():
+      self.flush()
+    return value.result()
+
+  def _SectionValue(self, lookup):
+    value = self._Wait(_ScopedContext._SectionValue(self, lookup))
+    if isinstance(value, list):
+      for item in value:
+        if _IsFuture(item):
+          return [self._Wait(item) for item in value]
+    return value
+
+  def LookupName(self, name):
+    return self._Wait(_ScopedContext.LookupName(self, name))
+
+  def LookupPath(self, parts):
+    value = self._LookUpStack(parts[0])
+
+    for part in parts[1:]:
+      try:
+        value = value[part]
+      except (KeyError, TypeError):  # TypeError for non-dictionaries
+        return self._Undefined(part)
+      if value.__class__ is Lazy:
+        value = self._Force(value)
+      value = self._Wait(value)
+
+    return value
+
+
+def _PrefetchFutures(value, names):
+  """Wait for the futures in value which can be reached through the names.
+
+  The futures are all waited for at once, and then the futures in their results,
+  and so on.  Since futures are already running, waiting for them one after
+  another takes as long as the slowest one.
+
+  Args:
+    value: A JSON value
+    names: A set of dictionary keys to follow
+
+  Returns:
+    A copy of value without the futures.  The dictionaries and lists which had
+    futures in them are copied; value isn't modified.
+  """
+  pending = []  # (container, key, future)
+  value = _CopyWithoutFutures(value, names, pending)
+  while pending:
+    waiting = pending
+    pending = []
+    for container, key, future in waiting:
+      container[key] = _CopyWithoutFutures(future.result(), names, pending)
+  return value
+
+
+def _CopyWithoutFutures(value, names, pending):
+  """Helper for _PrefetchFutures.
+
+  Futures in value are replaced in the copy when their (container, key, future)
+  triples in the pending list are waited for.
+  """
+  if isinstance(value, dict):
+    keys = [key for key in names if key in value]
+  elif isinstance(value, list):
+    keys = xrange(len(value))
+  else:
+    return value
 
+  copied = None
+  for key in keys:
+    item = value[key]
+    is_future = _IsFuture(item)
+    if is_future:
+      new_item = None  # filled in by _PrefetchFutures
+    else:
+      new_item = _CopyWithoutFutures(item, names, pending)
+      if new_item is item:
+        continue
+    if copied is None:
+      copied = copy.copy(value)
+    copied[key] = new_item
+    if is_future:
+      pending.append((copied, key, item))
+  if copied is None:
     return value
+  return copied
+
+
+# Conversions for the primitive types, keyed by exact type, so subclasses with
+# their own __repr__ still go through pprint.  repr() is what pprint.pformat()
+# returns for these types, without its overhead.
+_TO_STRING_FUNCS = {
+    int: repr,
+    long: repr,
+    float: repr,
+    bool: repr,
+    }
 
 
 def _ToString(x):
@@ -705,24 +1095,55 @@ def _ToString(x):
     return 'null'
   if isinstance(x, basestring):
     return x
-  return pprint.pformat(x)
+  to_string = _TO_STRING_FUNCS.get(type(x))
+  if to_string is not None:
+    return to_string(x)
+  return pprint.pformat(x)  # Containers, and everything else
+
+
+# Numbers are formatted without any characters that need escaping
+_NUMBER_TYPES = (int, long, float)
+
+# For strings shorter than this, it's faster to check whether there's anything
+# to escape first, since most strings have nothing to escape.  For longer
+# strings, the 'in' checks take longer than str.replace() calls which find
+# nothing.  (Measured with benchmarks.py html.)
+_ESCAPE_CHECK_MAX_LEN = 256
 
 
 # NOTE: We could consider making formatters act on strings only avoid this
 # repetitiveness.  But I wanted to leave open the possibility of doing stuff
 # like {number|increment-by 1}, where formatters take and return integers.
 def _Html(x):
+  """Like cgi.escape(x), but faster."""
   # If it's not string or unicode, make it a string
   if not isinstance(x, basestring):
+    if type(x) in _NUMBER_TYPES:
+      return str(x)
     x = str(x)
-  return cgi.escape(x)
+  if (len(x) < _ESCAPE_CHECK_MAX_LEN and
+      '&' not in x and '<' not in x and '>' not in x):
+    return x
+  return x.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
 
 
 def _HtmlAttrValue(x):
+  """Like cgi.escape(x, quote=True), but faster.
+
+  Unlike cgi.escape, it also escapes single quotes, so the value is safe in
+  attributes quoted with either character.
+  """
   # If it's not string or unicode, make it a string
   if not isinstance(x, basestring):
+    if type(x) in _NUMBER_TYPES:
+      return str(x)
     x = str(x)
-  return cgi.escape(x, quote=True)
+  if (len(x) < _ESCAPE_CHECK_MAX_LEN and
+      '&' not in x and '<' not in x and '>' not in x and '"' not in x and
+      "'" not in x):
+    return x
+  return (x.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+          .replace('"', '&quot;').replace("'", '&#39;'))
 
 
 def _AbsUrl(relative_url, context, unused_args):
@@ -753,6 +1174,235 @@ def _Pairs(data):
   return [{'@key': k, '@value': data[k]} for k in keys]
 
 
+# The rest of the default formatters are named functions, rather than lambdas,
+# so that they can be pickled.
+
+def _Raw(x):
+  return x
+
+
+def _Size(value):
+  return str(len(value))
+
+
+def _UrlParams(x):
+  return urllib.urlencode(x, doseq=True)
+
+
+def _Upper(x):
+  return x.upper()
+
+
+def _Lower(x):
+  return x.lower()
+
+
+def _PlainUrl(x):
+  return '<a href="%s">%s</a>' % (_HtmlAttrValue(x), _Html(x))
+
+
+# The escapers for Template(autoescape='html'), which _CompileTemplate chooses
+# from the HTML context of each substitution.  Each one takes any value, and
+# converts it like the 'str' formatter before escaping it, so that {name} only
+# needs one formatter.
+
+def _EscapeText(x):
+  """For text between tags."""
+  if not isinstance(x, basestring):
+    x = _ToString(x)
+  return _Html(x)
+
+
+def _EscapeAttrValue(x):
+  """For quoted attribute values."""
+  if not isinstance(x, basestring):
+    x = _ToString(x)
+  return _HtmlAttrValue(x)
+
+
+# Schemes which can't run code when the URL is followed
+_SAFE_URL_SCHEMES = ('http', 'https', 'mailto', 'ftp')
+
+# Browsers remove these characters anywhere in a URL, and C0 controls and spaces
+# at its start, before they parse the scheme.
+_URL_IGNORED_RE = re.compile('[\t\n\r]')
+_URL_LEADING_IGNORED = ''.join([chr(i) for i in range(0x21)])
+
+# Anything before the first : is taken as the scheme, unless a /, ? or # comes
+# first.  This is looser than the URL grammar, so unusual schemes fail closed.
+_URL_SCHEME_RE = re.compile(r'([^:/?#]*):')
+
+
+def _EscapeUrl(x):
+  """For a whole URL, at the start of a URL attribute like href.
+
+  URLs with other schemes than _SAFE_URL_SCHEMES, e.g. javascript:, are
+  replaced with '#'.
+  """
+  if not isinstance(x, basestring):
+    x = _ToString(x)
+  url = _URL_IGNORED_RE.sub('', x).lstrip(_URL_LEADING_IGNORED)
+  match = _URL_SCHEME_RE.match(url)
+  if match and match.group(1).lower() not in _SAFE_URL_SCHEMES:
+    return '#'
+  return _HtmlAttrValue(x)
+
+
+# The output of urllib.quote and quote_plus has no characters that need HTML
+# escaping, so one pass is enough in attribute values.
+
+def _EscapeUrlPath(x):
+  """For the path of a URL, e.g. href="/users/{name}"."""
+  if not isinstance(x, basestring):
+    x = _ToString(x)
+  if isinstance(x, unicode):
+    x = x.encode('utf-8')
+  return urllib.quote(x)
+
+
+def _EscapeUrlParamValue(x):
+  """For the query or fragment of a URL, e.g. href="/search?q={query}"."""
+  if not isinstance(x, basestring):
+    x = _ToString(x)
+  if isinstance(x, unicode):
+    x = x.encode('utf-8')
+  return urllib.quote_plus(x)
+
+
+# Characters which can end a JavaScript string, regular expression or comment,
+# the <script> element, or an attribute value, or start a ${} substitution in a
+# template literal, or which aren't allowed in string literals
+_JS_STRING_UNSAFE_RE = re.compile(u'[\\x00-\\x1f\\\\"\'`/${<>&\u2028\u2029]')
+
+
+def _JsEscapeChar(match):
+  return '\\u%04x' % ord(match.group(0))
+
+
+def _EscapeJsString(x):
+  """For the inside of a quoted string in a script or event handler."""
+  if not isinstance(x, basestring):
+    x = _ToString(x)
+  x = _JS_STRING_UNSAFE_RE.sub(_JsEscapeChar, x)
+  if isinstance(x, str) and '\xe2\x80' in x:
+    # U+2028 and U+2029 in UTF-8
+    x = x.replace('\xe2\x80\xa8', '\\u2028').replace('\xe2\x80\xa9', '\\u2029')
+  return x
+
+
+_JS_FLOATS = {'inf': 'Infinity', '-inf': '-Infinity', 'nan': 'NaN'}
+
+
+def _EscapeJsValue(x):
+  """For a value in a <script> element, outside of a string.
+
+  The value is written as a JavaScript literal, e.g. a string is quoted.
+  Lists and dictionaries become arrays and objects.
+  """
+  if isinstance(x, basestring):
+    return '"%s"' % _EscapeJsString(x)
+  if x is None:
+    return 'null'
+  if x is True:
+    return 'true'
+  if x is False:
+    return 'false'
+  if isinstance(x, (int, long)):
+    return str(x)  # no L suffix
+  if isinstance(x, float):
+    s = repr(x)
+    return _JS_FLOATS.get(s, s)
+  if isinstance(x, (list, tuple)):
+    return '[%s]' % ','.join([_EscapeJsValue(item) for item in x])
+  if isinstance(x, dict):
+    return '{%s}' % ','.join([
+        '"%s":%s' % (_EscapeJsString(key), _EscapeJsValue(value))
+        for key, value in x.iteritems()])
+  raise TypeError("Can't write %r as a JavaScript value" % (x,))
+
+
+def _EscapeJsAttrValue(x):
+  """For a value in an event handler attribute like onclick, outside of a
+  string.
+
+  Like _EscapeJsValue, but the quotes around strings are escaped for the
+  attribute.
+  """
+  return _HtmlAttrValue(_EscapeJsValue(x))
+
+
+# Escaper names, which _CompileTemplate passes to the builder -> functions
+_AUTOESCAPERS = {
+    'text': _EscapeText,
+    'attr-value': _EscapeAttrValue,
+    'url': _EscapeUrl,
+    'url-path': _EscapeUrlPath,
+    'url-param-value': _EscapeUrlParamValue,
+    'js-string': _EscapeJsString,
+    'js-value': _EscapeJsValue,
+    'js-attr-value': _EscapeJsAttrValue,
+    }
+
+
+# Formatters which always return the same result for the same value, and have
+# no side effects.  Their results can be memoized; see _MemoizedFormatter.
+_PURE_FORMATTERS = set([
+    _Html, _HtmlAttrValue, urllib.quote_plus, _Upper, _Lower, _ToString,
+    _PlainUrl, _Size, _UrlParams, repr])
+_PURE_FORMATTERS.update(_AUTOESCAPERS.values())
+
+
+def _IsPure(f):
+  """Is f a pure formatter?  User formatters can set f.pure = True."""
+  try:
+    if f in _PURE_FORMATTERS:
+      return True
+  except TypeError:  # unhashable
+    pass
+  return bool(getattr(f, 'pure', False))
+
+
+# The types of values whose formatted results are memoized.  (Others may not be
+# hashable.)
+_MEMOIZED_TYPES = set([str, unicode, int, long, float])
+
+# The maximum number of results memoized in one expansion
+_FORMATTER_CACHE_SIZE = 1000
+
+
+class _MemoizedFormatter(object):
+  """Wraps a pure formatter to memoize its results during an expansion.
+
+  This is an ENHANCED_FUNC, so that it gets the context, where the results are
+  kept (_ScopedContext.formatter_cache).  Used with Template(...,
+  memoize_formatters=True).
+  """
+
+  def __init__(self, f):
+    self.f = f
+
+  def __call__(self, value, context, unused_args):
+    cls = value.__class__
+    # The context is None when _PartialEvaluator calls it
+    if context is None or cls not in _MEMOIZED_TYPES:
+      return self.f(value)
+    # The class is part of the key, since e.g. 1 == 1.0 == True
+    key = (self.f, cls, value)
+    cache = context.formatter_cache
+    try:
+      return cache[key]
+    except KeyError:
+      pass
+    result = self.f(value)
+    if len(cache) < _FORMATTER_CACHE_SIZE:
+      cache[key] = result
+    return result
+
+  def __repr__(self):
+    # Errors name the formatter which raised
+    return repr(self.f)
+
+
 # See http://google-ctemplate.googlecode.com/svn/trunk/doc/howto.html for more
 # escape types.
 #
@@ -772,13 +1422,13 @@ _DEFAULT_FORMATTERS = {
     'html-attr-value': _HtmlAttrValue,
     'htmltag': _HtmlAttrValue,
 
-    'raw': lambda x: x,
+    'raw': _Raw,
     # Used for the length of a list.  Can be used for the size of a dictionary
     # too, though I haven't run into that use case.
-    'size': lambda value: str(len(value)),
+    'size': _Size,
 
     # The argument is a dictionary, and we get a a=1&b=2 string back.
-    'url-params': lambda x: urllib.urlencode(x, doseq=True),
+    'url-params': _UrlParams,
 
     # The argument is an atom, and it takes 'Search query?' -> 'Search+query%3F'
     'url-param-value': urllib.quote_plus,  # param is an atom
@@ -791,12 +1441,11 @@ _DEFAULT_FORMATTERS = {
     # string (unicode can cause issues when using 'str')
     'repr': repr,
 
-    'upper': lambda x: x.upper(),
-    'lower': lambda x: x.lower(),
+    'upper': _Upper,
+    'lower': _Lower,
 
     # Just show a plain URL on an HTML page (without anchor text).
-    'plain-url': lambda x: '<a href="%s">%s</a>' % (
-        cgi.escape(x, quote=True), cgi.escape(x)),
+    'plain-url': _PlainUrl,
 
     # A context formatter
     'AbsUrl': _AbsUrl,
@@ -901,17 +1550,22 @@ def _TemplateExists(unused_value, context, args):
   return context.HasTemplate(name)
 
 
-_SINGULAR = lambda x: x == 1
-_PLURAL = lambda x: x > 1
+def _Singular(x):
+  return x == 1
+
+
+def _Plural(x):
+  return x > 1
+
 
 _DEFAULT_PREDICATES = {
     # OLD, for backward compatibility: these are discouraged
-    'singular?': _SINGULAR,
-    'plural?': _PLURAL,
+    'singular?': _Singular,
+    'plural?': _Plural,
     'Debug?': _IsDebugMode,  # Also OLD
 
-    'singular': _SINGULAR,
-    'plural': _PLURAL,
+    'singular': _Singular,
+    'plural': _Plural,
     }
 
 
@@ -929,7 +1583,186 @@ def SplitMeta(meta):
   return meta[:n/2], meta[n/2:]
 
 
-_token_re_cache = {}
+class _LruStripe(object):
+  """One independently locked part of an LruCache.
+
+  The entries are in a circular doubly linked list, most recently used first.
+  Each node is a list [prev, next, key, value, size].
+  """
+
+  def __init__(self, max_entries, max_bytes):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.nodes = {}  # key -> node
+    self.head = head = [None, None, None, None, 0]
+    head[0] = head[1] = head
+    self.num_bytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _Unlink(self, node):
+    node[0][1] = node[1]
+    node[1][0] = node[0]
+
+  def _LinkFirst(self, node):
+    head = self.head
+    node[0] = head
+    node[1] = head[1]
+    head[1][0] = node
+    head[1] = node
+
+  def _Remove(self, node):
+    self._Unlink(node)
+    del self.nodes[node[2]]
+    self.num_bytes -= node[4]
+
+  def Get(self, key):
+    """Returns the node for key, or None, and marks it as most recently used."""
+    node = self.nodes.get(key)
+    if node is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self._Unlink(node)
+      self._LinkFirst(node)
+    return node
+
+  def Put(self, key, value, size):
+    node = self.nodes.get(key)
+    if node is not None:
+      self._Remove(node)
+    if self.max_bytes is not None and size > self.max_bytes:
+      return  # Too big to cache
+
+    node = [None, None, key, value, size]
+    self.nodes[key] = node
+    self._LinkFirst(node)
+    self.num_bytes += size
+
+    head = self.head
+    while ((self.max_entries is not None and
+            len(self.nodes) > self.max_entries) or
+           (self.max_bytes is not None and self.num_bytes > self.max_bytes)):
+      self._Remove(head[0])  # the least recently used
+      self.evictions += 1
+
+  def Clear(self):
+    self.nodes.clear()
+    self.head[0] = self.head[1] = self.head
+    self.num_bytes = 0
+
+
+class LruCache(object):
+  """A bounded, thread-safe cache which evicts the least recently used entries.
+
+  It's used for the compiled token regexes, and for the templates compiled by
+  formatters.TemplateFileInclude.  It supports the parts of the dictionary
+  interface they use: get(), [], 'in', len() and clear().
+
+  The keys are split into stripes by hash, each with its own lock and its own
+  share of the limits, so that threads using different keys don't wait for
+  each other.  With more than one stripe, the entry evicted is the least
+  recently used one in its stripe.
+  """
+
+  def __init__(self, max_entries=None, max_bytes=None, sizeof=None,
+               num_stripes=1):
+    """
+    Args:
+      max_entries: The maximum number of entries, or None for no limit.
+      max_bytes: The maximum total size of the values, or None for no limit.
+      sizeof: A function which returns the size of a value in bytes.  It's
+          required if max_bytes is set.  A value bigger than the limit isn't
+          cached.
+      num_stripes: The number of independently locked parts.
+    """
+    if max_bytes is not None and sizeof is None:
+      raise ConfigurationError('LruCache with max_bytes needs sizeof')
+    self.sizeof = sizeof
+    self.stripes = []
+    for _ in xrange(num_stripes):
+      self.stripes.append(_LruStripe(
+          _Share(max_entries, num_stripes), _Share(max_bytes, num_stripes)))
+
+  def _Stripe(self, key):
+    stripes = self.stripes
+    if len(stripes) == 1:
+      return stripes[0]
+    return stripes[hash(key) % len(stripes)]
+
+  def get(self, key, default=None):
+    stripe = self._Stripe(key)
+    stripe.lock.acquire()
+    try:
+      node = stripe.Get(key)
+      if node is None:
+        return default
+      return node[3]
+    finally:
+      stripe.lock.release()
+
+  def __getitem__(self, key):
+    value = self.get(key, _MISSING)
+    if value is _MISSING:
+      raise KeyError(key)
+    return value
+
+  def __setitem__(self, key, value):
+    if self.sizeof is None:
+      size = 0
+    else:
+      size = self.sizeof(value)
+    stripe = self._Stripe(key)
+    stripe.lock.acquire()
+    try:
+      stripe.Put(key, value, size)
+    finally:
+      stripe.lock.release()
+
+  def __contains__(self, key):
+    # Doesn't count as a hit or a miss, or make the entry recently used
+    return key in self._Stripe(key).nodes
+
+  def __len__(self):
+    return sum([len(stripe.nodes) for stripe in self.stripes])
+
+  def clear(self):
+    for stripe in self.stripes:
+      stripe.lock.acquire()
+      try:
+        stripe.Clear()
+      finally:
+        stripe.lock.release()
+
+  def stats(self):
+    """Returns a dictionary of counters, for monitoring.
+
+    'hits', 'misses', and 'evictions' are counted since the cache was created.
+    'entries' and 'bytes' are the current size.
+    """
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'entries': 0, 'bytes': 0}
+    for stripe in self.stripes:
+      stats['hits'] += stripe.hits
+      stats['misses'] += stripe.misses
+      stats['evictions'] += stripe.evictions
+      stats['entries'] += len(stripe.nodes)
+      stats['bytes'] += stripe.num_bytes
+    return stats
+
+
+def _Share(limit, num_stripes):
+  """The part of a limit for each stripe of an LruCache."""
+  if limit is None:
+    return None
+  return max(1, -(-limit // num_stripes))  # round up
+
+
+_MISSING = object()  # for LruCache.__getitem__
+
+_token_re_cache = LruCache(max_entries=256)
 
 def MakeTokenRegex(meta_left, meta_right):
   """Return a (compiled) regular expression for tokenization.
@@ -937,22 +1770,24 @@ def MakeTokenRegex(meta_left, meta_right):
   Args:
     meta_left, meta_right: e.g. '{' and '}'
 
-  - The regular expressions are memoized.
+  - The regular expressions are memoized, in a bounded LruCache.
   - This function is public so the syntax highlighter can use it.
   """
   key = meta_left, meta_right
-  if key not in _token_re_cache:
+  token_re = _token_re_cache.get(key)
+  if token_re is None:
     # - Need () grouping for re.split
     # - The first character must be a non-space.  This allows us to ignore
     # literals like function() { return 1; } when
     # - There must be at least one (non-space) character inside {}
-    _token_re_cache[key] = re.compile(
+    token_re = re.compile(
         r'(' +
         re.escape(meta_left) +
         r'\S.*?' +
         re.escape(meta_right) +
         r')')
-  return _token_re_cache[key]
+    _token_re_cache[key] = token_re
+  return token_re
 
 
 # Examples:
@@ -1025,27 +1860,282 @@ def _MatchDirective(token):
   return None, None  # no match
 
 
-def _Tokenize(template_str, meta_left, meta_right, whitespace):
-  """Yields tokens, which are 2-tuples (TOKEN_TYPE, token_string)."""
+# Characters that unicode.splitlines() and str.splitlines() break lines on.  A
+# directive can't span lines.
+_UNICODE_LINE_BREAKS = u'\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+_STR_LINE_BREAKS = '\n\r'
 
-  trimlen = len(meta_left)
-  token_re = MakeTokenRegex(meta_left, meta_right)
-  do_strip = (whitespace == 'strip-line')  # Do this outside loop
-  do_strip_part = False
+_scanner_re_cache = LruCache(max_entries=256)
 
-  for line in template_str.splitlines(True):  # retain newlines
-    if do_strip or do_strip_part:
-      line = line.strip()
+def _MakeScannerRegex(meta_left, meta_right, breaks):
+  """Return a (compiled) regular expression for _Tokenize.
 
-    tokens = token_re.split(line)
+  It finds the directives in the whole template, along with any space and line
+  break that follows them.  The text between matches is literal text.
 
-    # Check for a special case first.  If a comment or "block" directive is on a
-    # line by itself (with only space surrounding it), then the space is
-    # omitted.  For simplicity, we don't handle the case where we have 2
-    # directives, say '{.end} # {#comment}' on a line.
-    if len(tokens) == 3:
-      # ''.isspace() == False, so work around that
-      if (tokens[0].isspace() or not tokens[0]) and \
+  Args:
+    breaks: _UNICODE_LINE_BREAKS or _STR_LINE_BREAKS
+
+  Groups:
+    1: The inside of a directive
+    2: If the directive is the last thing on its line, the space and line break
+       after it ('' at the end of the template).  Otherwise None.
+
+  Like MakeTokenRegex, the regular expressions are memoized in a bounded
+  LruCache.
+  """
+  key = meta_left, meta_right, breaks
+  scanner_re = _scanner_re_cache.get(key)
+  if scanner_re is None:
+    if breaks is _UNICODE_LINE_BREAKS:
+      flags = re.UNICODE  # so \s agrees with unicode.isspace()
+    else:
+      flags = 0
+
+    # Like MakeTokenRegex: the first character must be a (non-unicode)
+    # non-space, and the directive ends at the first right metacharacter after
+    # that.
+    if len(meta_right) == 1:
+      # The common case is faster without a lookahead
+      inside = r'[^%s%s]*' % (breaks, re.escape(meta_right))
+    else:
+      inside = r'(?:(?!%s)[^%s])*' % (re.escape(meta_right), breaks)
+
+    scanner_re = re.compile(
+        re.escape(meta_left) +
+        r'([^ \t\n\r\f\v%s]%s)' % (breaks, inside) +
+        re.escape(meta_right) +
+        r'([^\S%s]*(?:\r\n|[%s]|\Z))?' % (breaks, breaks),
+        flags)
+    _scanner_re_cache[key] = scanner_re
+  return scanner_re
+
+
+def _StripLines(text, breaks, starts_line, ends_line, line_strip,
+                next_line_strip):
+  """Strip the lines in a piece of literal text, for {.OPTION strip-line}.
+
+  Args:
+    text: Literal text between two directives, which may span lines
+    breaks: The line break characters
+    starts_line: Whether the text starts at the beginning of a line
+    ends_line: Whether the text ends at the end of the template
+    line_strip: Whether the line the text starts on is stripped
+    next_line_strip: Whether lines starting in the text are stripped
+
+  Returns:
+    The stripped text, and whether the line the text ends on is stripped
+  """
+  pieces = []
+  ends_with_break = False
+  for i, line in enumerate(text.splitlines(True)):
+    if i > 0:
+      line_strip = next_line_strip
+    ends_with_break = line[-1] in breaks
+    if line_strip:
+      if i > 0 or starts_line:
+        line = line.lstrip()
+      if ends_with_break or ends_line:
+        line = line.rstrip()  # also removes the line break
+    pieces.append(line)
+  if ends_with_break:
+    line_strip = next_line_strip
+  return ''.join(pieces), line_strip
+
+
+def _Tokenize(template_str, meta_left, meta_right, whitespace):
+  """Yields tokens, which are 2-tuples (TOKEN_TYPE, token_string).
+
+  A single regex scans the whole template for directives, and the text between
+  them is yielded as literals without looking at each line.  Only directives
+  which end a line need to be checked for the "alone on a line" rule.
+
+  The result is equivalent to that of _TokenizeLines, except that the literal
+  text may be split into tokens differently.
+  """
+  # In this (strange) case, stripping a line could strip part of a directive.
+  # The single-pass scanner doesn't handle that.
+  if (meta_left + meta_right).strip() != meta_left + meta_right:
+    for token in _TokenizeLines(template_str, meta_left, meta_right,
+                                whitespace):
+      yield token
+    return
+
+  if isinstance(template_str, unicode):
+    breaks = _UNICODE_LINE_BREAKS
+  else:
+    breaks = _STR_LINE_BREAKS
+  scanner = _MakeScannerRegex(meta_left, meta_right, breaks)
+
+  do_strip = (whitespace == 'strip-line')
+  do_strip_part = False
+  line_strip = do_strip  # Whether the current line is stripped
+
+  if do_strip:
+    # Every line is stripped, so strip them all up front.  The lines are still
+    # separated by '\n' so the "alone on a line" rule works; the literals have
+    # it removed below.
+    template_str = '\n'.join(
+        line.strip() for line in template_str.splitlines())
+
+  meta_literals = {
+      '.meta-left': meta_left,
+      '.meta-right': meta_right,
+      '.space': ' ',
+      '.tab': '\t',
+      '.newline': '\n',
+      }
+
+  pos = 0  # end of the last match
+  for match in scanner.finditer(template_str):
+    start = match.start()
+    token, after = match.groups()
+
+    # Check for a special case first.  If a comment or "block" directive is on a
+    # line by itself (with only space surrounding it), then the whole line is
+    # omitted, except for the directive.  For simplicity, we don't handle the
+    # case where we have 2 directives, say '{.end} # {#comment}' on a line.
+    literal_end = start
+    alone = False
+    if after is not None:
+      if pos == start:
+        alone = pos == 0 or template_str[pos-1] in breaks
+      elif template_str[start-1].isspace():
+        # Find the space between the start of the line and the directive
+        prefix = template_str[pos:start]
+        stripped = prefix.rstrip()
+        space_lines = prefix[len(stripped):].splitlines(True)
+        if space_lines[-1][-1] in breaks:
+          alone = True  # the directive starts the line
+        else:
+          alone = (len(space_lines) > 1 or
+                   (not stripped and (pos == 0 or
+                                      template_str[pos-1] in breaks)))
+          literal_end = start - len(space_lines[-1])
+
+    if alone:
+      special = True
+      # Check the ones that begin with ## before #
+      if token == COMMENT_BEGIN:
+        token_type, token = COMMENT_BEGIN_TOKEN, None
+      elif token == COMMENT_END:
+        token_type, token = COMMENT_END_TOKEN, None
+      elif token == OPTION_STRIP_LINE or token == OPTION_END or \
+           token.startswith('#'):
+        token_type = None  # The whole line is omitted
+      else:
+        token_type, token = _MatchDirective(token)
+        special = token_type is not None
+
+      if special:
+        if pos < literal_end:
+          if do_strip:
+            yield LITERAL_TOKEN, template_str[pos:literal_end].replace('\n', '')
+          elif line_strip or do_strip_part:
+            literal, line_strip = _StripLines(
+                template_str[pos:literal_end], breaks,
+                pos == 0 or template_str[pos-1] in breaks, False, line_strip,
+                do_strip or do_strip_part)
+            yield LITERAL_TOKEN, literal
+          else:
+            yield LITERAL_TOKEN, template_str[pos:literal_end]
+        pos = match.end()
+
+        if token_type is not None:
+          yield token_type, token  # Only yield the token, not space
+        elif match.group(1) == OPTION_STRIP_LINE:
+          do_strip_part = True
+        elif match.group(1) == OPTION_END:
+          do_strip_part = False
+        line_strip = do_strip or do_strip_part  # for the next line
+        continue
+
+      token = match.group(1)
+
+    # The directive isn't special; process it normally.
+    if pos < start:
+      if do_strip:
+        yield LITERAL_TOKEN, template_str[pos:start].replace('\n', '')
+      elif line_strip or do_strip_part:
+        literal, line_strip = _StripLines(
+            template_str[pos:start], breaks,
+            pos == 0 or template_str[pos-1] in breaks, False, line_strip,
+            do_strip or do_strip_part)
+        yield LITERAL_TOKEN, literal
+      else:
+        yield LITERAL_TOKEN, template_str[pos:start]
+    pos = match.end()
+
+    # Check the ones that begin with ## before #
+    if token == COMMENT_BEGIN:
+      yield COMMENT_BEGIN_TOKEN, None
+    elif token == COMMENT_END:
+      yield COMMENT_END_TOKEN, None
+    elif token == OPTION_STRIP_LINE:
+      do_strip_part = True
+    elif token == OPTION_END:
+      do_strip_part = False
+
+    elif token.startswith('#'):
+      pass  # A single-line comment
+
+    elif token.startswith('.'):
+      literal = meta_literals.get(token)
+      if literal is not None:
+        yield META_LITERAL_TOKEN, literal
+      else:
+        token_type, token = _MatchDirective(token)
+        if token_type is not None:
+          yield token_type, token
+
+    else:  # Now we know the directive is a substitution.
+      yield SUBST_TOKEN, token
+
+    if after is not None:
+      # The rest of the line, which is removed when the line is stripped
+      if not line_strip:
+        yield LITERAL_TOKEN, after
+      line_strip = do_strip or do_strip_part  # for the next line
+
+  if pos < len(template_str):
+    if do_strip:
+      yield LITERAL_TOKEN, template_str[pos:].replace('\n', '')
+    elif line_strip or do_strip_part:
+      literal, _ = _StripLines(
+          template_str[pos:], breaks,
+          pos == 0 or template_str[pos-1] in breaks, True, line_strip,
+          do_strip or do_strip_part)
+      yield LITERAL_TOKEN, literal
+    else:
+      yield LITERAL_TOKEN, template_str[pos:]
+
+
+def _TokenizeLines(template_str, meta_left, meta_right, whitespace):
+  """Yields tokens, which are 2-tuples (TOKEN_TYPE, token_string).
+
+  This is the original tokenizer, which splits the template into lines and each
+  line into directives.  It's kept as a reference implementation for
+  _Tokenize, and for benchmarks.
+  """
+
+  trimlen = len(meta_left)
+  token_re = MakeTokenRegex(meta_left, meta_right)
+  do_strip = (whitespace == 'strip-line')  # Do this outside loop
+  do_strip_part = False
+
+  for line in template_str.splitlines(True):  # retain newlines
+    if do_strip or do_strip_part:
+      line = line.strip()
+
+    tokens = token_re.split(line)
+
+    # Check for a special case first.  If a comment or "block" directive is on a
+    # line by itself (with only space surrounding it), then the space is
+    # omitted.  For simplicity, we don't handle the case where we have 2
+    # directives, say '{.end} # {#comment}' on a line.
+    if len(tokens) == 3:
+      # ''.isspace() == False, so work around that
+      if (tokens[0].isspace() or not tokens[0]) and \
          (tokens[2].isspace() or not tokens[2]):
         token = tokens[1][trimlen : -trimlen]
 
@@ -1120,9 +2210,382 @@ def _Tokenize(template_str, meta_left, meta_right, whitespace):
           yield SUBST_TOKEN, token
 
 
+# States of _HtmlContext
+_HTML_TEXT = 'text'
+_HTML_COMMENT = 'comment'  # <!-- -->
+_HTML_TAG = 'tag'  # in a start tag, between attributes
+_HTML_ATTR_NAME = 'attribute name'
+_HTML_BEFORE_VALUE = 'before attribute value'  # after =
+_HTML_ATTR_VALUE = 'attribute value'  # quoted
+_HTML_UNQUOTED_VALUE = 'unquoted attribute value'
+_HTML_END_TAG = 'end tag'
+_HTML_SCRIPT = 'script'
+_HTML_STYLE = 'style'
+
+# States of the JavaScript in a <script> element or an event handler attribute
+_JS_CODE = 'code'
+_JS_STRING = 'string'
+_JS_LINE_COMMENT = 'line comment'
+_JS_BLOCK_COMMENT = 'block comment'
+_JS_REGEX = 'regular expression'
+_JS_REGEX_CLASS = 'regular expression class'  # [...]
+# A ${} substitution in a template literal.  Following it would mean matching
+# braces, so the rest of the script can't be escaped.
+_JS_TEMPLATE_SUBST = 'template literal substitution'
+
+# Attributes whose values are URLs
+_URL_ATTRS = set([
+    'action', 'archive', 'background', 'cite', 'classid', 'codebase', 'data',
+    'formaction', 'href', 'icon', 'longdesc', 'manifest', 'ping', 'poster',
+    'profile', 'src', 'srcset', 'usemap', 'xlink:href'])
+
+_TAG_NAME_RE = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9:\-]*)')
+_ATTR_NAME_RE = re.compile(r'[^\s=>/"\']+')
+_SPACE_RE = re.compile(r'\s*')
+_UNQUOTED_VALUE_END_RE = re.compile(r'[\s>]')
+_SCRIPT_END_RE = re.compile(r'</script', re.IGNORECASE)
+_STYLE_END_RE = re.compile(r'</style', re.IGNORECASE)
+_JS_SPECIAL_RE = re.compile(r'["\'`/]')
+_JS_STRING_SPECIAL_RE = re.compile(r'[\\"\'\n]')
+_JS_TEMPLATE_SPECIAL_RE = re.compile(r'[\\`]|\$(?:\{|\Z)')
+_JS_REGEX_SPECIAL_RE = re.compile(r'[\\/\[\n]')
+_JS_REGEX_CLASS_SPECIAL_RE = re.compile(r'[\\\]\n]')
+_JS_WORD_END_RE = re.compile(r'[\w$]+$')
+
+# After these words, a / starts a regular expression rather than dividing
+_JS_KEYWORDS_BEFORE_EXPR = set([
+    'await', 'case', 'delete', 'do', 'else', 'in', 'instanceof', 'new', 'of',
+    'return', 'throw', 'typeof', 'void', 'yield'])
+
+# Browsers decode character references in attribute values before they run
+# event handlers.  Only ASCII characters matter for tracking the JavaScript.
+_HTML_ENTITY_RE = re.compile(r'&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z]+);')
+_HTML_ENTITIES = {'quot': '"', 'apos': "'", 'amp': '&', 'lt': '<', 'gt': '>'}
+
+
+def _UnescapeEntity(match):
+  name = match.group(1)
+  if name.startswith('#'):
+    if name[1] in 'xX':
+      code = int(name[2:], 16)
+    else:
+      code = int(name[1:])
+    if code < 128:
+      return chr(code)
+    return 'x'  # any non-ASCII character
+  return _HTML_ENTITIES.get(name, match.group(0))
+
+
+class _HtmlContext(object):
+  """Tracks the HTML context of the template text, for autoescape='html'.
+
+  This is a small HTML tokenizer, which is fed the literal text of the
+  template, and tells which escaper a substitution at the current position
+  needs.  It's not a validating parser; it only follows what's needed to choose
+  an escaper: tags, quoted attribute values, comments, and <script> and <style>
+  elements.  In scripts and event handler attributes like onclick, it also
+  follows JavaScript strings, comments and regular expressions.
+  """
+
+  def __init__(self):
+    self.state = _HTML_TEXT
+    self.tag = None  # name of the current tag
+    self.attr = None  # name of the current attribute
+    self.quote = None  # quote character of the attribute value
+    self.url_part = None  # 'start', 'path' or 'query' in URL attributes
+    self.js_state = None  # a _JS_* state in scripts and event handlers
+    self.js_quote = None  # quote character of the JavaScript string
+    self.js_regex_ok = True  # whether a / would start a regular expression
+    self.js_dollar = False  # whether a template literal's text ended with $
+
+  def Copy(self):
+    return copy.copy(self)
+
+  def Describe(self):
+    """For error messages."""
+    if self.js_state is None:
+      return self.state
+    return '%s (%s)' % (self.state, self.js_state)
+
+  def Escaper(self):
+    """Returns the name of the escaper in _AUTOESCAPERS, or None.
+
+    None means that values can't be escaped here, e.g. inside a tag.
+    """
+    state = self.state
+    if state in (_HTML_TEXT, _HTML_COMMENT):
+      return 'text'
+    if state == _HTML_ATTR_VALUE:
+      if self.js_state is not None:
+        return _JS_ATTR_ESCAPERS.get(self.js_state)
+      if self.attr == 'style':
+        return None
+      if self.attr in _URL_ATTRS:
+        return _URL_ESCAPERS[self.url_part]
+      return 'attr-value'
+    if state == _HTML_SCRIPT:
+      return _JS_ESCAPERS.get(self.js_state)
+    return None
+
+  def Substitute(self):
+    """Called after a substitution, which may be the start of a URL."""
+    if self.state == _HTML_ATTR_VALUE and self.url_part == 'start':
+      self.url_part = 'path'
+    if self.js_state == _JS_CODE:
+      self.js_regex_ok = False  # a / after a value divides it
+    self.js_dollar = False
+
+  def Feed(self, text):
+    """Advance the state over literal text."""
+    i = 0
+    n = len(text)
+    while i < n:
+      state = self.state
+
+      if state == _HTML_TEXT:
+        i = text.find('<', i)
+        if i == -1:
+          return
+        if text.startswith('<!--', i):
+          self.state = _HTML_COMMENT
+          i += 4
+          continue
+        match = _TAG_NAME_RE.match(text, i)
+        if match:
+          if match.group(1):
+            self.state = _HTML_END_TAG
+          else:
+            self.state = _HTML_TAG
+            self.tag = match.group(2).lower()
+          i = match.end()
+        else:
+          i += 1
+
+      elif state == _HTML_COMMENT:
+        i = text.find('-->', i)
+        if i == -1:
+          return
+        self.state = _HTML_TEXT
+        i += 3
+
+      elif state == _HTML_END_TAG:
+        i = text.find('>', i)
+        if i == -1:
+          return
+        self.state = _HTML_TEXT
+        i += 1
+
+      elif state in (_HTML_TAG, _HTML_ATTR_NAME, _HTML_BEFORE_VALUE):
+        i = _SPACE_RE.match(text, i).end()
+        if i == n:
+          return
+        c = text[i]
+        if c == '>':
+          self._EndStartTag()
+          i += 1
+        elif state == _HTML_BEFORE_VALUE:
+          if c in '"\'':
+            self.state = _HTML_ATTR_VALUE
+            self.quote = c
+            if self.attr.startswith('on'):
+              self.js_state = _JS_CODE
+              self.js_regex_ok = True
+            i += 1
+          else:
+            self.state = _HTML_UNQUOTED_VALUE
+          self.url_part = 'start'
+        elif state == _HTML_ATTR_NAME and c == '=':
+          self.state = _HTML_BEFORE_VALUE
+          i += 1
+        elif c == '/':
+          i += 1
+        else:
+          match = _ATTR_NAME_RE.match(text, i)
+          if match:
+            self.attr = match.group(0).lower()
+            i = match.end()
+          else:
+            i += 1  # a stray quote
+          self.state = _HTML_ATTR_NAME
+
+      elif state == _HTML_ATTR_VALUE:
+        end = text.find(self.quote, i)
+        if end == -1:
+          end = n
+        value = text[i:end]
+        if self.js_state is not None:
+          self._FeedJs(_HTML_ENTITY_RE.sub(_UnescapeEntity, value))
+        elif self.url_part != 'query' and value:
+          if '?' in value or '#' in value:
+            self.url_part = 'query'
+          else:
+            self.url_part = 'path'
+        if end < n:
+          self.state = _HTML_TAG
+          self.js_state = None
+        i = end + 1
+
+      elif state == _HTML_UNQUOTED_VALUE:
+        match = _UNQUOTED_VALUE_END_RE.search(text, i)
+        if not match:
+          return
+        self.state = _HTML_TAG
+        i = match.start()
+
+      elif state == _HTML_SCRIPT:
+        # </script ends the element, even in a JavaScript string
+        match = _SCRIPT_END_RE.search(text, i)
+        if not match:
+          self._FeedJs(text[i:])
+          return
+        self._FeedJs(text[i:match.start()])
+        self.state = _HTML_END_TAG
+        self.js_state = None
+        i = match.end()
+
+      elif state == _HTML_STYLE:
+        match = _STYLE_END_RE.search(text, i)
+        if not match:
+          return
+        self.state = _HTML_END_TAG
+        i = match.end()
+
+      else:
+        raise AssertionError(state)
+
+  def _FeedJs(self, text):
+    """Advance the JavaScript state over text in a script or event handler."""
+    if self.js_dollar:
+      # ${ split by the template parser, as in `${.meta-left}...
+      self.js_dollar = False
+      if text.startswith('{'):
+        self.js_state = _JS_TEMPLATE_SUBST
+        return
+    i = 0
+    n = len(text)
+    while i < n:
+      js_state = self.js_state
+
+      if js_state == _JS_CODE:
+        match = _JS_SPECIAL_RE.search(text, i)
+        if not match:
+          self._SkipJsCode(text[i:])
+          return
+        self._SkipJsCode(text[i:match.start()])
+        token = match.group(0)
+        i = match.end()
+        if token != '/':
+          self.js_state = _JS_STRING
+          self.js_quote = token
+        elif text.startswith('/', i):
+          self.js_state = _JS_LINE_COMMENT
+          i += 1
+        elif text.startswith('*', i):
+          self.js_state = _JS_BLOCK_COMMENT
+          i += 1
+        elif self.js_regex_ok:
+          self.js_state = _JS_REGEX
+        else:
+          self.js_regex_ok = True  # a division, which an operand follows
+
+      elif js_state == _JS_STRING:
+        if self.js_quote == '`':
+          match = _JS_TEMPLATE_SPECIAL_RE.search(text, i)
+        else:
+          match = _JS_STRING_SPECIAL_RE.search(text, i)
+        if not match:
+          return
+        token = match.group(0)
+        i = match.end()
+        if token == '\\':
+          i += 1  # skip the escaped character
+        elif token == '${':
+          self.js_state = _JS_TEMPLATE_SUBST
+        elif token == '$':  # at the end of the text
+          self.js_dollar = True
+        elif token == self.js_quote or token == '\n':
+          self.js_state = _JS_CODE
+          self.js_regex_ok = False
+
+      elif js_state in (_JS_REGEX, _JS_REGEX_CLASS):
+        if js_state == _JS_REGEX:
+          match = _JS_REGEX_SPECIAL_RE.search(text, i)
+        else:
+          match = _JS_REGEX_CLASS_SPECIAL_RE.search(text, i)
+        if not match:
+          return
+        token = match.group(0)
+        i = match.end()
+        if token == '\\':
+          i += 1  # skip the escaped character
+        elif token == '[':
+          self.js_state = _JS_REGEX_CLASS
+        elif token == ']':
+          self.js_state = _JS_REGEX
+        else:  # the end of the literal, or an unterminated one
+          self.js_state = _JS_CODE
+          self.js_regex_ok = False
+
+      elif js_state == _JS_LINE_COMMENT:
+        i = text.find('\n', i)
+        if i == -1:
+          return
+        self.js_state = _JS_CODE
+
+      elif js_state == _JS_BLOCK_COMMENT:
+        i = text.find('*/', i)
+        if i == -1:
+          return
+        self.js_state = _JS_CODE
+        i += 2
+
+      elif js_state == _JS_TEMPLATE_SUBST:
+        return
+
+      else:
+        raise AssertionError(js_state)
+
+  def _SkipJsCode(self, code):
+    """Notes whether a / after the code would start a regular expression."""
+    code = code.rstrip()
+    if not code:
+      return
+    match = _JS_WORD_END_RE.search(code)
+    if match:
+      self.js_regex_ok = match.group(0) in _JS_KEYWORDS_BEFORE_EXPR
+    else:
+      # After ) and ], assume the end of a value, as in (a + b) / 2
+      self.js_regex_ok = code[-1] not in ')]'
+
+  def _EndStartTag(self):
+    if self.tag == 'script':
+      self.state = _HTML_SCRIPT
+      self.js_state = _JS_CODE
+      self.js_regex_ok = True
+    elif self.tag == 'style':
+      self.state = _HTML_STYLE
+    else:
+      self.state = _HTML_TEXT
+    self.attr = None
+
+
+# The part of a URL attribute value -> the escaper for it
+_URL_ESCAPERS = {
+    'start': 'url', 'path': 'url-path', 'query': 'url-param-value'}
+
+# The state of the JavaScript -> the escaper for it, in a <script> element and
+# in an event handler attribute
+_JS_ESCAPERS = {
+    _JS_CODE: 'js-value', _JS_STRING: 'js-string',
+    _JS_LINE_COMMENT: 'js-string', _JS_BLOCK_COMMENT: 'js-string',
+    _JS_REGEX: 'js-string', _JS_REGEX_CLASS: 'js-string'}
+_JS_ATTR_ESCAPERS = dict(_JS_ESCAPERS)
+_JS_ATTR_ESCAPERS[_JS_CODE] = 'js-attr-value'
+
+
 def _CompileTemplate(
     template_str, builder, meta='{}', format_char='|', default_formatter='str',
-    whitespace='smart'):
+    whitespace='smart', autoescape=None):
   """Compile the template string, calling methods on the 'program builder'.
 
   Args:
@@ -1143,13 +2606,23 @@ def _CompileTemplate(
         removed.  In 'strip-line' mode, every line is stripped of its
         leading and trailing whitespace.
 
+    autoescape: None or 'html'.  In 'html' mode, the HTML context of each
+        substitution is worked out from the literal text before it: text,
+        attribute value, URL attribute or script.  The escaper for that
+        context is added after the formatters, or replaces the 'str'
+        formatter, so each value is escaped once.  Substitutions with an
+        escaping formatter, like {x|html} or {x|raw}, are left alone.  The
+        contexts follow the template text in order; {.or} and {.alternates
+        with} clauses start in the context of their section.
+
   Returns:
     The compiled program (obtained from the builder)
 
   Raises:
     The various subclasses of CompilationError.  For example, if
     default_formatter=None, and a variable is missing a formatter, then
-    MissingFormatter is raised.
+    MissingFormatter is raised, as it is when autoescape can't escape a
+    substitution in its context, e.g. inside a tag.
 
   This function is public so it can be used by other tools, e.g. a syntax
   checking tool run before submitting a template to source control.
@@ -1167,6 +2640,14 @@ def _CompileTemplate(
   if whitespace not in ('smart', 'strip-line'):
     raise ConfigurationError('Invalid whitespace mode %r' % whitespace)
 
+  if autoescape is None:
+    html_context = None
+  elif autoescape == 'html':
+    html_context = _HtmlContext()
+    section_contexts = []  # the context at the start of each open section
+  else:
+    raise ConfigurationError('Invalid autoescape mode %r' % autoescape)
+
   # If we go to -1, then we got too many {end}.  If end at 1, then we're missing
   # an {end}.
   balance_counter = 0
@@ -1191,6 +2672,8 @@ def _CompileTemplate(
     if token_type in (LITERAL_TOKEN, META_LITERAL_TOKEN):
       if token:
         builder.Append(token)
+        if html_context:
+          html_context.Feed(token)
       continue
 
     if token_type in (SECTION_TOKEN, REPEATED_SECTION_TOKEN, DEF_TOKEN):
@@ -1205,25 +2688,35 @@ def _CompileTemplate(
       balance_counter += 1
       if token_type == DEF_TOKEN:
         has_defines = True
+      if html_context:
+        section_contexts.append(html_context.Copy())
       continue
 
     if token_type == PREDICATE_TOKEN:
       # {.attr?} lookups
       builder.NewPredicateSection(token, test_attr=True)
       balance_counter += 1
+      if html_context:
+        section_contexts.append(html_context.Copy())
       continue
 
     if token_type == IF_TOKEN:
       builder.NewPredicateSection(token, test_attr=False)
       balance_counter += 1
+      if html_context:
+        section_contexts.append(html_context.Copy())
       continue
 
     if token_type == OR_TOKEN:
       builder.NewOrClause(token)
+      if html_context and section_contexts:
+        html_context = section_contexts[-1].Copy()
       continue
 
     if token_type == ALTERNATES_TOKEN:
       builder.AlternatesWith()
+      if html_context and section_contexts:
+        html_context = section_contexts[-1].Copy()
       continue
 
     if token_type == END_TOKEN:
@@ -1235,6 +2728,8 @@ def _CompileTemplate(
             "earlier 'section' or 'repeated section' directive."
             % (meta_left, meta_right))
       builder.EndSection()
+      if html_context:
+        section_contexts.pop()
       continue
 
     if token_type == SUBST_TOKEN:
@@ -1250,7 +2745,12 @@ def _CompileTemplate(
         name = parts[0]
         formatters = parts[1:]
 
-      builder.AppendSubstitution(name, formatters)
+      if html_context:
+        escaper = _ChooseEscaper(html_context, token, formatters)
+        html_context.Substitute()
+        builder.AppendSubstitution(name, formatters, escaper=escaper)
+      else:
+        builder.AppendSubstitution(name, formatters)
       continue
 
     if token_type == SUBST_TEMPLATE_TOKEN:
@@ -1264,12 +2764,701 @@ def _CompileTemplate(
   if comment_counter != 0:
     raise CompilationError('Got %d more {##BEGIN}s than {##END}s' % comment_counter)
 
-  return builder.Root(), has_defines
+  root = builder.Root()
+  _CoalesceLiterals(root)
+  return root, has_defines
+
+
+# Formatters which escape their output.  autoescape leaves substitutions which
+# use them alone, if they fit the context.
+_ESCAPING_FORMATTERS = set([
+    'html', 'html-attr-value', 'htmltag', 'url-params', 'url-param-value',
+    'json', 'js-string', 'plain-url'])
+
+# Escaper chosen from the context -> the escaping formatters which are safe
+# there.  json and js-string don't escape </script>, so they fit nowhere.
+_FITTING_FORMATTERS = {
+    'text': set([
+        'html', 'html-attr-value', 'htmltag', 'url-param-value', 'plain-url']),
+    'attr-value': set(['html-attr-value', 'htmltag', 'url-param-value']),
+    'url': set(['url-param-value']),  # no scheme is left in its output
+    'url-path': set(['html-attr-value', 'htmltag', 'url-param-value']),
+    'url-param-value': set([
+        'html-attr-value', 'htmltag', 'url-param-value', 'url-params']),
+    'js-string': set(['url-param-value']),
+    }
+
+
+def _ChooseEscaper(html_context, token, formatters):
+  """Returns the escaper name for a substitution, for autoescape='html'.
+
+  Args:
+    html_context: The _HtmlContext at the substitution
+    token: The substitution, for error messages
+    formatters: The names of its formatters
+
+  Raises:
+    MissingFormatter: if the value can't be escaped in this context, or an
+        explicit escaping formatter doesn't fit it
+  """
+  explicit = False
+  for f in formatters:
+    if f == 'raw' or f.startswith('template '):
+      return None
+    if f in _ESCAPING_FORMATTERS:
+      explicit = True
+  escaper = html_context.Escaper()
+  if explicit:
+    fitting = _FITTING_FORMATTERS.get(escaper, ())
+    for f in formatters:
+      if f in _ESCAPING_FORMATTERS and f not in fitting:
+        raise MissingFormatter(
+            "Formatter %r in %r doesn't escape for HTML context %r; remove it, "
+            "or use 'raw'" % (f, token, html_context.Describe()))
+    return None
+  if escaper is None:
+    raise MissingFormatter(
+        "Can't auto-escape %r in HTML context %r; add a formatter like 'raw'"
+        % (token, html_context.Describe()))
+  return escaper
+
+
+def _CoalesceLiterals(block):
+  """Optimization pass: merge runs of adjacent literals into single strings.
+
+  _Tokenize yields at least one literal per line, and {.space}, {.newline},
+  etc. are separate literals too.  Each one costs a callback() call at
+  expansion time, so we join them after compilation.  Comments leave no
+  statements behind, so literals around them are merged too.
+
+  The lists are mutated in place, since sections may hold references to them.
+  """
+  for statements in block.StatementLists():
+    result = []
+    run = []  # literals not yet appended to result
+    for statement in statements + [None]:  # None flushes the last run
+      if isinstance(statement, basestring):
+        run.append(statement)
+        continue
+
+      if len(run) == 1:
+        result.append(run[0])
+      elif run:
+        try:
+          result.append(''.join(run))
+        except UnicodeDecodeError:
+          # Mixed byte string and unicode literals; leave it to JoinTokens.
+          result.extend(run)
+      run = []
+
+      if statement is not None:
+        result.append(statement)
+        func, args = statement
+        if isinstance(args, _AbstractSection):
+          _CoalesceLiterals(args)
+
+    statements[:] = result
+
+
+def _EncodeLiterals(block, encoding):
+  """Compile time pass for Template(output_encoding=...).
+
+  Unicode literals are encoded, so that they're not encoded on every expansion.
+  Literals which were left separate by _CoalesceLiterals because they mixed
+  byte strings and unicode can then be merged too.
+  """
+  _EncodeSectionLiterals(block, encoding)
+  _CoalesceLiterals(block)
+
+
+def _EncodeSectionLiterals(block, encoding):
+  """Helper for _EncodeLiterals."""
+  for statements in block.StatementLists():
+    for i, statement in enumerate(statements):
+      if isinstance(statement, unicode):
+        statements[i] = statement.encode(encoding)
+      elif not isinstance(statement, basestring):
+        func, args = statement
+        if isinstance(args, _AbstractSection):
+          _EncodeSectionLiterals(args, encoding)
+
+
+def _EncodingCallback(callback, encoding):
+  """Returns a callback which encodes unicode tokens before passing them on."""
+  def write(token):
+    if isinstance(token, unicode):
+      token = token.encode(encoding)
+    callback(token)
+  return write
+
+
+def _EncodeTokens(tokens, encoding):
+  """Like _EncodingCallback, for a stream of tokens."""
+  for token in tokens:
+    if isinstance(token, unicode):
+      token = token.encode(encoding)
+    yield token
+
+
+_UNKNOWN = object()  # a value that is only known at expansion time
+
+
+class _PartialEvaluator(object):
+  """Evaluates the parts of a program that only depend on constants.
+
+  This is the compile time pass for Template(constants=...).  It mirrors the
+  lookups of _ScopedContext on a stack of frames whose contexts are known at
+  compile time.  The root frame stands for the data dictionary merged with the
+  constants, so a name that isn't a constant is unknown there.
+
+  Only simple formatters and predicates are evaluated, since enhanced ones may
+  look at the context.  Sections over unknown values aren't entered, because
+  any name looked up inside could come from the unknown value.
+  """
+
+  def __init__(self, constants, undefined_str):
+    self.constants = constants
+    self.undefined_str = undefined_str
+
+  def Evaluate(self, block):
+    """Evaluate the root section of a program in place."""
+    statements = block.Statements()
+    statements[:] = self._Statements(statements, [_Frame(self.constants)])
+    _CoalesceLiterals(block)
+
+  def _Statements(self, statements, stack):
+    """Returns the statements with the constant parts evaluated."""
+    result = []
+    for statement in statements:
+      if isinstance(statement, basestring):
+        result.append(statement)
+        continue
+      func, args = statement
+      if func is _DoSubstitute:
+        result.extend(self._Substitute(statement, stack))
+      elif func is _DoSection:
+        result.extend(self._Section(statement, stack))
+      elif func is _DoRepeatedSection:
+        result.extend(self._RepeatedSection(statement, stack))
+      elif func is _DoPredicates:
+        result.extend(self._Predicates(statement, stack))
+      else:  # {.define}
+        result.append(statement)
+    return result
+
+  def _LookUpStack(self, stack, name):
+    """Like _ScopedContext._LookUpStack."""
+    value = _LookUpFrames(stack[1:], name)
+    if value is _UNKNOWN:
+      # The root frame.  The constants take precedence over the data.
+      value = self.constants.get(name, _UNKNOWN)
+    return value
+
+  def _Lookup(self, stack, lookup):
+    """Like _ScopedContext.LookupResolved, but may return _UNKNOWN."""
+    kind, key = lookup
+    if kind == NAME_LOOKUP:
+      return self._LookUpStack(stack, key)
+    elif kind == INDEX_LOOKUP:
+      return self._LookUpStack(stack, '@index')
+    elif kind == CURSOR_LOOKUP:
+      return self._Cursor(stack)
+    elif kind == PATH_LOOKUP:
+      value = self._LookUpStack(stack, key[0])
+      if value is _UNKNOWN:
+        return value
+      for part in key[1:]:
+        try:
+          value = value[part]
+        except (KeyError, TypeError):
+          if self.undefined_str is None:
+            return _UNKNOWN  # leave the UndefinedVariable to expansion time
+          return self.undefined_str
+      return value
+    else:  # ROOT_LOOKUP
+      return _UNKNOWN
+
+  def _Cursor(self, stack):
+    if len(stack) == 1:  # the data dictionary
+      return _UNKNOWN
+    return stack[-1].context
+
+  def _PushSection(self, block, stack):
+    """Returns the value a section would push, or _UNKNOWN."""
+    kind, name = block.lookup
+    if kind == CURSOR_LOOKUP:
+      value = self._Cursor(stack)
+    elif len(stack) == 1:
+      value = self.constants.get(name, _UNKNOWN)
+    else:
+      try:
+        value = stack[-1].context.get(name)
+      except (AttributeError, TypeError):  # an error at expansion time
+        value = _UNKNOWN
+    if value is _UNKNOWN or block.pre_format is None:
+      return value
+    for f, _, func_type in block.pre_formatters:
+      if not _IsContextFree(f, func_type):
+        return _UNKNOWN
+    try:
+      return block.pre_format(value, None)
+    except Exception:
+      return _UNKNOWN
+
+  def _Substitute(self, statement, stack):
+    _, args = statement
+    name, lookup, formatters, write = args
+    value = self._Lookup(stack, lookup)
+    if value is _UNKNOWN:
+      return [statement]
+    for f, _, func_type in formatters:
+      if not _IsContextFree(f, func_type):
+        return [statement]
+    tokens = []
+    try:
+      write(value, None, tokens.append, None)
+    except Exception:  # leave the error to expansion time
+      return [statement]
+    for token in tokens:
+      if not isinstance(token, basestring):
+        return [statement]
+    return tokens
+
+  def _Section(self, statement, stack):
+    _, block = statement
+    value = self._PushSection(block, stack)
+    if value is _UNKNOWN:
+      return [statement]
+    if not value:
+      # The {.or} clause is executed after the section is popped
+      return self._Statements(block.Statements('or'), stack)
+
+    frames = [_Frame(value)]
+    statements = self._Statements(block.Statements(), stack + frames)
+    if _IsFrameIndependent(statements, frames):
+      return statements
+    # The section still has to push the (constant) value.  Blocks are copied
+    # rather than mutated, since an unrolled loop evaluates them many times.
+    block = copy.copy(block)
+    block.statements = dict(block.statements, default=statements)
+    return [(_DoSection, block)]
+
+  def _RepeatedSection(self, statement, stack):
+    _, block = statement
+    items = self._PushSection(block, stack)
+    if items is _UNKNOWN:
+      return [statement]
+
+    if items:
+      if not isinstance(items, list):
+        return [statement]  # an error at expansion time
+      # Unroll the loop
+      result = []
+      last_index = len(items) - 1
+      for i, item in enumerate(items):
+        frames = [_Frame(items), _Frame(item, index=i+1)]
+        statements = self._Statements(block.Statements(), stack + frames)
+        if i != last_index:
+          statements.extend(self._Statements(
+              block.Statements('alternates with'), stack + frames))
+        if not _IsFrameIndependent(statements, frames):
+          return [statement]
+        result.extend(statements)
+      return result
+
+    # The {.or} clause is executed with the empty value pushed
+    frames = [_Frame(items)]
+    statements = self._Statements(block.Statements('or'), stack + frames)
+    if _IsFrameIndependent(statements, frames):
+      return statements
+    return [statement]
+
+  def _TestPredicate(self, predicate, args, func_type, stack):
+    """Returns the value of a predicate as a bool, or _UNKNOWN."""
+    if predicate is _AlwaysTrue:  # {.or}
+      return True
+    if predicate is _IsDebugMode:
+      predicate, args = _TestAttribute, ('debug',)
+
+    if predicate is _TestAttribute:
+      if not args:
+        return _UNKNOWN  # an error at expansion time
+      value = self._Lookup(stack, _ResolveName(args[0]))
+      if value is _UNKNOWN:
+        return value
+      return bool(value)
+
+    if func_type == SIMPLE_FUNC:
+      value = self._Cursor(stack)
+      if value is _UNKNOWN:
+        return value
+      try:
+        return bool(predicate(value))
+      except Exception:
+        return _UNKNOWN
+
+    return _UNKNOWN
+
+  def _Predicates(self, statement, stack):
+    _, block = statement
+    clauses = []
+    for (predicate, args, func_type), statements in block.clauses:
+      do_clause = self._TestPredicate(predicate, args, func_type, stack)
+      if do_clause is _UNKNOWN:
+        clauses.append(((predicate, args, func_type),
+                        self._Statements(statements, stack)))
+      elif do_clause:
+        statements = self._Statements(statements, stack)
+        if not clauses:
+          # Predicates don't push anything, so the clause can be inlined
+          return statements
+        clauses.append(((_AlwaysTrue, None, SIMPLE_FUNC), statements))
+        break
+      # else the clause is never executed
+
+    if not clauses:
+      return []
+    block = copy.copy(block)
+    block.clauses = clauses
+    return [(_DoPredicates, block)]
+
+
+def _LookUpFrames(frames, name):
+  """Like _ScopedContext._LookUpStack, but returns _UNKNOWN if not found."""
+  for frame in reversed(frames):
+    if name == '@index':
+      if frame.index != -1:
+        return frame.index
+    else:
+      context = frame.context
+      if hasattr(context, 'get'):
+        try:
+          return context[name]
+        except KeyError:
+          pass
+        except TypeError:  # unhashable name; an error at expansion time
+          return _UNKNOWN
+  return _UNKNOWN
+
+
+def _IsFrameIndependent(statements, frames):
+  """Can the statements be executed without the frames pushed for a section?
+
+  True if the statements left after partial evaluation don't look at the top of
+  the stack, and the names they look up aren't in the frames.  Looking them up
+  further down the stack then gives the same result.
+  """
+  for statement in statements:
+    if isinstance(statement, basestring):
+      continue
+    func, args = statement
+    if func is not _DoSubstitute:
+      return False  # sections and predicates use the cursor
+    _, (kind, key), formatters, _ = args
+    if kind == CURSOR_LOOKUP:
+      return False
+    elif kind == NAME_LOOKUP:
+      name = key
+    elif kind == PATH_LOOKUP:
+      name = key[0]
+    elif kind == INDEX_LOOKUP:
+      name = '@index'
+    else:  # ROOT_LOOKUP
+      name = None
+    if name is not None and _LookUpFrames(frames, name) is not _UNKNOWN:
+      return False
+    for _, _, func_type in formatters:
+      if func_type == ENHANCED_FUNC:  # may look up names in the context
+        return False
+  return True
+
+
+def _WalkStatements(statements, scope=()):
+  """Walk a program tree, for static analysis of templates.
+
+  Yields (scope, func, args) for every statement that isn't a literal, in
+  order.  The sections are entered; {.define} sections aren't, since they're
+  separate templates in the group.
+
+  Args:
+    statements: A list of statements, e.g. Template._program.Statements()
+    scope: A tuple of the names of the sections enclosing the statements.  This
+        is the stack of contexts that names are looked up in.
+  """
+  for statement in statements:
+    if isinstance(statement, basestring):
+      continue
+    func, args = statement
+    yield scope, func, args
+
+    # here the function acts as ID for the block type
+    if func is _DoSection or func is _DoRepeatedSection:
+      inner = scope + (args.section_name,)
+      for clause in ('default', 'alternates with'):
+        for item in _WalkStatements(args.Statements(clause), inner):
+          yield item
+      # The {.or} clause is shown when the section is missing or empty
+      for item in _WalkStatements(args.Statements('or'), scope):
+        yield item
+    elif func is _DoPredicates:
+      for statements in args.StatementLists():
+        for item in _WalkStatements(statements, scope):
+          yield item
+
+
+def _ReferencedPaths(program):
+  """Implements Template.referenced_paths(), given its root section."""
+  paths = set()
+  for scope, func, args in _WalkStatements(program.Statements()):
+    if func is _DoSubstitute:
+      name = args[0]
+      # None is {.template FOO}, which uses the root
+      if name is not None and name != '@index':
+        paths.add((scope, name))
+    elif func is _DoSection or func is _DoRepeatedSection:
+      paths.add((scope, args.section_name))
+    elif func is _DoPredicates:
+      for (predicate, pred_args, _), _ in args.clauses:
+        if predicate is _TestAttribute and pred_args:
+          paths.add((scope, pred_args[0]))
+        elif predicate is _IsDebugMode:
+          paths.add((scope, 'debug'))
+  return sorted(paths)
+
+
+class _ProgramRecorder(object):
+  """Wraps a _ProgramBuilder, recording the calls _CompileTemplate makes on it.
+
+  The calls only have strings as arguments (formatter names rather than
+  functions, etc.), so they can be saved, and replayed on another builder with
+  _ReplayProgram to build the same program without tokenizing the template.
+  """
+
+  def __init__(self, builder):
+    self.builder = builder
+    self.calls = []  # list of (method name, args)
+
+  def Append(self, statement):
+    # Merge literals, like _CoalesceLiterals, so there are fewer calls
+    if self.calls and self.calls[-1][0] == 'Append':
+      try:
+        self.calls[-1] = ('Append', (self.calls[-1][1][0] + statement,))
+      except UnicodeDecodeError:
+        self.calls.append(('Append', (statement,)))
+    else:
+      self.calls.append(('Append', (statement,)))
+    self.builder.Append(statement)
+
+  def AppendSubstitution(self, name, formatters, escaper=None):
+    if escaper is None:
+      self.calls.append(('AppendSubstitution', (name, formatters)))
+    else:
+      self.calls.append(('AppendSubstitution', (name, formatters, escaper)))
+    self.builder.AppendSubstitution(name, formatters, escaper=escaper)
+
+  def AppendTemplateSubstitution(self, name):
+    self.calls.append(('AppendTemplateSubstitution', (name,)))
+    self.builder.AppendTemplateSubstitution(name)
+
+  def NewSection(self, token_type, section_name, pre_formatters):
+    self.calls.append(
+        ('NewSection', (token_type, section_name, pre_formatters)))
+    self.builder.NewSection(token_type, section_name, pre_formatters)
+
+  def NewOrClause(self, pred_str):
+    self.calls.append(('NewOrClause', (pred_str,)))
+    self.builder.NewOrClause(pred_str)
+
+  def AlternatesWith(self):
+    self.calls.append(('AlternatesWith', ()))
+    self.builder.AlternatesWith()
+
+  def NewPredicateSection(self, pred_str, test_attr=False):
+    self.calls.append(('NewPredicateSection', (pred_str, test_attr)))
+    self.builder.NewPredicateSection(pred_str, test_attr=test_attr)
+
+  def EndSection(self):
+    self.calls.append(('EndSection', ()))
+    self.builder.EndSection()
+
+  def Root(self):
+    return self.builder.Root()
+
+
+# The builder methods that _ProgramRecorder records
+_RECORDED_METHODS = (
+    'Append', 'AppendSubstitution', 'AppendTemplateSubstitution', 'NewSection',
+    'NewOrClause', 'AlternatesWith', 'NewPredicateSection', 'EndSection')
+
+
+def _ValidCalls(calls):
+  """Returns whether calls loaded from a file look like _ProgramRecorder's."""
+  if not isinstance(calls, list):
+    return False
+  for call in calls:
+    if not (isinstance(call, tuple) and len(call) == 2 and
+            call[0] in _RECORDED_METHODS and isinstance(call[1], tuple)):
+      return False
+  return True
+
+
+def _ReplayProgram(calls, builder):
+  """Build a program from calls recorded by _ProgramRecorder.
+
+  Returns:
+    The compiled program, like _CompileTemplate.  The literals were already
+    merged when they were recorded.
+  """
+  for method, args in calls:
+    getattr(builder, method)(*args)
+  return builder.Root()
+
+
+_library_fingerprint = None
+
+def _LibraryFingerprint():
+  """Identifies this version of the library, for CompiledTemplateCache.
+
+  The recorded calls on _ProgramBuilder may mean something different in another
+  version, so they're keyed by a hash of this module's source (or the
+  modification time of the module, if the source isn't available).
+  """
+  global _library_fingerprint
+  if _library_fingerprint is None:
+    path = __file__
+    if path.endswith('.pyc') or path.endswith('.pyo'):
+      path = path[:-1]
+    try:
+      f = open(path, 'rb')
+      try:
+        _library_fingerprint = sha1(f.read()).hexdigest()
+      finally:
+        f.close()
+    except IOError:
+      _library_fingerprint = repr(os.path.getmtime(__file__))
+  return _library_fingerprint
+
+
+# Bump this when the format of the cache files changes
+_CACHE_FORMAT_VERSION = 1
+
+
+class CompiledTemplateCache(object):
+  """An on-disk cache of compiled templates.
+
+  Pass an instance as the compile_cache argument of Template(), FromString(),
+  FromFile(), or formatters.TemplateFileInclude().  Compiling a template which
+  is in the cache doesn't tokenize or parse it, which makes starting a process
+  that compiles many templates faster.
+
+  Each entry is keyed by a hash of the template string, the compile options,
+  and the version of this library, so stale entries are never used.  The
+  formatters and predicates are stored by name, and looked up again when the
+  template is loaded.
+
+  Errors reading or writing the cache directory are ignored; the template is
+  just compiled normally.
+  """
+
+  def __init__(self, directory):
+    """
+    Args:
+      directory: The directory to store the cache files in.  It's created if it
+          doesn't exist.
+    """
+    self.directory = directory
+
+  def _Key(self, template_str, compile_options):
+    h = sha1()
+    # Unicode and byte string templates compile to different literals
+    if isinstance(template_str, unicode):
+      h.update('u')
+      h.update(template_str.encode('utf-8'))
+    else:
+      h.update('s')
+      h.update(template_str)
+    options = dict(compile_options)
+    for name in ('meta', 'format_char', 'default_formatter', 'whitespace',
+                 'autoescape'):
+      options.setdefault(name, None)
+    h.update(repr(sorted(options.items())))
+    h.update(repr((_CACHE_FORMAT_VERSION, marshal.version, sys.version_info)))
+    h.update(_LibraryFingerprint())
+    return h.hexdigest()
+
+  def _Path(self, key):
+    return os.path.join(self.directory, key + '.jtc')
+
+  def _Load(self, key):
+    """Returns (has_defines, calls), or None if the entry isn't usable."""
+    try:
+      f = open(self._Path(key), 'rb')
+      try:
+        entry = marshal.load(f)
+      finally:
+        f.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+      return None
+    # The key is stored too, in case the file was replaced
+    if not (isinstance(entry, tuple) and len(entry) == 3 and
+            entry[0] == key and _ValidCalls(entry[2])):
+      return None
+    return entry[1], entry[2]
+
+  def _Save(self, key, has_defines, calls):
+    path = self._Path(key)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      f = open(temp_path, 'wb')
+      try:
+        marshal.dump((key, has_defines, calls), f)
+      finally:
+        f.close()
+      # Other processes see either the whole file or no file
+      os.rename(temp_path, path)
+    except (IOError, OSError, ValueError):
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+
+  def Compile(self, template_str, new_builder, compile_options):
+    """Like _CompileTemplate, but use the cache.
+
+    Args:
+      new_builder: A function which returns a new program builder.  If the
+          builder is a _ProgramRecorder, its calls are the ones saved.
+
+    Returns:
+      The compiled program and whether it has {.define} sections, like
+      _CompileTemplate.
+    """
+    key = self._Key(template_str, compile_options)
+    entry = self._Load(key)
+    if entry is not None:
+      has_defines, calls = entry
+      try:
+        return _ReplayProgram(calls, new_builder()), has_defines
+      except (TypeError, ValueError, IndexError, KeyError, AttributeError,
+              AssertionError, CompilationError):
+        pass  # The calls are malformed; compile again and replace them
+
+    builder = new_builder()  # the failed replay may have changed the old one
+    if isinstance(builder, _ProgramRecorder):
+      recorder = builder
+    else:
+      recorder = _ProgramRecorder(builder)
+    program, has_defines = _CompileTemplate(
+        template_str, recorder, **compile_options)
+    self._Save(key, has_defines, recorder.calls)
+    return program, has_defines
 
 
 _OPTION_RE = re.compile(r'^([a-zA-Z\-]+):\s*(.*)')
 _OPTION_NAMES = ['meta', 'format-char', 'default-formatter', 'undefined-str',
-                 'whitespace']
+                 'whitespace', 'autoescape']
 
 
 def FromString(s, **kwargs):
@@ -1279,8 +3468,8 @@ def FromString(s, **kwargs):
   return FromFile(f, **kwargs)
 
 
-def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
-             _constructor=None):
+def FromFile(f, more_formatters=_NoFunctions, more_predicates=_NoFunctions,
+             compile_cache=None, _constructor=None):
   """Parse a template from a file, using a simple file format.
 
   This is useful when you want to include template options in a data file,
@@ -1301,6 +3490,7 @@ def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
   Args:
     f: A file handle to read from.  Caller is responsible for opening and
     closing it.
+    compile_cache: An optional CompiledTemplateCache instance; see Template().
   """
   _constructor = _constructor or Template
 
@@ -1322,7 +3512,8 @@ def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
       if name in _OPTION_NAMES:
         name = name.replace('-', '_')
         value = value.strip()
-        if name == 'default_formatter' and value.lower() == 'none':
+        if (name in ('default_formatter', 'autoescape') and
+            value.lower() == 'none'):
           value = None
         options[name] = value
       else:
@@ -1340,6 +3531,8 @@ def FromFile(f, more_formatters=lambda x: None, more_predicates=lambda x: None,
     # There were no options, so no blank line is necessary.
     body = line + f.read()
 
+  if compile_cache is not None:
+    options['compile_cache'] = compile_cache
   return _constructor(body,
                       more_formatters=more_formatters,
                       more_predicates=more_predicates,
@@ -1358,12 +3551,24 @@ class Template(object):
   Don't go crazy with metacharacters.  {}, [], {{}} or <> should cover nearly
   any circumstance, e.g. generating HTML, CSS XML, JavaScript, C programs, text
   files, etc.
+
+  Templates can be pickled, e.g. to send them to multiprocessing workers.  The
+  program is saved as the calls that built it (see _ProgramRecorder), so the
+  template isn't compiled again when it's loaded.  The calls are only recorded
+  when the template is pickled, by compiling the template string again.
+  Formatters and predicates are saved by name and looked up again, so
+  more_formatters and more_predicates must be picklable.
   """
 
   def __init__(self, template_str,
-               more_formatters=lambda x: None,
-               more_predicates=lambda x: None,
+               more_formatters=_NoFunctions,
+               more_predicates=_NoFunctions,
                undefined_str=None,
+               backend='interpreter',
+               compile_cache=None,
+               constants=None,
+               memoize_formatters=False,
+               output_encoding=None,
                **compile_options):
     """
     Args:
@@ -1388,27 +3593,158 @@ class Template(object):
           constructor argument rather than an .expand() argument for
           simplicity.)
 
+      backend: How the compiled program is executed.  'interpreter' (the
+          default, and the reference engine) walks the program tree on every
+          expansion.  'codegen' turns the program into a Python function once,
+          which makes expansion faster.  Expanding with a Trace always uses the
+          interpreter.
+
+      compile_cache: An optional CompiledTemplateCache instance.  If the
+          template was compiled before with the same options, the program is
+          loaded from the cache instead.
+
+      constants: An optional dictionary of names whose values are fixed, like
+          deployment flags.  The parts of the template which only depend on
+          them are evaluated at compile time, e.g. {.debug?} blocks are
+          dropped or inlined.  The constants are merged into the data
+          dictionary on expansion, and take precedence over it.
+
+      memoize_formatters: If true, the results of pure formatters are memoized
+          during each expansion, for up to 1000 distinct string and number
+          values.  This helps when the same values are formatted many times,
+          like the category names in a long listing.  The pure formatters are
+          html, html-attr-value, htmltag, url-param-value, upper, lower, str,
+          and user formatters f with f.pure = True.
+
+      output_encoding: If set, e.g. to 'utf-8', the template expands to a byte
+          string in this encoding.  Unicode literals are encoded at compile
+          time, and unicode substitutions as they're written, so the tokens
+          don't have to be decoded to be joined.  Byte strings, in the template
+          or the data, are assumed to be in this encoding already.
+
     It also accepts all the compile options that _CompileTemplate does.
     """
-    r = _TemplateRegistry(self)
+    if backend not in ('interpreter', 'codegen'):
+      raise ConfigurationError('Invalid backend %r' % backend)
+
     self.undefined_str = undefined_str
+    self.backend = backend
+    self.constants = constants
+    self.memoize_formatters = memoize_formatters
+    self.output_encoding = output_encoding
     self.group = {}  # optionally updated by _UpdateTemplateGroup
-    builder = _ProgramBuilder(more_formatters, more_predicates, r)
+    self._generated_func = None  # set for backend='codegen'
+    # For pickling
+    self._more_formatters = more_formatters
+    self._more_predicates = more_predicates
+    self._template_str = template_str
+    self._compile_options = compile_options
+    self._loaded_calls = None  # set when the template was unpickled
+    self._defined_names = []  # names in self.group from {.define}
     # None used by _FromSection
     if template_str is not None:
-      self._program, self.has_defines = _CompileTemplate(
-          template_str, builder, **compile_options)
-      self.group = _MakeGroupFromRootSection(self._program, self.undefined_str)
+      if compile_cache is None:
+        self._program, self.has_defines = _CompileTemplate(
+            template_str, self._NewBuilder(), **compile_options)
+      else:
+        self._program, self.has_defines = compile_cache.Compile(
+            template_str, self._NewBuilder, compile_options)
+      if constants:
+        _PartialEvaluator(constants, undefined_str).Evaluate(self._program)
+      if output_encoding:
+        _EncodeLiterals(self._program, output_encoding)
+      self._GenerateCode()
+      self.group = _MakeGroupFromRootSection(
+          self._program, self.undefined_str, self.backend, output_encoding)
+      self._defined_names = list(self.group)
+
+  def __getstate__(self):
+    calls = self._RecordCalls()
+    if calls is None:
+      raise UsageError(
+          "Can't pickle a template made from a {.define} section; pickle the "
+          "template that defines it")
+    # The templates made from {.define} sections are built again on load
+    group = {}
+    for name in self.group:
+      if name not in self._defined_names:
+        group[name] = self.group[name]
+    return {
+        'calls': calls,
+        'has_defines': self.has_defines,
+        'more_formatters': self._more_formatters,
+        'more_predicates': self._more_predicates,
+        'undefined_str': self.undefined_str,
+        'backend': self.backend,
+        'constants': self.constants,
+        'memoize_formatters': self.memoize_formatters,
+        'output_encoding': self.output_encoding,
+        'group': group,
+        }
+
+  def __setstate__(self, state):
+    self.undefined_str = state['undefined_str']
+    self.backend = state['backend']
+    self.constants = state['constants']
+    self.memoize_formatters = state['memoize_formatters']
+    self.output_encoding = state['output_encoding']
+    self._generated_func = None
+    self._more_formatters = state['more_formatters']
+    self._more_predicates = state['more_predicates']
+    self._template_str = None
+    self._compile_options = None
+    # There's no template string to compile again, so keep the calls
+    self._loaded_calls = state['calls']
+
+    # Look up the formatters and predicates by name again
+    self._program = _ReplayProgram(self._loaded_calls, self._NewBuilder())
+    self.has_defines = state['has_defines']
+    if self.constants:
+      _PartialEvaluator(self.constants, self.undefined_str).Evaluate(
+          self._program)
+    if self.output_encoding:
+      _EncodeLiterals(self._program, self.output_encoding)
+    self._GenerateCode()
+    self.group = _MakeGroupFromRootSection(
+        self._program, self.undefined_str, self.backend, self.output_encoding)
+    self._defined_names = list(self.group)
+    # Templates added by MakeTemplateGroup
+    self.group.update(state['group'])
+
+  def _RecordCalls(self):
+    """Returns the _ProgramBuilder calls which build this template's program.
+
+    Returns None for templates made from {.define} sections.
+    """
+    if self._loaded_calls is not None:
+      return self._loaded_calls
+    if self._template_str is None:
+      return None
+    recorder = _ProgramRecorder(self._NewBuilder())
+    _CompileTemplate(self._template_str, recorder, **self._compile_options)
+    return recorder.calls
+
+  def _NewBuilder(self):
+    """Returns a _ProgramBuilder with this template's formatters, etc."""
+    return _ProgramBuilder(self._more_formatters, self._more_predicates,
+                           _TemplateRegistry(self), self.memoize_formatters)
 
   @staticmethod
-  def _FromSection(section, group, undefined_str):
-    t = Template(None, undefined_str=undefined_str)
+  def _FromSection(section, group, undefined_str, backend='interpreter',
+                   output_encoding=None):
+    t = Template(None, undefined_str=undefined_str, backend=backend,
+                 output_encoding=output_encoding)
     t._program = section
     t.has_defines = False
+    t._GenerateCode()
     # This "subtemplate" needs the group too for its own references
     t.group = group
     return t
 
+  def _GenerateCode(self):
+    if self.backend == 'codegen':
+      self._generated_func = _CodeGenerator().Compile(self._program)
+
   def _Statements(self):
     # for execute_with_style
     return self._program.Statements()
@@ -1433,32 +3769,98 @@ class Template(object):
     self.group.update(group)
 
   def _CheckRefs(self):
-    """Check that the template names referenced in this template exist."""
-    # TODO: Implement this.
-    # This is called by MakeTemplateGroup.
-    # We would walk the program Statements() tree, look for name=None
-    # substitutions, with a template formatter, and call Resolve().
-
-  #
-  # Public API
-  #
+    """Check that the template names referenced in this template exist.
 
-  def execute(self, data_dict, callback, group=None, trace=None):
-    """Low level method to expand the template piece by piece.
+    Raises:
+      UsageError if a {.template FOO} or {foo|template FOO} refers to a name
+      that's not in the group.
+    """
+    # This is meant to be called by MakeTemplateGroup.  But a style template
+    # can refer to templates in the group of the template it's expanded with, so
+    # it's not called yet.
+    missing = []
+    for _, func, args in _WalkStatements(self._program.Statements()):
+      if func is _DoSubstitute:
+        for f, _, formatter_type in args[2]:
+          if (formatter_type == TEMPLATE_FORMATTER and f.template is None and
+              f.name not in self.group):
+            missing.append(f.name)
+    if missing:
+      raise UsageError(
+          'This template references templates that are not in its group: %s'
+          % missing)
 
-    Args:
-      data_dict: The JSON data dictionary.
-      callback: A callback which should be called with each expanded token.
-      group: Dictionary of name -> Template instance (for styles)
+  def _NewContext(self, data_dict, group, wait_for_futures=False, flush=None):
+    """Returns the _ScopedContext to expand the template with.
 
-    Example: You can pass 'f.write' as the callback to write directly to a file
-    handle.
+    If wait_for_futures is set, it's a _FutureContext, and flush is passed to
+    it.
     """
     # First try the passed in version, then the one set by _UpdateTemplateGroup.
     # May be None.  Only one of these should be set.
     group = group or self.group
-    context = _ScopedContext(data_dict, self.undefined_str, group=group)
-    _Execute(self._program.Statements(), context, callback, trace)
+    if self.constants:
+      if not isinstance(data_dict, dict):
+        raise EvaluationError(
+            'A template with constants must be expanded with a dictionary; '
+            'got %s' % type(data_dict))
+      data_dict = dict(data_dict)
+      data_dict.update(self.constants)
+    if wait_for_futures:
+      return _FutureContext(data_dict, self.undefined_str, group=group,
+                            flush=flush)
+    return _ScopedContext(data_dict, self.undefined_str, group=group)
+
+  def _Run(self, context, callback, trace):
+    """Expands the template with a context from _NewContext.
+
+    Unlike execute(), it doesn't flush a BufferedSink, so that only the
+    outermost expansion does.
+    """
+    write = callback
+    if self.output_encoding:
+      write = _EncodingCallback(callback, self.output_encoding)
+    if self._generated_func and not trace:
+      self._generated_func(context, write, trace)
+    else:
+      _Execute(self._program.Statements(), context, write, trace)
+
+  def _ExecuteNested(self, data_dict, outer_context, callback, trace):
+    """For {foo|template BAR}, which expands this template inside another.
+
+    If the other template's context waits for futures, so does this one's.
+    """
+    if isinstance(outer_context, _FutureContext):
+      context = self._NewContext(data_dict, None, wait_for_futures=True,
+                                 flush=outer_context.flush)
+    else:
+      context = self._NewContext(data_dict, None)
+    self._Run(context, callback, trace)
+
+  def _Stream(self, data_dict, group=None):
+    """Like execute(), but a generator of tokens; see tokenstream()."""
+    context = self._NewContext(data_dict, group)
+    return _Stream(self._program.Statements(), context)
+
+  #
+  # Public API
+  #
+
+  def execute(self, data_dict, callback, group=None, trace=None):
+    """Low level method to expand the template piece by piece.
+
+    Args:
+      data_dict: The JSON data dictionary.
+      callback: A callback which should be called with each expanded token.
+      group: Dictionary of name -> Template instance (for styles)
+
+    Example: You can pass 'f.write' as the callback to write directly to a file
+    handle.  To write it in fewer, larger blocks, pass BufferedSink(f.write),
+    which is flushed at the end.
+    """
+    self._Run(self._NewContext(data_dict, group), callback, trace)
+    if isinstance(callback, BufferedSink):
+      callback.flush()
 
   render = execute  # Alias for backward compatibility
 
@@ -1475,17 +3877,33 @@ class Template(object):
       trace: Trace object for debugging
       style: Template instance to be treated as a style for this template (the
           "outside")
+      sink: A BufferedSink to write the expansion to, instead of returning it.
+          The sink is flushed at the end.
 
     Returns:
       The return value could be a str() or unicode() instance, depending on the
       the type of the template string passed in, and what the types the strings
-      in the dictionary are.
+      in the dictionary are.  None if a sink was passed.
+    """
+    return self._Expand(args, kwargs, None)
+
+  def expand_bytes(self, *args, **kwargs):
+    """Like expand(), but returns a byte string.
+
+    It's encoded with the template's output_encoding, or UTF-8 if it doesn't
+    have one.  Each unicode token is encoded as it's written, so the tokens are
+    joined once, and the result doesn't need to be encoded again.
     """
+    return self._Expand(args, kwargs, self.output_encoding or 'utf-8')
+
+  def _Expand(self, args, kwargs, encoding):
+    """Implements expand() and, if an encoding is passed, expand_bytes()."""
     if args:
       if len(args) == 1:
         data_dict = args[0]
         trace = kwargs.get('trace')
         style = kwargs.get('style')
+        sink = kwargs.get('sink')
       else:
         raise TypeError(
             'expand() only takes 1 positional argument (got %s)' % args)
@@ -1493,28 +3911,129 @@ class Template(object):
       data_dict = kwargs
       trace = None  # Can't use trace= with the kwargs style
       style = None
+      sink = None
 
-    tokens = []
+    if sink is None:
+      tokens = []
+      callback = tokens.append
+    else:
+      callback = sink
+    # execute() encodes the tokens of a template with an output_encoding.  A
+    # style may include the body template, whose encoding can differ.
+    if encoding and (style or self.output_encoding != encoding):
+      callback = _EncodingCallback(callback, encoding)
     if style:
-      style.execute(data_dict, tokens.append, group=self.group,
+      style.execute(data_dict, callback, group=self.group,
                     trace=trace)
     else:
       # Needs a group to reference its OWN {.define}s
-      self.execute(data_dict, tokens.append, group=self.group,
+      self.execute(data_dict, callback, group=self.group,
                    trace=trace)
 
+    if sink is not None:
+      if encoding and isinstance(sink, BufferedSink):
+        sink.flush()  # execute() only saw the wrapper
+      return None
+    if encoding:
+      return ''.join(tokens)  # all byte strings
+    return JoinTokens(tokens)
+
+  def execute_with_futures(self, data_dict, callback, group=None):
+    """Like execute(), but values in the data dictionary can be futures.
+
+    A future is any object with result() and done() methods, like a
+    concurrent.futures.Future.  It's waited for when the expansion reaches it,
+    so the template is expanded while the data for its later parts is still
+    being fetched.  Waiting blocks the calling thread; this isn't a coroutine.
+    Templates referenced with {foo|template BAR} wait for futures too.
+
+    If the callback has a flush() method, like a BufferedSink, it's called
+    before waiting for a future which isn't done, so the output so far is
+    written out first.
+    """
+    context = self._NewContext(data_dict, group, wait_for_futures=True,
+                               flush=getattr(callback, 'flush', None))
+    self._Run(context, callback, None)
+    if isinstance(callback, BufferedSink):
+      callback.flush()
+
+  def expand_with_futures(self, data_dict):
+    """Like expand(), but values in the data dictionary can be futures.
+
+    It blocks until the futures it reaches are done, and returns the string.
+    See execute_with_futures().
+    """
+    tokens = []
+    self.execute_with_futures(data_dict, tokens.append, group=self.group)
     return JoinTokens(tokens)
 
-  def tokenstream(self, data_dict):
+  def prefetch(self, data_dict):
+    """Waits for the futures in the data which the template may use.
+
+    This is for expanding a template without blocking in the middle, e.g.
+
+      t.expand(t.prefetch(data_dict))
+
+    Futures are objects with result() and done() methods, like a
+    concurrent.futures.Future; see execute_with_futures().  The futures which are
+    reached by the names in referenced_paths(), of this template and the
+    templates in its group, are waited for together.
+
+    Returns:
+      A copy of data_dict without those futures.  The dictionaries and lists
+      which had futures in them are copied; data_dict isn't modified.
+    """
+    # The group's templates aren't constructed just to look at their names
+    programs = [self._program]
+    if self.group:
+      programs.extend(self.group.Programs())
+    names = set()
+    for program in programs:
+      for _, name in _ReferencedPaths(program):
+        names.update(name.split('.'))
+    return _PrefetchFutures(data_dict, names)
+
+  def referenced_paths(self):
+    """Returns the names of the data this template may look up.
+
+    This is static analysis of the compiled template, e.g. so that a server can
+    fetch only the parts of the data dictionary that a page renders.  It
+    includes substituted names, section names, and the attributes of
+    {.if test foo} and {.foo?} predicates.  Names looked up by formatters and
+    predicates themselves, and by other templates in the group, aren't
+    included.
+
+    Returns:
+      A sorted list of (scope, name) pairs.  The scope is a tuple of the names
+      of the enclosing sections, outermost first, and the name is as written in
+      the template, e.g. 'foo.bar' or '@'.  Since names are looked up in every
+      enclosing context, the name may refer to a value in any prefix of the
+      scope.
+    """
+    return _ReferencedPaths(self._program)
+
+  def tokenstream(self, data_dict, chunk_size=0):
     """Yields a list of tokens resulting from expansion.
 
-    This may be useful for WSGI apps.  NOTE: In the current implementation, the
-    entire expanded template must be stored memory.
+    This may be useful for WSGI apps.  The template is expanded as the tokens
+    are consumed, so the output doesn't have to be stored in memory, and the
+    first part of it can be sent before the rest is expanded.  Templates
+    referenced with {foo|template BAR} are streamed too.  (The interpreter is
+    always used, even with backend='codegen'.)
 
     NOTE: This is a generator, but JavaScript doesn't have generators.
+
+    Args:
+      data_dict: The JSON data dictionary.
+      chunk_size: If nonzero, the tokens are joined into chunks of at least
+          this many characters (except for the last one), to avoid many tiny
+          writes.
     """
-    tokens = []
-    self.execute(data_dict, tokens.append)
+    tokens = self._Stream(data_dict)
+    if self.output_encoding:
+      tokens = _EncodeTokens(tokens, self.output_encoding)
+    if chunk_size:
+      tokens = _Chunks(tokens, chunk_size)
     for token in tokens:
       yield token
 
@@ -1543,13 +4062,154 @@ class Trace(object):
     return 'Trace %s %s' % (self.exec_depth, self.template_depth)
 
 
-def _MakeGroupFromRootSection(root_section, undefined_str):
+class BufferedSink(object):
+  """Collects the tokens of an expansion, and writes them out in blocks.
+
+  Template.execute() calls its callback once for every literal and
+  substitution.  If that's f.write or a socket's sendall, there are many tiny
+  writes.  A BufferedSink can be passed as the callback instead:
+
+    sink = BufferedSink(f.write)
+    t.execute(data_dict, sink)  # or t.expand(data_dict, sink=sink)
+
+  execute() and expand() flush the sink at the end.
+
+  Public attributes:
+    num_chars: The number of characters written out.
+    num_bytes: The number of bytes written out.  Unicode blocks are only counted
+        once they're encoded; see the encoding argument.
+    num_writes: The number of blocks written out.
+  """
+
+  def __init__(self, out, buffer_size=8192, encoding=None):
+    """
+    Args:
+      out: A function which is called with each block, like f.write, or a file
+          descriptor (an integer), which is written to with os.write().
+      buffer_size: A block is written out when at least this many characters
+          are buffered.
+      encoding: If set, unicode blocks are encoded before they're written out.
+          For a file descriptor, the default is 'utf-8'.
+    """
+    if isinstance(out, (int, long)):
+      self.fd = out
+      self.out = self._WriteFd
+      encoding = encoding or 'utf-8'
+    else:
+      self.fd = None
+      self.out = out
+    self.buffer_size = buffer_size
+    self.encoding = encoding
+
+    self.num_chars = 0
+    self.num_bytes = 0
+    self.num_writes = 0
+    self._tokens = []
+    self._size = 0  # characters in self._tokens
+
+  def __call__(self, token):
+    self._tokens.append(token)
+    self._size += len(token)
+    if self._size >= self.buffer_size:
+      self.flush()
+
+  write = __call__  # so it can be used like a file
+
+  def flush(self):
+    """Write out any buffered tokens as one block."""
+    if not self._tokens:
+      return
+    block = JoinTokens(self._tokens)
+    self.num_chars += self._size
+    self._tokens = []
+    self._size = 0
+
+    if self.encoding and isinstance(block, unicode):
+      block = block.encode(self.encoding)
+    if isinstance(block, str):
+      self.num_bytes += len(block)
+    self.num_writes += 1
+    self.out(block)
+
+  def _WriteFd(self, block):
+    # os.write() may not write the whole block
+    while block:
+      n = os.write(self.fd, block)
+      block = block[n:]
+
+
+class _TemplateGroup(UserDict.DictMixin):
+  """A dictionary { template name -> Template() instance } for {.define}s.
+
+  Templates are only constructed from the {.define} sections when they're
+  first looked up, e.g. by _TemplateRef.Resolve.  A template which defines
+  many sub-templates is then cheap to compile, when only a few of them are
+  used.  Until then the private dictionary holds the _Section instance.  Every
+  method which returns values goes through __getitem__, so the sections are
+  never seen outside.
+  """
+
+  def __init__(self, undefined_str, backend, output_encoding=None):
+    self.undefined_str = undefined_str
+    self.backend = backend
+    self.output_encoding = output_encoding  # the literals are encoded already
+    self._templates = {}  # name -> Template or _Section
+
+  def __getitem__(self, name):
+    value = self._templates[name]
+    if isinstance(value, _Section):
+      # If two threads get here at once, they construct equivalent templates,
+      # and the last one is kept.
+      value = Template._FromSection(
+          value, self, self.undefined_str, self.backend, self.output_encoding)
+      self._templates[name] = value
+    return value
+
+  def __setitem__(self, name, value):
+    self._templates[name] = value
+
+  def __delitem__(self, name):
+    del self._templates[name]
+
+  def keys(self):
+    return self._templates.keys()
+
+  # DictMixin implements these with keys(); these are faster
+
+  def __contains__(self, name):
+    return name in self._templates
+
+  def __iter__(self):
+    return iter(self._templates)
+
+  def __len__(self):
+    return len(self._templates)
+
+  def copy(self):
+    """Returns a dict with the templates, constructing them all."""
+    return dict(self.iteritems())
+
+  def Programs(self):
+    """Returns the programs of the templates, without constructing them."""
+    programs = []
+    for value in self._templates.itervalues():
+      if isinstance(value, _Section):
+        programs.append(value)
+      else:
+        programs.append(value._program)
+    return programs
+
+
+def _MakeGroupFromRootSection(root_section, undefined_str,
+                              backend='interpreter', output_encoding=None):
   """Construct a dictinary { template name -> Template() instance }
 
   Args:
     root_section: _Section instance -- root of the original parse tree
+    backend: Backend for the Template() instances, see Template()
+    output_encoding: See Template()
   """
-  group = {}
+  group = _TemplateGroup(undefined_str, backend, output_encoding)
   for statement in root_section.Statements():
     if isinstance(statement, basestring):
       continue
@@ -1557,9 +4217,9 @@ def _MakeGroupFromRootSection(root_section, undefined_str):
     # here the function acts as ID for the block type
     if func is _DoDef and isinstance(args, _Section):
       section = args
-      # Construct a Template instance from a this _Section subtree
-      t = Template._FromSection(section, group, undefined_str)
-      group[section.section_name] = t
+      # A Template instance is constructed from this _Section subtree when
+      # it's first used
+      group[section.section_name] = section
   return group
 
 
@@ -1597,59 +4257,201 @@ def JoinTokens(tokens):
   try/except.  Two tries necessary.
 
   If someone really wanted to use another encoding, they could monkey patch
-  jsontemplate.JoinTokens (this function).
+  jsontemplate.JoinTokens (this function), or use Template(...,
+  output_encoding=...) to avoid the second try.
+
+  Only the byte strings are decoded.  Before, the unicode tokens were
+  "decoded" too, which encodes them as ASCII first, so a byte string template
+  with non-ASCII literals raised UnicodeEncodeError when it was expanded with
+  non-ASCII unicode data.  Now the result is a unicode string.
   """
   try:
     return ''.join(tokens)
   except UnicodeDecodeError:
     # This can still raise UnicodeDecodeError if that data isn't utf-8.
-    return ''.join(t.decode('utf-8') for t in tokens)
+    decoded = []
+    for t in tokens:
+      if not isinstance(t, unicode):
+        t = t.decode('utf-8')
+      decoded.append(t)
+    return u''.join(decoded)
+
+
+# The control flow of sections is written once, as generators which set up the
+# context, and yield the statement lists to execute in it, in order.  The
+# interpreter executes them with _Execute, and _Stream streams them.
+
+def _SectionParts(block, context):
+  """{.section foo}"""
+  # If a section present and "true", push the dictionary onto the stack as the
+  # new context, and show it
+  if context.PushResolvedSection(block.lookup, block.pre_format):
+    yield block.Statements()
+    context.Pop()
+  else:  # missing or "false" -- show the {.or} section
+    context.Pop()
+    yield block.Statements('or')
+
+
+def _RepeatedSectionParts(block, context):
+  """{.repeated section foo}
+
+  The items are iterated over directly, and one frame for them is pushed and
+  updated in place, rather than calling context.Next() until it raises
+  StopIteration.  Any iterable is consumed one item at a time, so instead of
+  looking ahead for the last item, {.alternates with} is executed before every
+  item but the first, while the previous item is still on the stack.
+  """
+  items = context.PushResolvedSection(block.lookup, block.pre_format)
+  i = 0
+  if items:
+    if not isinstance(items, list):
+      items = _Iterate(items)
+
+    statements = block.LoopStatements()
+    alt_statements = block.LoopStatements('alternates with')
+    frame = _Frame(None, index=0)
+    context.stack.append(frame)
+    for item in items:
+      # Each item could be an atom (string, integer, etc.) or a dictionary.
+      if i and alt_statements:
+        yield alt_statements
+      i += 1
+      if item.__class__ is Lazy:  # the cursor is never a Lazy
+        item = context._Force(item)
+      frame.context = item
+      frame.index = i  # @index is 1-based
+      if frame.cache:
+        frame.cache = {}
+      yield statements
+    context.stack.pop()
+
+  if not i:  # missing, false, or no items
+    yield block.Statements('or')
+
+  context.Pop()
+
+
+def _ChooseClause(block, context):
+  """{.predicate?}
+
+  Returns:
+    The predicate and statements of the first clause whose predicate is true,
+    or (None, None).
+  """
+  value = context.stack[-1].context  # the cursor
+  for (predicate, args, func_type), statements in block.clauses:
+    if func_type == ENHANCED_FUNC:
+      do_clause = predicate(value, context, args)
+    else:
+      do_clause = predicate(value)
+
+    if do_clause:
+      return predicate, statements
+  return None, None
 
 
 def _DoRepeatedSection(args, context, callback, trace):
-  """{.repeated section foo}"""
+  """{.repeated section foo}
 
+  Like _RepeatedSectionParts, but with the loop written out, since the
+  generator costs time for each item.  _Stream uses _RepeatedSectionParts.
+  """
   block = args
-
-  items = context.PushSection(block.section_name, block.pre_formatters)
+  items = context.PushResolvedSection(block.lookup, block.pre_format)
+  i = 0
   if items:
     if not isinstance(items, list):
-      raise EvaluationError('Expected a list; got %s' % type(items))
+      items = _Iterate(items)
+
+    statements = block.LoopStatements()
+    alt_statements = block.LoopStatements('alternates with')
+    frame = _Frame(None, index=0)
+    context.stack.append(frame)
+    for item in items:
+      if i and alt_statements:
+        _Execute(alt_statements, context, callback, trace)
+      i += 1
+      if item.__class__ is Lazy:
+        item = context._Force(item)
+      frame.context = item
+      frame.index = i
+      if frame.cache:
+        frame.cache = {}
+      _Execute(statements, context, callback, trace)
+    context.stack.pop()
 
-    last_index = len(items) - 1
-    statements = block.Statements()
-    alt_statements = block.Statements('alternates with')
+  if not i:  # missing, false, or no items
+    _Execute(block.Statements('or'), context, callback, trace)
+
+  context.Pop()
+
+
+def _DoInvariantSubstitute(invariant_args, context, callback, trace):
+  """A substitution in a repeated section which doesn't depend on the item.
+
+  If the current item doesn't define the name, the name resolves to the same
+  frame for every item, so the formatted value is kept in the cache of the
+  loop's frame (see _Frame).  Otherwise this is just _DoSubstitute.
+
+  Args:
+    invariant_args: An _InvariantArgs with the args of _DoSubstitute
+  """
+  args = invariant_args.args
+  _, (kind, key), _, _ = args
+  if kind == PATH_LOOKUP:
+    name = key[0]
+  else:
+    name = key
+
+  item = context.stack[-1].context
+  if type(item) is dict:
+    if name in item:
+      _DoSubstitute(args, context, callback, trace)
+      return
+  elif hasattr(item, 'get'):  # same test as _ScopedContext.LookupName
     try:
-      i = 0
-      while True:
-        context.Next()
-        # Execute the statements in the block for every item in the list.
-        # Execute the alternate block on every iteration except the last.  Each
-        # item could be an atom (string, integer, etc.) or a dictionary.
-        _Execute(statements, context, callback, trace)
-        if i != last_index:
-          _Execute(alt_statements, context, callback, trace)
-        i += 1
-    except StopIteration:
+      item[name]
+    except KeyError:
       pass
+    else:
+      _DoSubstitute(args, context, callback, trace)
+      return
 
-  else:
-    _Execute(block.Statements('or'), context, callback, trace)
+  cache = context.stack[-2].cache  # the frame for the list
+  try:
+    value = cache[invariant_args]  # names are strings, so no collision
+  except KeyError:
+    # Errors are raised here, every time, as if it weren't hoisted
+    tokens = []
+    _DoSubstitute(args, context, tokens.append, trace)
+    value, = tokens  # simple formatters write exactly one value
+    cache[invariant_args] = value
+  callback(value)
 
-  context.Pop()
+
+def _Iterate(items):
+  """Returns an iterator over the value of a repeated section.
+
+  Besides lists, any iterable can be repeated over, e.g. a generator or a
+  database cursor.  Strings and dictionaries are iterable too, but repeating
+  over them is surely a mistake.
+
+  Raises:
+    EvaluationError if the value can't be repeated over
+  """
+  if isinstance(items, basestring) or hasattr(items, 'get'):
+    raise EvaluationError('Expected a list; got %s' % type(items))
+  try:
+    return iter(items)
+  except TypeError:
+    raise EvaluationError('Expected a list; got %s' % type(items))
 
 
 def _DoSection(args, context, callback, trace):
   """{.section foo}"""
-  block = args
-  # If a section present and "true", push the dictionary onto the stack as the
-  # new context, and show it
-  if context.PushSection(block.section_name, block.pre_formatters):
-    _Execute(block.Statements(), context, callback, trace)
-    context.Pop()
-  else:  # missing or "false" -- show the {.or} section
-    context.Pop()
-    _Execute(block.Statements('or'), context, callback, trace)
+  for statements in _SectionParts(args, context):
+    _Execute(statements, context, callback, trace)
 
 
 def _DoPredicates(args, context, callback, trace):
@@ -1657,19 +4459,11 @@ def _DoPredicates(args, context, callback, trace):
 
   Here we execute the first clause that evaluates to true, and then stop.
   """
-  block = args
-  value = context.Lookup('@')
-  for (predicate, args, func_type), statements in block.clauses:
-    if func_type == ENHANCED_FUNC:
-      do_clause = predicate(value, context, args)
-    else:
-      do_clause = predicate(value)
-
-    if do_clause:
-      if trace: trace.Push(predicate)
-      _Execute(statements, context, callback, trace)
-      if trace: trace.Pop()
-      break
+  predicate, statements = _ChooseClause(args, context)
+  if statements is not None:
+    if trace: trace.Push(predicate)
+    _Execute(statements, context, callback, trace)
+    if trace: trace.Pop()
 
 
 def _DoDef(args, context, callback, trace):
@@ -1679,65 +4473,165 @@ def _DoDef(args, context, callback, trace):
   # in _DoSubstitute.
 
 
-def _DoSubstitute(args, context, callback, trace):
-  """Variable substitution, i.e. {foo}
+def _FormatterError(name, value, f, e):
+  """Wrap an exception raised by a formatter.
 
-  We also implement template formatters here, i.e.  {foo|template bar} as well
-  as {.template FOO} for templates that operate on the root of the data dict
-  rather than a subtree.
+  Must be called while the exception is being handled, so that sys.exc_info()
+  is still available.
   """
-  name, formatters = args
+  return EvaluationError(
+      'Formatting name %r, value %r with formatter %s raised exception: %r '
+      '-- see e.original_exc_info' % (name, value, f, e),
+      original_exc_info=sys.exc_info())
 
-  if name is None:
-    value = context.Root()  # don't use the cursor
-  else:
-    try:
-      value = context.Lookup(name)
-    except TypeError, e:
-      raise EvaluationError(
-          'Error evaluating %r in context %r: %r' % (name, context, e))
 
-  last_index = len(formatters) - 1
-  for i, (f, args, formatter_type) in enumerate(formatters):
-    try:
-      if formatter_type == TEMPLATE_FORMATTER:
-        template = f.Resolve(context)
-        if i == last_index:
-          # In order to keep less template output in memory, we can just let the
-          # other template write to our callback directly, and then stop.
-          template.execute(value, callback, trace=trace)
-          return  # EARLY RETURN
-        else:
-          # We have more formatters to apply, so explicitly construct 'value'
-          tokens = []
-          template.execute(value, tokens.append, trace=trace)
-          value = JoinTokens(tokens)
+def _FuseFormatters(name, formatters):
+  """Fuse the formatters of a substitution into one function, at compile time.
 
-      elif formatter_type == ENHANCED_FUNC:
-        value = f(value, context, args)
+  The formatters are bound to each other, from the last one to the first, so
+  that no formatter types are dispatched on when the template is expanded.
 
-      elif formatter_type == SIMPLE_FUNC:
-        value = f(value)
+  Args:
+    name: The name being substituted, for error messages
+    formatters: List of (f, args, formatter_type) triples
 
-      else:
-        assert False, 'Invalid formatter type %r' % formatter_type
+  Returns:
+    A function write(value, context, callback, trace), which formats the value
+    and passes the result to callback.
+  """
+  write = None
+  for f, args, formatter_type in reversed(formatters):
+    write = _BindFormatter(name, f, args, formatter_type, write)
+  if write is None:
+    write = _WriteValue(name)
+  return write
+
+
+def _WriteValue(name):
+  """Returns the write() function which passes the formatted value on."""
+  def write(value, context, callback, trace):
+    # TODO: Require a string/unicode instance here?
+    if value is None:
+      raise EvaluationError('Evaluating %r gave None value' % name)
+    callback(value)
+  return write
+
+
+def _BindFormatter(name, f, args, formatter_type, write):
+  """Bind one formatter for _FuseFormatters.
 
+  Like _DoSubstitute used to, this wraps any exception the formatter raises in
+  an EvaluationError, which names the formatter.
+
+  Args:
+    write: The function for the rest of the formatters, or None if this is the
+        last one.
+
+  Returns:
+    A function write(value, context, callback, trace).
+  """
+  if formatter_type == TEMPLATE_FORMATTER:
+    # Exceptions aren't wrapped; in this case we want to see the original
+    # exception.
+    if write is None:
+      # In order to keep less template output in memory, we can just let the
+      # other template write to our callback directly.
+      def bound(value, context, callback, trace):
+        f.Resolve(context)._ExecuteNested(value, context, callback, trace)
+    else:
+      # We have more formatters to apply, so explicitly construct 'value'
+      def bound(value, context, callback, trace):
+        tokens = []
+        f.Resolve(context)._ExecuteNested(
+            value, context, tokens.append, trace)
+        write(JoinTokens(tokens), context, callback, trace)
+    return bound
+
+  apply = _BindFormatterArgs(f, args, formatter_type)
+  if write is None:
+    write = _WriteValue(name)
+
+  def bound(value, context, callback, trace):
+    try:
+      result = apply(value, context)
     except (KeyboardInterrupt, EvaluationError):
       # Don't "wrap" recursive EvaluationErrors
       raise
-
     except Exception, e:
-      if formatter_type == TEMPLATE_FORMATTER:
-        raise  # in this case we want to see the original exception
-      raise EvaluationError(
-          'Formatting name %r, value %r with formatter %s raised exception: %r '
-          '-- see e.original_exc_info' % (name, value, f, e),
-          original_exc_info=sys.exc_info())
+      raise _FormatterError(name, value, f, e)
+    write(result, context, callback, trace)
+
+  return bound
+
+
+def _ComposePreFormatters(pre_formatters):
+  """Compose the pre-formatters of a section into one function.
+
+  Returns:
+    A function pre_format(value, context), or None if there are no
+    pre-formatters.  Exceptions raised by the formatters aren't wrapped.
+  """
+  pre_format = None
+  for f, args, formatter_type in pre_formatters:
+    apply = _BindFormatterArgs(f, args, formatter_type)
+    if pre_format is None:
+      pre_format = apply
+    else:
+      pre_format = _ComposeFunctions(pre_format, apply)
+  return pre_format
 
-  # TODO: Require a string/unicode instance here?
-  if value is None:
-    raise EvaluationError('Evaluating %r gave None value' % name)
-  callback(value)
+
+def _BindFormatterArgs(f, args, formatter_type):
+  """Returns a function apply(value, context) which calls a formatter.
+
+  The arguments are bound once, so the caller doesn't dispatch on the type.
+  """
+  if formatter_type == ENHANCED_FUNC:
+    return _BindEnhancedFunc(f, args)
+  elif formatter_type == SIMPLE_FUNC:
+    return _BindSimpleFunc(f)
+  else:
+    raise AssertionError('Invalid formatter type %r' % formatter_type)
+
+
+def _BindSimpleFunc(f):
+  return lambda value, context: f(value)
+
+
+def _BindEnhancedFunc(f, args):
+  return lambda value, context: f(value, context, args)
+
+
+def _ComposeFunctions(first, second):
+  return lambda value, context: second(first(value, context), context)
+
+
+def _DoSubstitute(args, context, callback, trace):
+  """Variable substitution, i.e. {foo}
+
+  We also implement template formatters here, i.e.  {foo|template bar} as well
+  as {.template FOO} for templates that operate on the root of the data dict
+  rather than a subtree.
+  """
+  name, lookup, _, write = args
+
+  kind, key = lookup
+  try:
+    # The kind of lookup was resolved at compile time; see _ResolveName
+    if kind == NAME_LOOKUP:
+      value = context.LookupName(key)
+    elif kind == CURSOR_LOOKUP:
+      value = context.stack[-1].context
+    elif kind == ROOT_LOOKUP:
+      value = context.Root()  # don't use the cursor
+    else:
+      value = context.LookupResolved(lookup)
+  except TypeError, e:
+    raise EvaluationError(
+        'Error evaluating %r in context %r: %r' % (name, context, e))
+
+  # The formatters were fused into one function at compile time
+  write(value, context, callback, trace)
 
 
 def _Execute(statements, context, callback, trace):
@@ -1770,6 +4664,348 @@ def _Execute(statements, context, callback, trace):
         raise
 
 
+def _Stream(statements, context):
+  """Like _Execute, but a generator which yields tokens as they're expanded.
+
+  This is the engine for Template.tokenstream().  Sections are expanded by
+  generators too, so that the output of a long repeated section is yielded as
+  it's expanded.  The other statements are executed by _Execute's functions,
+  into a list.
+  """
+  for i, statement in enumerate(statements):
+    if isinstance(statement, basestring):
+      yield statement
+      continue
+
+    func, args = statement
+    stream = _STREAM_FUNCS.get(func)
+    try:
+      if stream:
+        tokens = stream(args, context)
+      else:
+        tokens = []
+        func(args, context, tokens.append, None)
+      for token in tokens:
+        yield token
+    except UndefinedVariable, e:
+      # Show context for statements, like _Execute
+      start = max(0, i-3)
+      end = i+3
+      e.near = statements[start:end]
+      e.trace = None
+      raise
+
+
+def _StreamSubstitute(args, context):
+  """Like _DoSubstitute, but streams a template which is the last formatter."""
+  name, lookup, formatters, _ = args
+  if not formatters or formatters[-1][2] != TEMPLATE_FORMATTER:
+    tokens = []
+    _DoSubstitute(args, context, tokens.append, None)
+    return tokens
+
+  # Apply the other formatters to the value, and then stream the template
+  values = []
+
+  def capture(value, unused_context, unused_callback, unused_trace):
+    values.append(value)
+
+  write = capture
+  for f, f_args, formatter_type in reversed(formatters[:-1]):
+    write = _BindFormatter(name, f, f_args, formatter_type, write)
+  _DoSubstitute((name, lookup, formatters[:-1], write), context, None, None)
+  ref = formatters[-1][0]
+  return ref.Resolve(context)._Stream(values[0])
+
+
+def _StreamParts(parts, context):
+  """Streams the statement lists which a section's generator yields."""
+  for statements in parts:
+    for token in _Stream(statements, context):
+      yield token
+
+
+def _StreamSection(block, context):
+  """Like _DoSection."""
+  return _StreamParts(_SectionParts(block, context), context)
+
+
+def _StreamRepeatedSection(block, context):
+  """Like _DoRepeatedSection."""
+  return _StreamParts(_RepeatedSectionParts(block, context), context)
+
+
+def _StreamPredicates(block, context):
+  """Like _DoPredicates."""
+  _, statements = _ChooseClause(block, context)
+  if statements is None:
+    return []
+  return _Stream(statements, context)
+
+
+_STREAM_FUNCS = {
+    _DoSubstitute: _StreamSubstitute,
+    _DoSection: _StreamSection,
+    _DoRepeatedSection: _StreamRepeatedSection,
+    _DoPredicates: _StreamPredicates,
+    }
+
+
+def _Chunks(tokens, chunk_size):
+  """Join tokens into chunks of at least chunk_size characters."""
+  chunk = []
+  size = 0
+  for token in tokens:
+    chunk.append(token)
+    size += len(token)
+    if size >= chunk_size:
+      yield JoinTokens(chunk)
+      chunk = []
+      size = 0
+  if chunk:
+    yield JoinTokens(chunk)
+
+
+class _CodeGenerator(object):
+  """Turns a _Section tree into a native Python function (backend='codegen').
+
+  _Execute is the reference engine; this is an alternative which walks the tree
+  once at compile time instead of at every expansion.  Literals are inlined,
+  and lookups, formatter calls and repeated sections are emitted directly as
+  Python code.
+
+  Each section becomes its own Python function, so deeply nested templates
+  don't run into Python's limits on nested blocks.  Objects which can't be
+  written as literals (formatters, arguments, etc.) are passed in through the
+  namespace the generated source is exec'd in.
+  """
+
+  def __init__(self):
+    self.namespace = {
+        'EvaluationError': EvaluationError,
+        'UndefinedVariable': UndefinedVariable,
+        'JoinTokens': JoinTokens,
+        '_Frame': _Frame,
+        '_Iterate': _Iterate,
+        'Lazy': Lazy,
+        '_FormatterError': _FormatterError,
+        }
+    self.functions = []  # list of lists of lines
+    self.num_names = 0
+
+  def _NewName(self, prefix):
+    self.num_names += 1
+    return '%s%d' % (prefix, self.num_names)
+
+  def _Const(self, obj):
+    """Make an object available to the generated code, returning its name."""
+    name = self._NewName('_c')
+    self.namespace[name] = obj
+    return name
+
+  def _NewFunction(self):
+    name = self._NewName('_s')
+    lines = ['def %s(context, callback, trace):' % name,
+             '  lookup_name = context.LookupName']
+    self.functions.append(lines)
+    return name, lines
+
+  def _Substitute(self, args, lines, indent):
+    name, (kind, key), formatters, _ = args
+    pad = ' ' * indent
+
+    if kind == ROOT_LOOKUP:
+      lines.append(pad + 'value = context.Root()')
+    elif kind == CURSOR_LOOKUP:
+      lines.append(pad + 'value = context.stack[-1].context')
+    else:
+      if kind == NAME_LOOKUP:
+        expr = 'lookup_name(%r)' % key
+      elif kind == PATH_LOOKUP:
+        expr = 'context.LookupPath(%r)' % (key,)
+      elif kind == INDEX_LOOKUP:
+        expr = 'context.LookupIndex()'
+      else:
+        raise AssertionError('Invalid lookup kind %r' % kind)
+      lines.extend([
+          pad + 'try:',
+          pad + '  value = %s' % expr,
+          pad + 'except TypeError, e:',
+          pad + '  raise EvaluationError(',
+          pad + "      'Error evaluating %%r in context %%r: %%r' %% "
+                '(%r, context, e))' % name,
+          ])
+
+    last_index = len(formatters) - 1
+    for i, (f, args, formatter_type) in enumerate(formatters):
+      f_name = self._Const(f)
+      if formatter_type == TEMPLATE_FORMATTER:
+        # Same as _DoSubstitute: exceptions propagate unwrapped
+        if i == last_index:
+          lines.append(
+              pad + '%s.Resolve(context)._ExecuteNested(value, context, '
+                    'callback, trace)' % f_name)
+          return  # the other template writes to our callback
+        lines.extend([
+            pad + 'tokens = []',
+            pad + '%s.Resolve(context)._ExecuteNested(value, context, '
+                  'tokens.append, trace)' % f_name,
+            pad + 'value = JoinTokens(tokens)',
+            ])
+        continue
+
+      if formatter_type == ENHANCED_FUNC:
+        call = '%s(value, context, %s)' % (f_name, self._Const(args))
+      elif formatter_type == SIMPLE_FUNC:
+        call = '%s(value)' % f_name
+      else:
+        raise AssertionError('Invalid formatter type %r' % formatter_type)
+      lines.extend([
+          pad + 'try:',
+          pad + '  value = %s' % call,
+          pad + 'except (KeyboardInterrupt, EvaluationError):',
+          pad + '  raise',
+          pad + 'except Exception, e:',
+          pad + '  raise _FormatterError(%r, value, %s, e)' % (name, f_name),
+          ])
+
+    lines.extend([
+        pad + 'if value is None:',
+        pad + '  raise EvaluationError(%r)' % (
+            'Evaluating %r gave None value' % name),
+        pad + 'callback(value)',
+        ])
+
+  def _Section(self, block):
+    func_name, lines = self._NewFunction()
+    lines.append('  if context.PushResolvedSection(%r, %s):' % (
+        block.lookup, self._Const(block.pre_format)))
+    self._Statements(block.Statements(), lines, 4)
+    lines.extend([
+        '    context.Pop()',
+        '  else:',
+        '    context.Pop()',
+        ])
+    self._Statements(block.Statements('or'), lines, 4)
+    return func_name
+
+  def _RepeatedSection(self, block):
+    func_name, lines = self._NewFunction()
+    lines.extend([
+        '  items = context.PushResolvedSection(%r, %s)' % (
+            block.lookup, self._Const(block.pre_format)),
+        '  i = 0',
+        '  if items:',
+        '    if not isinstance(items, list):',
+        '      items = _Iterate(items)',
+        # Like _DoRepeatedSection
+        '    frame = _Frame(None, index=0)',
+        '    context.stack.append(frame)',
+        '    for item in items:',
+        ])
+    alt_statements = block.LoopStatements('alternates with')
+    if alt_statements:
+      lines.append('      if i:')
+      self._Statements(alt_statements, lines, 8)
+    lines.extend([
+        '      i += 1',
+        '      if item.__class__ is Lazy:',
+        '        item = context._Force(item)',
+        '      frame.context = item',
+        '      frame.index = i',  # @index is 1-based
+        '      if frame.cache:',
+        '        frame.cache = {}',
+        ])
+    self._Statements(block.LoopStatements(), lines, 6)
+    lines.extend([
+        '    context.stack.pop()',
+        '  if not i:',
+        ])
+    self._Statements(block.Statements('or'), lines, 4)
+    lines.append('  context.Pop()')
+    return func_name
+
+  def _Predicates(self, block):
+    func_name, lines = self._NewFunction()
+    lines.append('  cursor = context.stack[-1].context')
+    keyword = 'if'
+    for (predicate, args, func_type), statements in block.clauses:
+      if func_type == ENHANCED_FUNC:
+        test = '%s(cursor, context, %s)' % (
+            self._Const(predicate), self._Const(args))
+      else:
+        test = '%s(cursor)' % self._Const(predicate)
+      lines.append('  %s %s:' % (keyword, test))
+      self._Statements(statements, lines, 4)
+      keyword = 'elif'
+    return func_name
+
+  def _Statements(self, statements, lines, indent, top_level=False):
+    """Emit code for a list of statements.
+
+    Args:
+      top_level: If True, keep track of the index of the statement being
+          executed, so UndefinedVariable can show some context like _Execute
+          does.  (Only the outermost _Execute's value is visible to callers.)
+    """
+    pad = ' ' * indent
+    num_lines = len(lines)
+    for i, statement in enumerate(statements):
+      if isinstance(statement, basestring):
+        lines.append(pad + 'callback(%r)' % statement)
+        continue
+
+      func, args = statement
+      if func is _DoDef:
+        continue  # see _DoDef
+      if top_level:
+        lines.append(pad + 'i = %d' % i)
+
+      if func is _DoSubstitute:
+        self._Substitute(args, lines, indent)
+        continue
+      if func is _DoSection:
+        func_name = self._Section(args)
+      elif func is _DoRepeatedSection:
+        func_name = self._RepeatedSection(args)
+      elif func is _DoPredicates:
+        func_name = self._Predicates(args)
+      else:
+        # Something we don't know how to compile; call it like _Execute does.
+        lines.append(pad + '%s(%s, context, callback, trace)' % (
+            self._Const(func), self._Const(args)))
+        continue
+      lines.append(pad + '%s(context, callback, trace)' % func_name)
+
+    if len(lines) == num_lines:
+      lines.append(pad + 'pass')
+
+  def Compile(self, root_section):
+    """
+    Returns:
+      A function (context, callback, trace) which behaves like calling _Execute
+      on the root section's statements.
+    """
+    statements = root_section.Statements()
+    func_name, lines = self._NewFunction()
+    lines.extend([
+        '  i = 0',
+        '  try:',
+        ])
+    self._Statements(statements, lines, 4, top_level=True)
+    lines.extend([
+        '  except UndefinedVariable, e:',
+        '    e.near = %s[max(0, i-3):i+3]' % self._Const(statements),
+        '    e.trace = trace',
+        '    raise',
+        ])
+
+    source = '\n'.join('\n'.join(lines) for lines in self.functions) + '\n'
+    code = compile(source, '<jsontemplate codegen>', 'exec')
+    exec code in self.namespace
+    return self.namespace[func_name]
+
+
 def expand(template_str, dictionary, **kwargs):
   """Free function to expands a template string with a data dictionary.
 
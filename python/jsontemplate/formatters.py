@@ -62,9 +62,9 @@ def PythonPercentFormat(format_str):
 # Seam for testing
 _open = open
 
-# Cache of compiled templates.  In Java, this might need to be a
-# ConcurrentHashMap like the tokenization regex cache.
-_compiled_template_cache = {}
+# Cache of compiled templates, shared by TemplateFileInclude instances.  In
+# Java, this might be a ConcurrentHashMap like the tokenization regex cache.
+_compiled_template_cache = jsontemplate.LruCache(max_entries=1000)
 
 
 class TemplateFileInclude(object):
@@ -73,8 +73,19 @@ class TemplateFileInclude(object):
   The relative path is specified as an argument to the template.
   """
 
-  def __init__(self, root_dir):
+  def __init__(self, root_dir, compile_cache=None, cache=None):
+    """
+    Args:
+      root_dir: The directory that template paths are relative to
+      compile_cache: An optional jsontemplate.CompiledTemplateCache, so that
+          included templates are compiled once across processes too.
+      cache: An optional jsontemplate.LruCache for the compiled templates, e.g.
+          with other limits, or to look at its stats().  By default, a cache of
+          1000 templates shared by all instances is used.
+    """
     self.root_dir = root_dir
+    self.compile_cache = compile_cache
+    self.cache = cache
 
   def __call__(self, format_str):
     """Returns a formatter function."""
@@ -83,12 +94,19 @@ class TemplateFileInclude(object):
       relative_path = format_str[len('template-file '):]
       full_path = os.path.join(self.root_dir, relative_path)
 
-      if full_path not in _compiled_template_cache:
+      cache = self.cache
+      if cache is None:
+        cache = _compiled_template_cache
+
+      # Two threads may both compile a template, which is harmless
+      template = cache.get(full_path)
+      if template is None:
         f = _open(full_path)
-        _compiled_template_cache[full_path] = jsontemplate.FromFile(f)
+        template = jsontemplate.FromFile(f, compile_cache=self.compile_cache)
         f.close()
+        cache[full_path] = template
 
-      return _compiled_template_cache[full_path].expand  # a 'bound method'
+      return template.expand  # a 'bound method'
 
     else:
       return None  # this lookup is not applicable
@@ -98,6 +98,23 @@ class FormattersTest(taste.Test):
     # once
     self.verify.Equal(formatters._open.open_count, 1)
 
+  def testTemplateIncludeCache(self):
+    cache = jsontemplate.LruCache(max_entries=10)
+    include_formatter = formatters.TemplateFileInclude(
+        os.path.join(os.path.dirname(__file__), 'testdata'), cache=cache)
+    t = jsontemplate.Template(
+        self.include_template, more_formatters=include_formatter)
+
+    d = {'profile': {'name': 'Bob', 'age': 13}}
+    self.verify.Equal(t.expand(d), 'Bob is 13\n')
+    jsontemplate.Template(
+        self.include_template, more_formatters=include_formatter)
+
+    self.verify.Equal(formatters._open.open_count, 1)
+    self.verify.Equal(len(formatters._compiled_template_cache), 0)
+    self.verify.Equal(cache.stats()['misses'], 1)
+    self.verify.Equal(cache.stats()['hits'], 1)
+
   def testLookupChain(self):
     chained = formatters.LookupChain([
         formatters.PythonPercentFormat,
@@ -6,8 +6,12 @@ jsontemplate_unittest.py
 __author__ = 'Andy Chu'
 
 
+import marshal
 import os
+import pickle
+import shutil
 import sys
+import tempfile
 try:
   import json
 except ImportError:
@@ -75,6 +79,37 @@ text
                             {'foo': ['a', 'b', 'c']})
     self.verify.Equal('{ .repeated section foo}', s)  # ignored
 
+  def testSameAsTokenizeLines(self):
+
+    def Normalize(tokens):
+      # Literal text may be split into tokens differently
+      result = []
+      for token_type, token in tokens:
+        if token_type == jsontemplate.LITERAL_TOKEN:
+          if not token:
+            continue
+          if result and result[-1][0] == jsontemplate.LITERAL_TOKEN:
+            result[-1] = (token_type, result[-1][1] + token)
+            continue
+        result.append((token_type, token))
+      return result
+
+    templates = [
+        'a {b} c\n',
+        '  {.section foo}  \n  {bar}\n  {.end}\n',
+        '{# comment}\nx {# inline}\n  {.or}\r\n\r\n',
+        'a\n {.OPTION strip-line}\n  b {c}  \n {.END}\n  d  \n',
+        '{##BEGIN}\n{a}\n{##END}\n{.repeated section a}{@}{.end}',
+        u'  {.end}\u2028 \xe9 {.space}\x85\u2029 {.end} \x1c',
+        '{ a}\n{.meta-left}{.meta-right}{.newline}',
+        ]
+    for template_str in templates:
+      for whitespace in ('smart', 'strip-line'):
+        expected = jsontemplate._TokenizeLines(
+            template_str, '{', '}', whitespace)
+        actual = jsontemplate._Tokenize(template_str, '{', '}', whitespace)
+        self.verify.Equal(Normalize(expected), Normalize(actual))
+
   def testSectionRegex(self):
 
     # Section names are required
@@ -171,6 +206,64 @@ class ScopedContextTest(taste.Test):
     s = jsontemplate._ScopedContext([], '')
     self.verify.Raises(StopIteration, s.Next)
 
+  def testResolveName(self):
+    self.verify.Equal(
+        jsontemplate._ResolveName('@'), (jsontemplate.CURSOR_LOOKUP, None))
+    self.verify.Equal(
+        jsontemplate._ResolveName('@index'), (jsontemplate.INDEX_LOOKUP, None))
+    self.verify.Equal(
+        jsontemplate._ResolveName('foo'), (jsontemplate.NAME_LOOKUP, 'foo'))
+    self.verify.Equal(
+        jsontemplate._ResolveName('foo.bar'),
+        (jsontemplate.PATH_LOOKUP, ('foo', 'bar')))
+
+    # Sections don't search the stack or split names
+    self.verify.Equal(
+        jsontemplate._ResolveSectionName('foo.bar'),
+        (jsontemplate.NAME_LOOKUP, 'foo.bar'))
+
+  def testLookupResolved(self):
+    data = {'foo': [{'bar': 1}, {'bar': 2}], 'baz': {'a': 'b'}}
+    s = jsontemplate._ScopedContext(data, 'UNDEFINED')
+    s.PushSection('foo', [])
+    s.Next()
+    s.Next()
+
+    # Each resolved lookup gives the same value as the dynamic Lookup()
+    for name in ('@', '@index', 'bar', 'baz', 'baz.a', 'baz.x', 'x', 'x.y',
+                 '@index.foo', 'bar.@index'):
+      self.verify.Equal(
+          s.LookupResolved(jsontemplate._ResolveName(name)), s.Lookup(name))
+    self.verify.Equal(s.Lookup('@index'), 2)
+    self.verify.Equal(s.Lookup('bar'), 2)
+    self.verify.Equal(s.Lookup('baz.a'), 'b')
+    self.verify.Equal(s.Lookup('x.y'), 'UNDEFINED')
+
+  def testLookupCache(self):
+    data = {'a': 0, 'rows': [{'a': 1}, {}, {'a': 3}]}
+    s = jsontemplate._ScopedContext(data, None)
+    s.PushSection('rows', [])
+    values = []
+    while True:
+      try:
+        s.Next()
+      except StopIteration:
+        break
+      values.append(s.Lookup('a'))
+    self.verify.Equal(values, [1, 0, 3])
+    self.verify.Equal(s.stack[-1].cache, {'a': 0})  # the frame for the list
+
+    # The cache of a repeated section's item is cleared for the next item
+    template_str = (
+        '{.repeated section rows}{.section inner}{a}{b.c}{.end}{.end}')
+    data = {'rows': [{'a': 1, 'b': {'c': 'x'}, 'inner': {'d': 1}},
+                     {'a': 2, 'inner': {'d': 2}},
+                     {'a': 3, 'inner': {'b': {'c': 'z'}}}],
+            'b': {'c': 'y'}}
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(template_str, backend=backend)
+      self.verify.Equal(t.expand(data), '1x2y3z')
+
 
 class InternalTemplateTest(taste.Test):
   """Tests that can only be run internally."""
@@ -189,6 +282,162 @@ class InternalTemplateTest(taste.Test):
         """))
     self.verify.Equal('There are 5 ways to do it\n', t.expand({'num': 5L}))
 
+  def testHtmlEscaping(self):
+    import cgi
+    values = [
+        '', 'plain', '<b>"Tom" & \'Jerry\'</b>', '&&', u'\xe9 < \u2028',
+        '<' * 300, 'x' * 300, 5, -2.5, True, None, ['<'],
+        ]
+    for value in values:
+      s = value
+      if not isinstance(s, basestring):
+        s = str(s)
+      self.verify.Equal(jsontemplate._Html(value), cgi.escape(s))
+      self.verify.Equal(
+          jsontemplate._HtmlAttrValue(value),
+          cgi.escape(s, quote=True).replace("'", '&#39;'))
+
+    t = jsontemplate.Template('{@|plain-url}')
+    self.verify.Equal(
+        t.expand('http://x/?a="1"&b=2'),
+        '<a href="http://x/?a=&quot;1&quot;&amp;b=2">'
+        'http://x/?a="1"&amp;b=2</a>')
+
+  def testToString(self):
+    import pprint
+
+    class Celsius(int):
+      def __repr__(self):
+        return '%d C' % self
+
+    values = [
+        5, -12345678901234567890L, 5L, 2.5, 0.1, 1e100, True, False, Celsius(3),
+        [1, 2], {'a': 1}, (1,),
+        ]
+    for value in values:
+      self.verify.Equal(jsontemplate._ToString(value), pprint.pformat(value))
+    self.verify.Equal(jsontemplate._ToString(None), 'null')
+    self.verify.Equal(jsontemplate._ToString(u'\xe9'), u'\xe9')
+
+  def testAutoescape(self):
+    data = {'x': '<b>"A" & \'B\'</b>', 'n': 3L, 'q': u'caf\xe9 & co',
+            'url': 'javascript:alert(1)', 'items': [1, 'a</script>', None]}
+    expand = lambda s: jsontemplate.Template(s, autoescape='html').expand(data)
+
+    # Text, attribute values, and comments
+    self.verify.Equal(
+        expand('<p title="{x}">{x} {n}</p><!-- {x} -->'),
+        '<p title="&lt;b&gt;&quot;A&quot; &amp; &#39;B&#39;&lt;/b&gt;">'
+        '&lt;b&gt;"A" &amp; \'B\'&lt;/b&gt; 3L</p>'
+        '<!-- &lt;b&gt;"A" &amp; \'B\'&lt;/b&gt; -->')
+
+    # URL attributes
+    self.verify.Equal(
+        expand('<a href="{url}">'), '<a href="#">')
+    t = jsontemplate.Template('<a href="{url}">', autoescape='html')
+    for url in [
+        'java\nscript:alert(1)', 'jav\tascript:alert(1)', ' JavaScript:x',
+        '\x01javascript:alert(1)', u'\x00data:text/html,x', 'foo bar:x']:
+      self.verify.Equal(t.expand(url=url), '<a href="#">')
+    for url in ['HTTPS://x/', '/a:b', '?a:b', 'x#a:b', 'mailto:a@b.c']:
+      self.verify.Equal(t.expand(url=url), '<a href="%s">' % url)
+    self.verify.Equal(
+        expand("<a href='/users/{q}?q={q}&amp;x={x}'>"),
+        "<a href='/users/caf%C3%A9%20%26%20co?q=caf%C3%A9+%26+co&amp;"
+        "x=%3Cb%3E%22A%22+%26+%27B%27%3C%2Fb%3E'>")
+
+    # Scripts, in and out of strings
+    self.verify.Equal(
+        expand('<script>var a = {items}, b = "{x}";</script>{x}'),
+        '<script>var a = [1,"a\\u003c\\u002fscript\\u003e",null], '
+        'b = "\\u003cb\\u003e\\u0022A\\u0022 \\u0026 \\u0027B\\u0027'
+        '\\u003c\\u002fb\\u003e";</script>'
+        '&lt;b&gt;"A" &amp; \'B\'&lt;/b&gt;')
+
+    # Event handlers are JavaScript in an attribute value, and character
+    # references are decoded before it runs
+    self.verify.Equal(
+        expand('<a onclick="f({x}, \'{n}\', &quot;{n}&quot;)">'),
+        '<a onclick="f(&quot;\\u003cb\\u003e\\u0022A\\u0022 \\u0026 '
+        '\\u0027B\\u0027\\u003c\\u002fb\\u003e&quot;, \'3L\', &quot;3L&quot;)">')
+
+    # The value of a style attribute can't be escaped, and srcset has URLs
+    self.verify.Raises(
+        jsontemplate.MissingFormatter,
+        jsontemplate.Template, '<p style="color: {x}">', autoescape='html')
+    self.verify.Equal(
+        expand('<img srcset="{url} 2x">'), '<img srcset="# 2x">')
+
+    # Regular expression literals, told apart from division
+    self.verify.Equal(
+        expand("<script>var r = /'/, s = {n}, t = /[/{n}]/;</script>"),
+        "<script>var r = /'/, s = 3, t = /[/3L]/;</script>")
+    self.verify.Equal(
+        expand('<script>var a = (b + 1) / 2 / {n}, c = "{n}";</script>'),
+        '<script>var a = (b + 1) / 2 / 3, c = "3L";</script>')
+    self.verify.Equal(
+        expand('<script>if (x) return /{url}/.test(y);</script>'),
+        '<script>if (x) return /javascript:alert(1)/.test(y);</script>')
+
+    # Template literals are strings, but a ${} substitution in one is code which
+    # isn't followed
+    t = jsontemplate.Template('<script>s = `{x}`, t = `${x}`;</script>',
+                              autoescape='html')
+    self.verify.Equal(
+        t.expand(x='${alert(1)}'),
+        '<script>s = `\\u0024\\u007balert(1)}`, '
+        't = `$\\u0024\\u007balert(1)}`;</script>')
+    self.verify.Raises(
+        jsontemplate.MissingFormatter,
+        jsontemplate.Template,
+        "<script>s = `${.meta-left}a{.meta-right}`; f({n});</script>",
+        autoescape='html')
+
+    # Explicit escapers aren't doubled
+    self.verify.Equal(
+        expand('<p>{x|html}{x|raw}{x|upper}</p>'),
+        '<p>&lt;b&gt;"A" &amp; \'B\'&lt;/b&gt;<b>"A" & \'B\'</b>'
+        '&lt;B&gt;"A" &amp; \'B\'&lt;/B&gt;</p>')
+
+    # ... but they have to fit the context
+    self.verify.Equal(
+        expand('<a title="{x|htmltag}" href="/?q={x|url-param-value}">'),
+        '<a title="&lt;b&gt;&quot;A&quot; &amp; &#39;B&#39;&lt;/b&gt;" '
+        'href="/?q=%3Cb%3E%22A%22+%26+%27B%27%3C%2Fb%3E">')
+    for s in ['<script>{x|html}</script>', '<a href="{url|html-attr-value}">',
+              '<p title="{x|html}">', '<script>f({x|json})</script>']:
+      self.verify.Raises(
+          jsontemplate.MissingFormatter,
+          jsontemplate.Template, s, autoescape='html')
+
+    # {.or} starts in the context of its section
+    self.verify.Equal(
+        expand('{.section x}<i title="{x}">{.or}<i>{x}{.end}</i>'),
+        '<i title="&lt;b&gt;&quot;A&quot; &amp; &#39;B&#39;&lt;/b&gt;"></i>')
+
+    # Single-quoted attribute values can't be ended by the value
+    self.verify.Equal(
+        jsontemplate.Template("<a title='{x}'>", autoescape='html').expand(
+            x="' onmouseover='alert(1)"),
+        "<a title='&#39; onmouseover=&#39;alert(1)'>")
+
+    # A value inside a tag can't be escaped
+    self.verify.Raises(
+        jsontemplate.MissingFormatter,
+        jsontemplate.Template, '<input {x}>', autoescape='html')
+    t = jsontemplate.Template('<input {x|raw}>', autoescape='html')
+    self.verify.Equal(t.expand(x='checked'), '<input checked>')
+
+    # The escaper replaces the 'str' formatter
+    t = jsontemplate.Template('<p>{x}</p>', autoescape='html')
+    func, args = t._program.Statements()[1]
+    self.verify.Equal(args[2], [(jsontemplate._EscapeText, None, 0)])
+
+    t = jsontemplate.FromString('autoescape: html\n\n<p>{x}</p>')
+    t = pickle.loads(pickle.dumps(t))
+    self.verify.Equal(
+        t.expand(data), '<p>&lt;b&gt;"A" &amp; \'B\'&lt;/b&gt;</p>')
+
   def testMultipleFormatters(self):
     # TODO: This could have a version in the external test too, just not with
     # 'url-params', which is not the same across platforms because of dictionary
@@ -379,6 +628,254 @@ class InternalTemplateTest(taste.Test):
         """),
         t.expand(d))
 
+  def testRepeatedSectionOverIterables(self):
+    template_str = (
+        '{.repeated section items}{@index}{@}{.alternates with},{.or}none{.end}')
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(template_str, backend=backend)
+      log = []
+
+      def Items():
+        for item in 'abc':
+          log.append('next')
+          yield item
+
+      # The generator is consumed as the items are expanded
+      t.execute({'items': Items()}, log.append)
+      self.verify.Equal(
+          log,
+          ['next', '1', 'a', 'next', ',', '2', 'b', 'next', ',', '3', 'c'])
+
+      self.verify.Equal(t.expand(items=('a', 'b')), '1a,2b')
+      self.verify.Equal(t.expand(items=iter([])), 'none')
+      self.verify.Equal(t.expand(items=xrange(1, 3)), '11,22')
+      for items in ('abc', {'a': 1}, 5):
+        self.verify.Raises(jsontemplate.EvaluationError, t.expand, items=items)
+
+  def testOutputEncoding(self):
+    template_str = u'\xe9 {a} {.section b}{@}{.end}{.define T}\u2603{.end}'
+    data = {'a': u'\xe0', 'b': '\xc3\xa8'}  # a unicode and a utf-8 value
+
+    # Without output_encoding, tokens are decoded and joined
+    t = jsontemplate.Template(template_str)
+    self.verify.Equal(t.expand(data), u'\xe9 \xe0 \xe8')
+    self.verify.Equal(t.expand_bytes(data), '\xc3\xa9 \xc3\xa0 \xc3\xa8')
+
+    # A byte string template with UTF-8 literals, expanded with non-ASCII
+    # unicode data, gives unicode.  (It used to raise UnicodeEncodeError.)
+    t = jsontemplate.Template('\xc3\xa9 {a}')
+    self.verify.Equal(t.expand(data), u'\xe9 \xe0')
+    self.verify.Equal(
+        jsontemplate.JoinTokens([u'', '\xc3\xa9', u'\xe0']), u'\xe9\xe0')
+
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          template_str, output_encoding='utf-8', backend=backend)
+      # Literals are encoded at compile time
+      self.verify.Equal(t._program.Statements()[0], '\xc3\xa9 ')
+      self.verify.Equal(t.expand(data), '\xc3\xa9 \xc3\xa0 \xc3\xa8')
+      self.verify.Equal(t.expand_bytes(data), '\xc3\xa9 \xc3\xa0 \xc3\xa8')
+      self.verify.Equal(
+          ''.join(t.tokenstream(data)), '\xc3\xa9 \xc3\xa0 \xc3\xa8')
+      self.verify.Equal(t.group['T'].expand({}), '\xe2\x98\x83')
+
+    t = jsontemplate.Template(u'\xe9{a}', output_encoding='latin-1')
+    self.verify.Equal(t.expand_bytes(a=u'\xe0'), '\xe9\xe0')
+    t = pickle.loads(pickle.dumps(t))
+    self.verify.Equal(t.expand_bytes(a=u'\xe0'), '\xe9\xe0')
+
+  def testExpandWithFutures(self):
+    log = []
+
+    class Future(object):
+      """Like a concurrent.futures.Future."""
+
+      def __init__(self, value, done=True):
+        self.value = value
+        self.is_done = done
+
+      def __repr__(self):
+        return '<Future>'
+
+      def done(self):
+        return self.is_done
+
+      def result(self):
+        if not self.is_done:
+          log.append('wait %s' % self.value)
+          self.is_done = True
+        return self.value
+
+    template_str = (
+        '{title} {user.name}: '
+        '{.repeated section items}{@}{.end} {.section more}{@}{.end}')
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(template_str, backend=backend)
+      del log[:]
+      data = {
+          'title': Future('T'),
+          'user': Future({'name': Future('bob')}),
+          'items': Future([Future(1), 2, Future(3)]),
+          'more': Future('slow', done=False),
+          }
+      self.verify.Equal(t.expand_with_futures(data), 'T bob: 123 slow')
+
+      # The output so far is flushed before waiting for 'more'
+      def write(token):
+        log.append(token)
+      sink = jsontemplate.BufferedSink(write)
+      data['more'] = Future('slow', done=False)
+      del log[:]
+      t.execute_with_futures(data, sink)
+      self.verify.Equal(log, ['T bob: 123 ', 'wait slow', 'slow'])
+
+      # Other templates wait for the futures in their data too
+      row = jsontemplate.Template('<{name}>', backend=backend)
+      table = jsontemplate.Template(
+          '{.repeated section rows}{@|template ROW}{.end}', backend=backend)
+      jsontemplate.MakeTemplateGroup({'ROW': row, 'TABLE': table})
+      rows = [{'name': Future('a')}, {'name': Future('b', done=False)}]
+      self.verify.Equal(table.expand_with_futures({'rows': rows}), '<a><b>')
+
+    # prefetch() waits for the futures the template can reach, in waves
+    t = jsontemplate.Template(template_str)
+    data = {
+        'title': 'T',
+        'user': Future({'name': Future('bob', done=False)}, done=False),
+        'items': [Future(1, done=False), 2],
+        'more': Future('slow', done=False),
+        'unused': Future('x', done=False),
+        }
+    del log[:]
+    prefetched = t.prefetch(data)
+    self.verify.Equal(
+        sorted(log[:3]), ['wait 1', 'wait slow', "wait {'name': <Future>}"])
+    self.verify.Equal(log[3:], ['wait bob'])
+    self.verify.Equal(t.expand(prefetched), 'T bob: 12 slow')
+
+    # Unreferenced futures are left alone, and the data isn't modified
+    self.verify.Equal(prefetched['unused'], data['unused'])
+    self.verify.IsTrue(isinstance(data['user'], Future))
+    self.verify.IsTrue(isinstance(data['items'][0], Future))
+
+  def testLazyValues(self):
+    calls = []
+
+    def Value(name, value):
+      def func():
+        calls.append(name)
+        return value
+      return jsontemplate.Lazy(func)
+
+    template_str = (
+        '{.section show}{expensive}{.end}'
+        '{.repeated section rows}{a} {user.name}{.alternates with}, {.end}'
+        '{.if test flag}yes{.end}')
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(template_str, backend=backend)
+      data = {
+          'show': Value('show', False),
+          'expensive': Value('expensive', 'x'),
+          'user': Value('user', {'name': Value('name', 'bob')}),
+          'rows': Value('rows', [{'a': Value('a1', 1)}, {'a': 2}]),
+          'flag': Value('flag', True),
+          }
+      del calls[:]
+      self.verify.Equal(t.expand(data), '1 bob, 2 bobyes')
+      # Each function is called once, and 'expensive' isn't used
+      self.verify.Equal(
+          sorted(calls), ['a1', 'flag', 'name', 'rows', 'show', 'user'])
+
+      # The values aren't kept between expansions
+      del calls[:]
+      t.expand(data)
+      self.verify.Equal(len(calls), 6)
+
+      # Items of a repeated section, which are reached through the cursor
+      t = jsontemplate.Template(
+          '{.repeated section xs}{@}{.end} {.repeated section ys}{a}{.end}',
+          backend=backend)
+      self.verify.Equal(
+          t.expand(xs=[Value('x', 'b')], ys=[Value('y', {'a': 'c'})]), 'b c')
+
+  def testTokenstream(self):
+    t = jsontemplate.Template(B("""
+        {.define ITEM}<li>{@|html}</li>{.end}
+        <ul>
+        {.repeated section items}{@|upper|template ITEM}{.or}none{.end}
+        </ul>
+        """), more_formatters={'upper': lambda x: x.upper()})
+    log = []
+
+    def Items():
+      for item in ('a', '<b>'):
+        log.append('next')
+        yield item
+
+    # Nothing is expanded until the tokens are consumed, and the output of
+    # sections and other templates is yielded as it's expanded
+    for token in t.tokenstream({'items': Items()}):
+      log.append(token)
+    self.verify.Equal(
+        log,
+        ['\n<ul>\n', 'next', '<li>', 'A', '</li>', 'next', '<li>', '&lt;B&gt;',
+         '</li>', '\n</ul>\n'])
+    self.verify.Equal(
+        ''.join(t.tokenstream({'items': []})), t.expand(items=[]))
+
+    chunks = list(t.tokenstream({'items': ['a', 'b', 'c']}, chunk_size=10))
+    self.verify.Equal(chunks, ['\n<ul>\n<li>', 'A</li><li>', 'B</li><li>',
+                               'C</li>\n</ul>\n'])
+
+    t = jsontemplate.Template('{.section a}{b}{.end}')
+    try:
+      list(t.tokenstream({'a': {'c': 1}}))
+    except jsontemplate.UndefinedVariable, e:
+      self.verify.Equal(len(e.near), 1)
+    else:
+      raise AssertionError('Expected UndefinedVariable')
+
+  def testBufferedSink(self):
+    data = {'items': ['a', 'b', 'c']}
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          '{.repeated section items}<{@}>{.alternates with}\n{.end}',
+          backend=backend)
+      blocks = []
+      sink = jsontemplate.BufferedSink(blocks.append, buffer_size=5)
+      t.execute(data, sink)
+      self.verify.Equal(blocks, ['<a>\n<', 'b>\n<c', '>'])
+      self.verify.Equal(sink.num_writes, 3)
+      self.verify.Equal(sink.num_chars, 11)
+      self.verify.Equal(sink.num_bytes, 11)
+
+    blocks = []
+    sink = jsontemplate.BufferedSink(blocks.append, encoding='utf-8')
+    self.verify.Equal(t.expand({'items': [u'\xe9']}, sink=sink), None)
+    self.verify.Equal(blocks, ['<\xc3\xa9>'])
+    self.verify.Equal((sink.num_chars, sink.num_bytes), (3, 4))
+
+    # Only the outermost expansion flushes, not each nested one
+    for backend in ('interpreter', 'codegen'):
+      row = jsontemplate.Template('<{@}>', backend=backend)
+      table = jsontemplate.Template(
+          '{.repeated section items}{@|template ROW}{.end}', backend=backend)
+      jsontemplate.MakeTemplateGroup({'ROW': row, 'TABLE': table})
+      blocks = []
+      sink = jsontemplate.BufferedSink(blocks.append)
+      table.execute({'items': range(100)}, sink)
+      self.verify.Equal(sink.num_writes, 1)
+      self.verify.Equal(blocks[0][:12], '<0><1><2><3>')
+
+    # Writing to a file descriptor
+    read_fd, write_fd = os.pipe()
+    try:
+      t.execute({'items': [u'\xe9', 'b']}, jsontemplate.BufferedSink(write_fd))
+      self.verify.Equal(os.read(read_fd, 100), '<\xc3\xa9>\n<b>')
+    finally:
+      os.close(read_fd)
+      os.close(write_fd)
+
   def testExpandWithStyle(self):
     # TODO: REMOVE with expand_with_style and execute_with_style_LEGACY
     data = {
@@ -439,6 +936,496 @@ class InternalTemplateTest(taste.Test):
         """), s)
 
 
+class OptimizationTest(taste.Test):
+  """Tests for the passes run over the compiled program."""
+
+  def testCoalesceLiterals(self):
+    t = jsontemplate.Template(B("""
+        Hello{.space}{# comment}there
+        {# Removed line}
+        {.meta-left}{name}{.meta-right}{.newline}
+        """))
+    self.verify.Equal(
+        t._program.Statements()[0], 'Hello there\n{')
+    self.verify.Equal(len(t._program.Statements()), 3)
+    self.verify.Equal(t.expand(name='Bob'), 'Hello there\n{Bob}\n\n')
+
+  def testCoalesceLiteralsInSections(self):
+    t = jsontemplate.Template(
+        '{.repeated section @}a{.space}b{.alternates with}c{.tab}d{.end}')
+    block = t._program.Statements()[0][1]
+    self.verify.Equal(block.Statements(), ['a b'])
+    self.verify.Equal(block.Statements('alternates with'), ['c\td'])
+
+    t = jsontemplate.Template('{.if test x}a{.space}b{.or}c{.space}d{.end}')
+    block = t._program.Statements()[0][1]
+    self.verify.Equal(
+        [statements for _, statements in block.clauses],
+        [['a b'], ['c d']])
+
+  def testFusedFormatters(self):
+
+    def Bad(value):
+      raise ValueError('bad')
+
+    def MoreFormatters(name):
+      return {'bad': Bad, 'upper': lambda x: x.upper()}.get(name)
+
+    t = jsontemplate.Template(
+        '{a|upper|html}{a|bad}',
+        more_formatters=MoreFormatters)
+    try:
+      t.expand({'a': '<b>'})
+    except jsontemplate.EvaluationError, e:
+      # The error still names the formatter which failed
+      self.verify.In('with formatter %s raised' % Bad, e.args[0])
+      self.verify.Equal(e.original_exc_info[0], ValueError)
+    else:
+      raise AssertionError('Expected EvaluationError')
+
+    t = jsontemplate.Template(
+        '{.section a|upper}{@|html}{.end} {b|str|html|upper}',
+        more_formatters=MoreFormatters)
+    self.verify.Equal(t.expand({'a': 'x<', 'b': 1}), 'X&lt; 1')
+
+    t = jsontemplate.Template('{a|none}', more_formatters=lambda name: Bad)
+    self.verify.Raises(jsontemplate.EvaluationError, t.expand, {'a': 'x'})
+
+  def testMemoizedFormatters(self):
+    calls = []
+
+    def Shout(value):
+      calls.append(value)
+      return str(value).upper() + '!'
+    Shout.pure = True
+
+    def Bad(value):
+      raise ValueError('bad')
+    Bad.pure = True
+
+    template_str = '{.repeated section rows}{@|shout}{.alternates with},{.end}'
+    rows = ['a', 'b', 'a', 1, 1.0, True, 1, [1], [1]]
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          template_str, more_formatters={'shout': Shout},
+          backend=backend, memoize_formatters=True)
+      del calls[:]
+      self.verify.Equal(
+          t.expand(rows=rows), 'A!,B!,A!,1!,1.0!,TRUE!,1!,[1]!,[1]!')
+      # Equal values of different types are memoized separately, and lists
+      # aren't memoized
+      self.verify.Equal(calls, ['a', 'b', 1, 1.0, True, [1], [1]])
+
+      # Results aren't kept between expansions
+      del calls[:]
+      t.expand(rows=['a'])
+      self.verify.Equal(calls, ['a'])
+
+    # Without the option, nothing is memoized
+    t = jsontemplate.Template(
+        '{a|shout}{a|shout}', more_formatters={'shout': Shout})
+    del calls[:]
+    t.expand(a='x')
+    self.verify.Equal(calls, ['x', 'x'])
+
+    t = jsontemplate.Template(
+        '{a|html}{b|bad}', more_formatters={'bad': Bad},
+        memoize_formatters=True)
+    try:
+      t.expand(a='<', b='x')
+    except jsontemplate.EvaluationError, e:
+      self.verify.In('Bad', str(e))
+    else:
+      raise AssertionError('Expected EvaluationError')
+
+    t = pickle.loads(pickle.dumps(jsontemplate.Template(
+        '{a|html}{a|html}', memoize_formatters=True)))
+    self.verify.Equal(t.expand(a='<'), '&lt;&lt;')
+    self.verify.Equal(len(t._NewContext({}, None).formatter_cache), 0)
+
+  def testLoopInvariants(self):
+    calls = []
+
+    def Count(value):
+      calls.append(value)
+      return value
+    Count.pure = True  # calls are only counted, so hoisting it is allowed
+
+    template_str = (
+        '{.repeated section rows}'
+        '{title|count}{site.name|count}{@index}{.alternates with},'
+        '{.end}')
+    data = {'title': 'T', 'site': {'name': 'S'},
+            'rows': ['a', {'title': 'U'}, 'b', {'site': {'name': 'R'}}]}
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          template_str, more_formatters={'count': Count}, backend=backend)
+      del calls[:]
+      self.verify.Equal(t.expand(data).split(','),
+                        ['TS1', 'US2', 'TS3', 'TR4'])
+      # {title} and {site.name} are formatted once for the items which don't
+      # define them, and once for each item that does
+      self.verify.Equal(calls.count('T'), 1)
+      self.verify.Equal(calls.count('S'), 1)
+
+    t = jsontemplate.Template('{.repeated section @}{a}{.end}')
+    self.verify.Raises(jsontemplate.UndefinedVariable, t.expand, [{'a': 1}, {}])
+
+    # Formatters which aren't known to be pure are called for every item
+    counter = [0]
+
+    def Number(value):
+      counter[0] += 1
+      return '%s#%d' % (value, counter[0])
+
+    for backend in ('interpreter', 'codegen'):
+      counter[0] = 0
+      t = jsontemplate.Template(
+          '{.repeated section rows}{title|number} {.end}',
+          more_formatters={'number': Number}, backend=backend)
+      self.verify.Equal(t.expand(title='S', rows=[1, 2, 3]), 'S#1 S#2 S#3 ')
+
+  def testPartialEvaluation(self):
+    constants = {
+        'debug': False,
+        'feature-x': True,
+        'site': {'title': 'A&B', 'count': 1},
+        'links': [{'url': 'u1'}, {'url': 'u2'}],
+        }
+    template_str = B("""
+        {.debug?}{name}{.or}prod{.end}
+        {.section site}<h1>{title|html}</h1>{.or}none{.end}
+        {.repeated section links}{@index}:{url}{.alternates with},{.end}
+        {.if test feature-x}X{.or}{name}{.end}
+        {.section site}{.section count}{.singular?}one{.or}many{.end}{.end}{.end}
+        """)
+    t = jsontemplate.Template(template_str, constants=constants)
+    # Everything was evaluated at compile time
+    self.verify.Equal(
+        t._program.Statements(),
+        ['prod\n<h1>A&amp;B</h1>\n1:u1,2:u2\nX\none\n'])
+    # The constants take precedence over the data
+    self.verify.Equal(t.expand(debug=True), t.expand())
+
+    plain = jsontemplate.Template(template_str)
+    constants['name'] = 'Bob'
+    self.verify.Equal(t.expand(name='Bob'), plain.expand(constants))
+
+  def testPartialEvaluationIsConservative(self):
+    constants = {'debug': True, 'site': {'title': 'T', 'n': 2}}
+    template_str = B("""
+        {.section site}{title} {name}{.end}
+        {.section site}{n|cycle a b}{.end}
+        {.repeated section rows}{.debug?}{title}{.end}{.end}
+        {.if test other}{title}{.or}{.debug?}D{.end}{.end}
+        """)
+    data = {'name': 'N', 'title': 'R', 'other': 'yes',
+            'rows': [{'debug': False}, {}]}
+    expected = jsontemplate.Template(template_str).expand(
+        dict(data, **constants))
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          template_str, constants=constants, backend=backend)
+      self.verify.Equal(t.expand(data), expected)
+      # Constants are applied again when unpickling
+      self.verify.Equal(pickle.loads(pickle.dumps(t)).expand(data), expected)
+    self.verify.Raises(jsontemplate.EvaluationError, t.expand, [])
+
+
+class CodegenTest(taste.Test):
+  """Tests for backend='codegen' that the multi-language tests don't cover."""
+
+  def testInvalidBackend(self):
+    self.verify.Raises(
+        jsontemplate.ConfigurationError, jsontemplate.Template, 'Hello',
+        backend='BAD')
+
+  def testSameAsInterpreter(self):
+    template_str = B("""
+        {title|html}
+        {.repeated section rows}
+          {@index} {name|html} {base-url}/{id}
+        {.alternates with}
+          --
+        {.or}
+          None
+        {.end}
+        {.section missing}{@}{.or}missing{.end}
+        {.if test footer}{footer}{.or}no footer{.end}
+        """)
+    data = {
+        'title': '<Report>',
+        'base-url': 'http://example.com',
+        'rows': [{'name': 'A&B', 'id': 1}, {'name': 'C', 'id': 2}],
+        }
+    expected = jsontemplate.Template(template_str).expand(data)
+    t = jsontemplate.Template(template_str, backend='codegen')
+    self.verify.Equal(t.expand(data), expected)
+
+    data['rows'] = []
+    data['footer'] = 'Footer'
+    expected = jsontemplate.Template(template_str).expand(data)
+    self.verify.Equal(t.expand(data), expected)
+
+  def testDefines(self):
+    t = jsontemplate.Template(B("""
+        {.define TITLE}
+        Title: {title}
+        {.end}
+        {.template TITLE}{.section body}{@|template TITLE}{.end}
+        """), backend='codegen')
+    self.verify.Equal(
+        t.expand({'title': 'Hi', 'body': {'title': 'Body'}}),
+        'Title: Hi\nTitle: Body\n\n')
+
+  def testUndefinedVariableShowsContext(self):
+    t = jsontemplate.Template('Hello {name}', backend='codegen')
+    try:
+      t.expand({})
+    except jsontemplate.UndefinedVariable, e:
+      self.verify.Equal(e.near[0], 'Hello ')
+    else:
+      raise AssertionError('Expected UndefinedVariable')
+
+  def testTraceUsesInterpreter(self):
+    trace = jsontemplate.Trace()
+    t = jsontemplate.Template('Hello {name}', backend='codegen')
+    t.expand({'name': 'World'}, trace=trace)
+    self.verify.Equal(trace.exec_depth, 1)
+
+
+class CompiledTemplateCacheTest(taste.Test):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.cache = jsontemplate.CompiledTemplateCache(
+        os.path.join(self.directory, 'cache'))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def testCacheHitSkipsCompiling(self):
+    template_str = B("""
+        {# comment}
+        {.section person}
+          {name|html}{.space}{.if test greet}hi{.or}bye{.end}
+        {.or}
+          {.repeated section list}{@}{.alternates with}, {.end}
+        {.end}
+        {.define TITLE}T{.end}{.template TITLE}
+        """)
+    data = {'person': {'name': '<Bob>', 'greet': True}, 'list': [1, 2]}
+
+    expected = jsontemplate.Template(template_str)
+    t = jsontemplate.Template(template_str, compile_cache=self.cache)
+    self.verify.Equal(len(os.listdir(self.cache.directory)), 1)
+
+    saved = jsontemplate._Tokenize
+    def Fail(*args):
+      raise AssertionError('Template was tokenized')
+    jsontemplate._Tokenize = Fail
+    try:
+      cached = jsontemplate.Template(template_str, compile_cache=self.cache)
+    finally:
+      jsontemplate._Tokenize = saved
+
+    for d in (data, {'list': [1, 2]}):
+      self.verify.Equal(cached.expand(d), expected.expand(d))
+      self.verify.Equal(t.expand(d), expected.expand(d))
+    self.verify.Equal(cached.has_defines, True)
+    self.verify.Equal(sorted(cached.group), ['TITLE'])
+
+  def testKeyIncludesOptions(self):
+    jsontemplate.Template('[a]', compile_cache=self.cache)
+    jsontemplate.Template('[a]', meta='[]', compile_cache=self.cache)
+    jsontemplate.Template('[a]', meta='[]', compile_cache=self.cache)
+    jsontemplate.Template(u'[a]', meta='[]', compile_cache=self.cache)
+    jsontemplate.FromString('meta: []\n\n[a]', compile_cache=self.cache)
+    self.verify.Equal(len(os.listdir(self.cache.directory)), 3)
+
+    t = jsontemplate.Template('[a]', meta='[]', compile_cache=self.cache)
+    self.verify.Equal(t.expand({'a': 1}), '1')
+    t = jsontemplate.Template('[a]', compile_cache=self.cache)
+    self.verify.Equal(t.expand({'a': 1}), '[a]')
+
+  def testBadEntriesAreIgnored(self):
+    jsontemplate.Template('{a}', compile_cache=self.cache)
+    (filename,) = os.listdir(self.cache.directory)
+    path = os.path.join(self.cache.directory, filename)
+
+    key = filename[:-4]
+    for contents in ['garbage', marshal.dumps(('other key', False, [])),
+                     marshal.dumps((key, False, [('Bad', ())])),
+                     # The right shape, but the calls fail
+                     marshal.dumps((key, False, [('Append', ())])),
+                     marshal.dumps((key, False, [('EndSection', ())])),
+                     marshal.dumps((key, False, [('NewSection', ('x',))]))]:
+      f = open(path, 'wb')
+      f.write(contents)
+      f.close()
+      t = jsontemplate.Template('{a}', compile_cache=self.cache)
+      self.verify.Equal(t.expand({'a': 1}), '1')
+
+    # The bad entry was replaced
+    f = open(path, 'rb')
+    self.verify.Equal(
+        marshal.load(f)[2], [('AppendSubstitution', ('a', ['str']))])
+    f.close()
+
+  def testUnwritableDirectory(self):
+    # The cache is best effort; the template is still compiled
+    open(self.cache.directory, 'w').close()  # a file, not a directory
+    t = jsontemplate.Template('{a}', compile_cache=self.cache)
+    self.verify.Equal(t.expand({'a': 1}), '1')
+
+
+class LruCacheTest(taste.Test):
+
+  def testEviction(self):
+    cache = jsontemplate.LruCache(max_entries=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    self.verify.Equal(cache.get('a'), 1)  # now b is the least recently used
+    cache['c'] = 3
+    self.verify.Equal(cache.get('b'), None)
+    self.verify.Raises(KeyError, lambda: cache['b'])
+    self.verify.Equal(cache['c'], 3)
+    self.verify.IsTrue('a' in cache)
+    self.verify.Equal(len(cache), 2)
+    self.verify.Equal(
+        cache.stats(),
+        {'hits': 2, 'misses': 2, 'evictions': 1, 'entries': 2, 'bytes': 0})
+
+    cache.clear()
+    self.verify.Equal(len(cache), 0)
+    self.verify.Equal(cache.stats()['hits'], 2)
+
+  def testMaxBytes(self):
+    self.verify.Raises(
+        jsontemplate.ConfigurationError, jsontemplate.LruCache, max_bytes=10)
+
+    cache = jsontemplate.LruCache(max_bytes=10, sizeof=len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'xxxx'
+    cache['a'] = 'xxxxx'  # replaced, and now the most recently used
+    self.verify.Equal(cache.stats()['bytes'], 9)
+    cache['c'] = 'xx'
+    self.verify.Equal(sorted(cache.stripes[0].nodes), ['a', 'c'])
+    cache['d'] = 'x' * 11  # too big
+    self.verify.Equal(cache.stats()['entries'], 2)
+
+  def testStripes(self):
+    cache = jsontemplate.LruCache(max_entries=8, num_stripes=4)
+    for i in xrange(100):
+      cache[i] = i
+    self.verify.Equal(len(cache), 8)
+    for i in xrange(92, 100):
+      self.verify.Equal(cache[i], i)
+
+  def testTokenRegexCache(self):
+    token_re = jsontemplate.MakeTokenRegex('<%', '%>')
+    self.verify.IsTrue(jsontemplate.MakeTokenRegex('<%', '%>') is token_re)
+    self.verify.IsTrue(
+        isinstance(jsontemplate._token_re_cache, jsontemplate.LruCache))
+
+    # The regexes for _Tokenize are cached the same way, so that templates
+    # with many different metacharacters don't grow the cache without bound
+    breaks = jsontemplate._STR_LINE_BREAKS
+    scanner_re = jsontemplate._MakeScannerRegex('<%', '%>', breaks)
+    self.verify.IsTrue(
+        jsontemplate._MakeScannerRegex('<%', '%>', breaks) is scanner_re)
+    for i in xrange(300):
+      jsontemplate._MakeScannerRegex('<%d' % i, '%d>' % i, breaks)
+    self.verify.Equal(len(jsontemplate._scanner_re_cache), 256)
+    t = jsontemplate.Template('<%x%>', meta='<%%>')
+    self.verify.Equal(t.expand(x=1), '1')
+
+
+class StaticAnalysisTest(taste.Test):
+
+  def testReferencedPaths(self):
+    t = jsontemplate.Template(B("""
+        {title} {@index}
+        {.section person}
+          {name} {address.city|html}{.if test debug}{.end}
+          {.repeated section friends}
+            {@}{.alternates with}, {.singular?}x{.end}
+          {.or}
+            {.template TITLE}
+          {.end}
+        {.or}
+          {.Debug?}{nobody}{.end}
+        {.end}
+        {.define TITLE}{defined}{.end}
+        """))
+    self.verify.Equal(t.referenced_paths(), [
+        ((), 'debug'),
+        ((), 'nobody'),
+        ((), 'person'),
+        ((), 'title'),
+        (('person',), 'address.city'),
+        (('person',), 'debug'),
+        (('person',), 'friends'),
+        (('person',), 'name'),
+        (('person', 'friends'), '@'),
+        ])
+    # {.define} sections are separate templates
+    self.verify.Equal(t.group['TITLE'].referenced_paths(), [((), 'defined')])
+
+
+def _Exclaim(value):
+  """A module-level formatter, so templates which use it can be pickled."""
+  return value + '!'
+
+
+class PickleTest(taste.Test):
+
+  def testPickleTemplate(self):
+    template_str = B("""
+        {title|upper} {title|size} {title|raw|html}
+        {.section person}
+          {name|exclaim}{.section count}{.singular?} one{.or} many{.end}{.end}
+        {.or}
+          {.repeated section list}{@}{.alternates with}, {.end}
+        {.end}
+        {.define TITLE}<{@}>{.end}{.template TITLE}
+        """)
+    data = {
+        'title': 'Hi', 'person': {'name': 'Bob', 'count': 1}, 'list': [1, 2]}
+
+    for backend in ('interpreter', 'codegen'):
+      t = jsontemplate.Template(
+          template_str, more_formatters={'exclaim': _Exclaim},
+          backend=backend)
+      for protocol in (0, pickle.HIGHEST_PROTOCOL):
+        loaded = pickle.loads(pickle.dumps(t, protocol))
+        self.verify.Equal(loaded.backend, backend)
+        self.verify.Equal(loaded.expand(data), t.expand(data))
+        self.verify.Equal(
+            loaded.expand({'title': 'x', 'list': [1]}),
+            t.expand({'title': 'x', 'list': [1]}))
+        self.verify.Equal(sorted(loaded.group), ['TITLE'])
+
+        # A loaded template has no template string, but can be pickled again
+        loaded = pickle.loads(pickle.dumps(loaded, protocol))
+        self.verify.Equal(loaded.expand(data), t.expand(data))
+
+  def testPickleTemplateGroup(self):
+    child = jsontemplate.Template('- {@}')
+    parent = jsontemplate.Template('{.repeated section @}{@|template child}{.end}')
+    jsontemplate.MakeTemplateGroup({'child': child, 'parent': parent})
+
+    loaded = pickle.loads(pickle.dumps(parent))
+    self.verify.Equal(loaded.expand([1, 2]), '- 1- 2')
+    self.verify.Equal(sorted(loaded.group), ['child', 'parent'])
+    self.verify.IsTrue(loaded.group['parent'] is loaded)
+
+  def testDefineCantBePickled(self):
+    t = jsontemplate.Template('{.define TITLE}T{.end}')
+    self.verify.Raises(
+        jsontemplate.UsageError, pickle.dumps, t.group['TITLE'])
+
+
 class FunctionsApiTest(taste.Test):
   """Tests that can only be run internally."""
 
@@ -520,6 +1507,55 @@ class TemplateGroupTest(taste.Test):
           - work
         """))
 
+  def testCheckRefs(self):
+    t = jsontemplate.Template(
+        '{.section a}{@|template child}{.end}{.template TITLE}{@|template SELF}')
+    self.verify.Raises(jsontemplate.UsageError, t._CheckRefs)
+    t._UpdateTemplateGroup({'child': t, 'TITLE': t})
+    t._CheckRefs()  # doesn't raise
+
+  def testDefinesAreCompiledLazily(self):
+    t = jsontemplate.Template(B("""
+        {.define TITLE}{title}{.end}
+        {.define UNUSED}{unused}{.end}
+        {.define ITEM}{@|template TITLE}{.end}
+        {.template ITEM}
+        """))
+
+    def IsCompiled(name):
+      return isinstance(t.group._templates[name], jsontemplate.Template)
+
+    self.verify.Equal(sorted(t.group), ['ITEM', 'TITLE', 'UNUSED'])
+    self.verify.Equal([IsCompiled(name) for name in sorted(t.group)],
+                      [False, False, False])
+    self.verify.Equal(t.expand(title='Hello'), '\n\n\nHello')
+    self.verify.Equal([IsCompiled(name) for name in sorted(t.group)],
+                      [True, True, False])
+    self.verify.IsTrue('UNUSED' in t.group)
+    self.verify.Equal(t.group.get('UNUSED').expand(unused='x'), 'x')
+    self.verify.Equal(t.group.get('OTHER'), None)
+
+    # prefetch() looks at the names in the group without constructing it
+    t = jsontemplate.Template('{.define A}{a}{.end}{.define B}{b}{.end}')
+    self.verify.Equal(t.prefetch({'a': 1}), {'a': 1})
+    self.verify.Equal([IsCompiled(name) for name in sorted(t.group)],
+                      [False, False])
+
+    # No way of getting the values gives a section
+    def AreTemplates(values):
+      for value in values:
+        if not isinstance(value, jsontemplate.Template):
+          return False
+      return True
+
+    for values in [
+        lambda g: g.copy().values(), lambda g: g.values(),
+        lambda g: [v for _, v in g.iteritems()], lambda g: [g.pop('A')],
+        lambda g: [g.setdefault('B')], lambda g: dict(g).values(),
+        lambda g: (lambda **kwargs: kwargs)(**g).values()]:
+      t = jsontemplate.Template('{.define A}{a}{.end}{.define B}{b}{.end}')
+      self.verify.IsTrue(AreTemplates(values(t.group)))
+
   def testMutualRecursion(self):
 
     class NodePredicates(jsontemplate.FunctionRegistry):
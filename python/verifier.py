@@ -44,6 +44,19 @@ class InternalTemplateVerifier(base_verifier.JsonTemplateVerifier):
 
   LABELS = ['python']
 
+  def __init__(self, backend='interpreter'):
+    """
+    Args:
+      backend: Passed to the Template constructor, e.g. 'codegen'.
+    """
+    taste.StandardVerifier.__init__(self)
+    self.backend = backend
+
+  def _Template(self, template_def):
+    kwargs = dict(template_def.kwargs)
+    kwargs.setdefault('backend', self.backend)
+    return jsontemplate.Template(*template_def.args, **kwargs)
+
   def Expansion(
       self, template_def, dictionary, expected, ignore_whitespace=False,
       ignore_all_whitespace=False, all_formatters=False):
@@ -54,7 +67,7 @@ class InternalTemplateVerifier(base_verifier.JsonTemplateVerifier):
     if all_formatters:
       template_def.kwargs['more_formatters'] = formatters.PythonPercentFormat
 
-    template = jsontemplate.Template(*template_def.args, **template_def.kwargs)
+    template = self._Template(template_def)
 
     left = expected
     right = template.expand(dictionary)
@@ -62,10 +75,11 @@ class InternalTemplateVerifier(base_verifier.JsonTemplateVerifier):
     self.LongStringsEqual(left, right, ignore_whitespace=ignore_whitespace)
 
   def EvaluationError(self, exception, template_def, data_dict):
-    template = jsontemplate.Template(*template_def.args, **template_def.kwargs)
+    template = self._Template(template_def)
     self.Raises(exception, template.expand, data_dict)
 
   def CompilationError(self, exception, *args, **kwargs):
+    kwargs.setdefault('backend', self.backend)
     self.Raises(exception, jsontemplate.Template, *args, **kwargs)
 
 